@@ -2,26 +2,30 @@ from microdot import Microdot
 import sys
 import urequests
 from wifi_connector import Wifi_Connector
-from relay import Relay
+from relay_registry import RelayRegistry
 import ssl
 from forecastAnalyzer import ForecastAnalyzer
+from config_store import ConfigStore
+import event_log
+from event_log import EventLog
 
-_WIFI_CONNECTOR = Wifi_Connector() # current defaults to my wifi and password, can chance ssid and password here by updating initialization
-_LED = Relay()
-_RELAY1 = Relay(pinTag=21)
-_RELAY_MAP = {
-    _LED.pinTag(): _LED, 
-    _RELAY1.pinTag(): _RELAY1
-    }
+_WIFI_CONNECTOR = Wifi_Connector(cache_file="wifi_cache.json") # current defaults to my wifi and password, can chance ssid and password here by updating initialization
+_EVENTS = EventLog("events.bin") # same event log as web_server.py
+_CONFIG = ConfigStore("settings.json") # same settings as web_server.py
+_RELAYS = RelayRegistry(_CONFIG) # zones configured on flash, shared with web_server.py
+_WIFI_CONNECTOR.on_result = lambda connected, status: _EVENTS.log(
+    event_log.WIFI_CONNECTED if connected else event_log.WIFI_FAILED,
+    value=_WIFI_CONNECTOR.last_connect_ms if connected else status, urgent=True)
 
 def RunInBackground():
-    global _WIFI_CONNECTOR, _RELAY_MAP
+    global _WIFI_CONNECTOR, _RELAYS
 
     if not (_WIFI_CONNECTOR.connect()):
         print(f"wireless connection failed")
         sys.exit()
 
-    forecast_analyzer = ForecastAnalyzer("config.json")
+    forecast_analyzer = ForecastAnalyzer(_CONFIG)
+    forecast_analyzer.on_error = lambda status_code: _EVENTS.log(event_log.FORECAST_FAILED, value=status_code)
     
     if not forecast_analyzer._zipcode:
         forecast_analyzer.set_zipcode("94127")
@@ -38,6 +42,7 @@ def RunInBackground():
 
     print("\nFetching weather for the next week:")
     forecast_analyzer.fetch_weather_next_week()
+    _EVENTS.flush()
 
 if __name__ == '__main__':
     RunInBackground()
\ No newline at end of file
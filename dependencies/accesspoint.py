@@ -1,64 +1,124 @@
 # ap_mode_manager.py
+import asyncio
 import network
-import time
+import socket
+import struct
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+# URLs phones and laptops fetch to detect a captive portal; answering them with
+# a redirect makes the device open the setup page by itself
+CAPTIVE_PROBES = (
+    '/generate_204', '/gen_204', # Android, Chrome
+    '/hotspot-detect.html', '/library/test/success.html', # Apple
+    '/connecttest.txt', '/ncsi.txt', '/redirect', # Windows
+    '/canonical.html', '/success.txt', # Firefox
+)
+
+_DNS_TTL = 60
+
 
 class APModeManager:
     """
     Manages the Access Point (AP) mode functionality for the Pico W.
 
+    Bringing the AP up never blocks the event loop: await start(), or await
+    active.wait() from any task that needs the AP. While it is up, a small DNS
+    responder answers every name with the AP's address, and install() sends
+    requests for other hosts to the setup page, so a phone joining the AP lands
+    on the setup UI right away.
+
     Author: Dylan O'Connor
     """
     def __init__(self, ssid="PicoRelayAP", password="ILOVEPICO",
                  ip_address="192.168.4.1", subnet_mask="255.255.255.0",
-                 gateway="192.168.4.1", dns="8.8.8.8"):
-        
+                 gateway="192.168.4.1", dns="8.8.8.8", dns_port=53,
+                 timeout_seconds=10):
+
         self.ssid = ssid
         self.password = password
         self.ip_address = ip_address
         self.subnet_mask = subnet_mask
         self.gateway = gateway
         self.dns = dns
+        self.dns_port = dns_port # port of the captive DNS responder, None to disable it
+        self.timeout_seconds = timeout_seconds
         self.ap = network.WLAN(network.AP_IF)
+        self.active = asyncio.Event() # set while AP mode is up
+        self.on_result = None # optional callback(active) run when start() finishes
+        self._dns_task = None
+        self._address = bytes(int(part) for part in ip_address.split('.'))
 
-    def setup_ap_mode(self) -> bool:
+        self.dns_queries = 0
+        self.redirects = 0
+
+    @property
+    def is_ap_active(self) -> bool:
+        """True while AP mode is up."""
+        return self.active.is_set()
+
+    async def start(self) -> bool:
         """
-        Activates and configures the Pico W in Access Point mode.
+        Activates and configures the Pico W in Access Point mode and starts the
+        DNS responder, without blocking the event loop.
         Returns True if successful, False otherwise.
         """
         print("Attempting to set up Access Point mode...")
         try:
             self.ap.active(True)
-            
+
             # modes: 0=Open, 1=WEP, 2=WPA-PSK, 3=WPA2-PSK, 4=WPA/WPA2-PSK
             self.ap.config(essid=self.ssid, password=self.password, security=4)
-            
+
             # Set a static IP for the AP
             self.ap.ifconfig((self.ip_address, self.subnet_mask, self.gateway, self.dns))
 
-            timeout = 10
-            start_time = time.time()
-            while not self.ap.active() and (time.time() - start_time) < timeout:
-                time.sleep(0.5)
+            start_time = ticks_ms()
+            if not self.ap.active():
                 print("Waiting for AP to activate...")
+            while not self.ap.active() and \
+                    ticks_diff(ticks_ms(), start_time) < self.timeout_seconds * 1000:
+                await asyncio.sleep(0.1)
 
             if self.ap.active():
                 current_ip = self.ap.ifconfig()[0]
                 print(f"Access Point Mode Activated!")
                 print(f"SSID: {self.ssid}")
                 print(f"AP IP Address: {current_ip}")
-                return True
+                self.active.set()
+                if self.dns_port and self._dns_task is None:
+                    self._dns_task = asyncio.create_task(self._serve_dns())
+                return self._result(True)
             else:
                 print("Failed to activate AP mode within timeout.")
-                return False
+                return self._result(False)
         except Exception as e:
             print(f"Error setting up AP mode: {e}")
-            self.ap.active(False) 
-            return False
+            self.ap.active(False)
+            return self._result(False)
+
+    def _result(self, active):
+        if self.on_result:
+            self.on_result(active)
+        return active
 
     def disconnect(self):
         """
-        Deactivates the Access Point.
+        Deactivates the Access Point and its DNS responder.
         """
+        self.active.clear()
+        if self._dns_task is not None:
+            self._dns_task.cancel()
+            self._dns_task = None
         if self.ap.active():
             self.ap.active(False)
             print("Access Point Deactivated.")
@@ -70,5 +130,112 @@ class APModeManager:
         if self.ap.active():
             return self.ap.ifconfig()[0]
         return ""
-    
-    
\ No newline at end of file
+
+    # --- captive portal ---
+
+    def dns_reply(self, query):
+        """
+        Builds the reply to a DNS query, answering an A (or ANY) question for
+        any name with the AP's address. Returns None for packets to ignore.
+        """
+        if len(query) < 12:
+            return None
+        flags, questions = struct.unpack_from('!HH', query, 2)
+        if flags & 0x8000 or questions != 1: # a response, or not a plain query
+            return None
+        end = 12
+        while end < len(query) and query[end]: # walk the name's labels
+            end += query[end] + 1
+        end += 5 # the terminating zero, the type and the class
+        if end > len(query):
+            return None
+        qtype = struct.unpack_from('!H', query, end - 4)[0]
+        answers = 1 if qtype in (1, 255) else 0 # A or ANY; other types get no answer
+        # response, authoritative, recursion available; RD copied from the query
+        reply = query[:2] + struct.pack('!HHHHH', 0x8480 | (flags & 0x0100),
+                                        1, answers, 0, 0) + query[12:end]
+        if answers:
+            # a pointer to the question's name, type A, class IN
+            reply += struct.pack('!HHHIH', 0xC00C, 1, 1, _DNS_TTL, 4) + self._address
+        return reply
+
+    async def _serve_dns(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(socket.getaddrinfo('0.0.0.0', self.dns_port)[0][-1])
+            sock.setblocking(False)
+            print(f"DNS responder sending every name to {self.ip_address}.")
+            while self.active.is_set():
+                try:
+                    query, addr = sock.recvfrom(512)
+                except OSError:
+                    await asyncio.sleep(0.05) # nothing received
+                    continue
+                reply = self.dns_reply(query)
+                if reply is not None:
+                    self.dns_queries += 1
+                    sock.sendto(reply, addr)
+                await asyncio.sleep(0)
+        except OSError as e:
+            print(f"DNS responder stopped: {e}")
+        finally:
+            sock.close()
+
+    def _foreign_host(self, request):
+        host = request.headers.get('Host', '').split(':')[0]
+        # names only: requests to one of our addresses are left alone
+        return host != '' and host != self.ip_address and \
+            not host.replace('.', '').isdigit()
+
+    def stats(self):
+        return {
+            'active': self.is_ap_active,
+            'ssid': self.ssid,
+            'ip': self.get_ip_address(),
+            'dns_responder': self._dns_task is not None,
+            'dns_queries': self.dns_queries,
+            'redirects': self.redirects,
+        }
+
+    def install(self, app, setup_url='/setup', url='/ap'):
+        """
+        While AP mode is up, redirects the captive portal checks and requests
+        for other hosts (routed or not) to setup_url on the AP address. Call it
+        after the app's own 404 handler is registered, which it falls back to.
+        Also registers a route at url returning stats() as JSON.
+        """
+        from microdot import Microdot, Response, invoke_handler
+
+        location = f'http://{self.ip_address}{setup_url}'
+        not_found = app.error_handlers.get(404)
+
+        def redirect():
+            self.redirects += 1
+            return Response.redirect(location)
+
+        @app.before_request
+        async def captive_redirect(request):
+            if self.active.is_set() and self._foreign_host(request):
+                return redirect()
+
+        @app.errorhandler(404)
+        async def captive_not_found(request):
+            if self.active.is_set() and self._foreign_host(request):
+                return redirect()
+            if not_found is not None:
+                return await invoke_handler(not_found, request)
+            return 'Not found', 404
+
+        async def captive_probe(request):
+            if not self.active.is_set():
+                Microdot.abort(404)
+            return redirect()
+
+        for probe in CAPTIVE_PROBES:
+            app.route(probe)(captive_probe)
+
+        @app.route(url)
+        async def ap(request):
+            return self.stats()
+        return captive_redirect
@@ -0,0 +1,178 @@
+"""
+Compact binary (CBOR, RFC 8949) encoding of JSON responses, negotiated with
+the ``Accept`` header.
+
+Clients that send ``Accept: application/cbor`` get every dictionary or list
+response encoded as CBOR instead of JSON; everyone else keeps getting JSON.
+CBOR drops the quotes, separators and decimal digits of JSON (a small integer
+is one byte), so status and schedule payloads shrink by roughly a third, and
+encoding needs no intermediate string.
+
+The encoder streams: it writes into a small chunk buffer and hands each full
+chunk to the socket, so a response is never built in memory as a whole. It
+walks nested containers with an explicit stack instead of recursion.
+
+Supported types: ``dict``, ``list``, ``tuple``, ``str``, ``bytes``,
+``bytearray``, ``int``, ``float``, ``bool`` and ``None``.
+
+Example::
+
+    from cbor import CBOREncoding
+
+    encoding = CBOREncoding()
+    encoding.install(app) # dict/list responses as CBOR when accepted
+    encoding.dumps({"21": "On"}) # b'\\xa1b21bOn'
+"""
+import struct
+
+MEDIA_TYPE = 'application/cbor'
+
+_MAJOR_UINT = 0
+_MAJOR_NEGINT = 1
+_MAJOR_BYTES = 2
+_MAJOR_TEXT = 3
+_MAJOR_ARRAY = 4
+_MAJOR_MAP = 5
+
+_FALSE = 0xF4
+_TRUE = 0xF5
+_NULL = 0xF6
+_FLOAT32 = 0xFA
+_FLOAT64 = 0xFB
+
+# room for the longest head or float written past the chunk size
+_SLACK = 9
+
+
+def _map_items(d):
+    for key, value in d.items():
+        yield key
+        yield value
+
+
+class CBOREncoding:
+    """Streaming CBOR encoder and ``Accept`` negotiation for Microdot.
+
+    :param chunk_size: The size of the pieces handed to the socket.
+    """
+    def __init__(self, chunk_size=256):
+        self.chunk_size = chunk_size
+        self.responses = 0
+
+    def _head(self, buf, n, major, value):
+        """Write a CBOR head at ``buf[n]`` and return the new offset."""
+        major <<= 5
+        if value < 24:
+            buf[n] = major | value
+            return n + 1
+        if value < 0x100:
+            buf[n] = major | 24
+            buf[n + 1] = value
+            return n + 2
+        if value < 0x10000:
+            struct.pack_into('>BH', buf, n, major | 25, value)
+            return n + 3
+        if value < 0x100000000:
+            struct.pack_into('>BI', buf, n, major | 26, value)
+            return n + 5
+        if value < 0x10000000000000000:
+            struct.pack_into('>BQ', buf, n, major | 27, value)
+            return n + 9
+        raise ValueError('integer too large for CBOR')
+
+    def stream(self, obj):
+        """Generate the CBOR encoding of ``obj`` in chunks of about
+        ``chunk_size`` bytes."""
+        size = self.chunk_size
+        buf = bytearray(size + _SLACK)
+        n = 0
+        stack = [iter((obj,))]
+        while stack:
+            try:
+                item = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+
+            payload = None
+            if item is None:
+                buf[n] = _NULL
+                n += 1
+            elif item is True:
+                buf[n] = _TRUE
+                n += 1
+            elif item is False:
+                buf[n] = _FALSE
+                n += 1
+            elif isinstance(item, int):
+                if item >= 0:
+                    n = self._head(buf, n, _MAJOR_UINT, item)
+                else:
+                    n = self._head(buf, n, _MAJOR_NEGINT, -1 - item)
+            elif isinstance(item, float):
+                try:
+                    single = struct.pack('>f', item)
+                except OverflowError: # too large for a float32 (CPython)
+                    single = None
+                if single is not None and struct.unpack('>f', single)[0] == item:
+                    buf[n] = _FLOAT32
+                    buf[n + 1:n + 5] = single
+                    n += 5
+                else:
+                    struct.pack_into('>Bd', buf, n, _FLOAT64, item)
+                    n += 9
+            elif isinstance(item, str):
+                payload = item.encode()
+                n = self._head(buf, n, _MAJOR_TEXT, len(payload))
+            elif isinstance(item, (bytes, bytearray)):
+                payload = item
+                n = self._head(buf, n, _MAJOR_BYTES, len(payload))
+            elif isinstance(item, dict):
+                n = self._head(buf, n, _MAJOR_MAP, len(item))
+                stack.append(_map_items(item))
+            elif isinstance(item, (list, tuple)):
+                n = self._head(buf, n, _MAJOR_ARRAY, len(item))
+                stack.append(iter(item))
+            else:
+                raise TypeError(f'cannot encode {type(item).__name__} as CBOR')
+
+            if payload:
+                length = len(payload)
+                if n + length > size:
+                    # flush what is buffered; big strings go out as they are
+                    if n:
+                        yield bytes(memoryview(buf)[:n])
+                        n = 0
+                    if length > size:
+                        yield bytes(payload)
+                        continue
+                buf[n:n + length] = payload
+                n += length
+            if n >= size:
+                yield bytes(memoryview(buf)[:n])
+                n = 0
+        if n:
+            yield bytes(memoryview(buf)[:n])
+
+    def dumps(self, obj):
+        """Return the CBOR encoding of ``obj`` as bytes."""
+        return b''.join(self.stream(obj))
+
+    def accepts(self, request):
+        """Return ``True`` if the client asked for CBOR."""
+        return MEDIA_TYPE in request.headers.get('Accept', '')
+
+    def install(self, app):
+        """Encode the dictionary and list responses of ``app`` (error
+        responses included) as CBOR for clients that accept it."""
+        async def encode_cbor(request, response):
+            if response.data is not None and request is not None \
+                    and self.accepts(request):
+                response.body = self.stream(response.data)
+                response.data = None
+                response.headers['Content-Type'] = MEDIA_TYPE
+                self.responses += 1
+            return response
+        app.after_request(encode_cbor)
+        app.after_error_request(encode_cbor)
+        return encode_cbor
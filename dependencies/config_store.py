@@ -0,0 +1,319 @@
+"""
+One key-value store for all the settings kept on flash, cached in RAM.
+
+Every setting lives in one JSON file (``settings.json``) under a dotted key,
+such as ``wifi.ssid``, ``forecast.zipcode`` or ``schedules``. The file is read
+once at boot; after that, reads come from memory. A change is written back
+with one commit, and a commit replaces the whole file atomically (write a
+copy, then rename it), so a reset in the middle of a write leaves the
+previous settings intact. Changes made inside ``batch()`` share a single
+commit, or are all discarded if the block raises. Setting a key to the value
+it already has writes nothing.
+
+The file records its schema version. When a store of an older version is
+loaded, the migration functions bring it up to date and the result is
+committed. Version 0 is a device without a store: its migration imports the
+files used before (``wifi_config.json``, ``config.json`` and
+``schedules.json``); version 1 to 2 imports the zone list (``relays.json``)
+under ``relays``. They are left in place until the application calls
+:meth:`ConfigStore.remove_legacy_files`, once the firmware is known to work,
+so an OTA rollback to the previous firmware still finds its settings. A store
+written by newer firmware (after an OTA rollback, say) is used as it is, and
+is not rewritten with an older version.
+
+Example::
+
+    from config_store import ConfigStore
+
+    config = ConfigStore("settings.json")
+    ssid = config.get_str("wifi.ssid")
+    with config.batch(): # one flash write for both keys
+        config.set("wifi.ssid", "home")
+        config.set("wifi.password", "secret")
+    config.subscribe("schedules", lambda key, value: print(key, "changed"))
+    config.install(app) # GET /config (statistics; values are not served)
+"""
+import json
+import os
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+SCHEMA_VERSION = 2
+
+# settings files of earlier versions: (file, key prefix to spread a JSON
+# object over, or the key to store the whole file under, version whose
+# migration imports it)
+LEGACY_FILES = (
+    ('wifi_config.json', 'wifi.', 0),
+    ('config.json', 'forecast.', 0),
+    ('schedules.json', 'schedules', 0),
+    ('relays.json', 'relays', 1),
+)
+
+_TRUE = ('1', 'true', 'yes', 'on')
+
+
+def _import_legacy_files(values, version=0):
+    """Version 0 to 1: read the separate settings files used before."""
+    for path, key, imported_by in LEGACY_FILES:
+        if imported_by != version:
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if key.endswith('.'):
+            if isinstance(data, dict):
+                for name, value in data.items():
+                    if value is not None:
+                        values[key + name] = value
+        else:
+            values[key] = data
+        print(f"Imported {path} into the config store.")
+    return values
+
+
+def _import_relays(values):
+    """Version 1 to 2: read the zone list, kept in its own file before."""
+    return _import_legacy_files(values, 1)
+
+
+# version -> function(values) returning the values of the next version
+MIGRATIONS = {
+    0: _import_legacy_files,
+    1: _import_relays,
+}
+
+
+class ConfigStore:
+    """Loads the settings, serves them from memory and commits changes.
+
+    :param path: The JSON file holding the settings.
+    :param migrations: Dictionary of schema version to the function
+                       upgrading the values of that version to the next.
+    :param version: The schema version this firmware writes.
+    """
+    def __init__(self, path='settings.json', migrations=MIGRATIONS,
+                 version=SCHEMA_VERSION):
+        self.path = path
+        self.migrations = migrations
+        self.version = version
+        self._values = {}
+        self._subscribers = [] # list of (key or prefix, callback)
+        self._dirty = False
+        self._batch_depth = 0
+        self._saved = None # (values, dirty) before the outermost batch
+
+        self.commits = 0
+        self.unchanged = 0 # sets skipped because the value was already stored
+        self.last_commit_ms = 0
+        self.size = 0 # bytes in the file after the last load or commit
+        self.load()
+
+    def load(self):
+        """(Re)load the settings from the file, migrating them if needed."""
+        data = None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(data, dict) or not isinstance(data.get('values'), dict):
+            data = {'version': 0, 'values': {}}
+        self._values = data['values']
+        found = data.get('version', 0)
+        if found > self.version:
+            print(f"Config store version {found} is newer than {self.version}; using it as is.")
+            self.version = found
+            return
+        while found < self.version:
+            self._values = self.migrations[found](self._values)
+            found += 1
+            self._dirty = True
+        if self._dirty:
+            self.commit()
+        else:
+            self.size = self._file_size()
+
+    def remove_legacy_files(self):
+        """Delete the settings files of earlier versions, once they were
+        imported and committed. Call it when the running firmware is known
+        to work (e.g. its OTA slot is confirmed): until then, the previous
+        firmware may be booted again and needs them."""
+        if self._dirty or not self._file_size():
+            return
+        for path, _, _ in LEGACY_FILES:
+            try:
+                os.remove(path)
+                print(f"Removed {path}; its settings are in {self.path}.")
+            except OSError:
+                pass
+
+    def _file_size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    # --- reads ---
+
+    def get(self, key, default=None):
+        """Return the value stored for ``key``, or ``default``. Lists and
+        dictionaries are the stored objects: after changing one, pass it to
+        set() again so the change is committed."""
+        return self._values.get(key, default)
+
+    def _converted(self, key, default, kind):
+        value = self._values.get(key)
+        if value is None:
+            return default
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_int(self, key, default=0):
+        return self._converted(key, default, int)
+
+    def get_float(self, key, default=0.0):
+        return self._converted(key, default, float)
+
+    def get_str(self, key, default=None):
+        return self._converted(key, default, str)
+
+    def get_bool(self, key, default=False):
+        value = self._values.get(key)
+        if value is None:
+            return default
+        if isinstance(value, str):
+            return value.lower() in _TRUE
+        return bool(value)
+
+    def get_list(self, key, default=None):
+        value = self._values.get(key)
+        return value if isinstance(value, list) else default
+
+    def get_dict(self, key, default=None):
+        value = self._values.get(key)
+        return value if isinstance(value, dict) else default
+
+    def keys(self, prefix=''):
+        return [key for key in self._values if key.startswith(prefix)]
+
+    # --- changes ---
+
+    def set(self, key, value):
+        """Store ``value`` under ``key`` and commit it (at the end of the
+        batch inside ``batch()``). Returns False if nothing changed."""
+        old = self._values.get(key)
+        # a list or dictionary passed back after being changed in place is
+        # the stored object itself, so it can't be compared with it
+        if key in self._values and old == value and \
+                not (old is value and isinstance(value, (dict, list))):
+            self.unchanged += 1
+            return False
+        self._values[key] = value
+        self._changed(key, value)
+        return True
+
+    def delete(self, key):
+        """Remove ``key``. Returns False if it was not set."""
+        if key not in self._values:
+            return False
+        del self._values[key]
+        self._changed(key, None)
+        return True
+
+    def _changed(self, key, value):
+        self._dirty = True
+        self._notify(key, value)
+        if not self._batch_depth:
+            self.commit()
+
+    def _notify(self, key, value):
+        for prefix, callback in self._subscribers:
+            if key == prefix or (prefix.endswith('.') and key.startswith(prefix)):
+                callback(key, value)
+
+    def subscribe(self, key, callback):
+        """Register callback(key, value), called when ``key`` changes (value
+        None when it is deleted). A key ending with a dot, such as ``wifi.``,
+        subscribes to every key starting with it."""
+        self._subscribers.append((key, callback))
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers = [entry for entry in self._subscribers if entry[1] is not callback]
+
+    def batch(self):
+        """Return a context manager deferring the commit of the changes made
+        inside it to its end. If the block raises, the changes are discarded
+        instead (subscribers are told about the restored values). Batches can
+        be nested; the outermost commits or discards."""
+        return self
+
+    def __enter__(self):
+        if not self._batch_depth:
+            self._saved = (dict(self._values), self._dirty)
+        self._batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._batch_depth -= 1
+        if self._batch_depth:
+            return
+        values, dirty = self._saved
+        self._saved = None
+        if exc_type is None:
+            self.commit()
+            return
+        staged, self._values, self._dirty = self._values, values, dirty
+        for key in set(staged) | set(values):
+            if key not in staged or key not in values or staged[key] is not values[key]:
+                self._notify(key, values.get(key))
+
+    def commit(self):
+        """Write the settings to flash if anything changed since the last
+        commit: a copy is written, then renamed over the file."""
+        if not self._dirty:
+            return False
+        started = ticks_ms()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'values': self._values}, f)
+        os.rename(tmp, self.path)
+        self._dirty = False
+        self.commits += 1
+        self.last_commit_ms = ticks_diff(ticks_ms(), started)
+        self.size = self._file_size()
+        return True
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'keys': len(self._values),
+            'bytes': self.size,
+            'commits': self.commits,
+            'unchanged_sets': self.unchanged,
+            'last_commit_ms': self.last_commit_ms,
+            'dirty': self._dirty,
+        }
+
+    def install(self, app, url='/config'):
+        """Register a route at ``url`` returning stats() as JSON. The values
+        themselves (Wi-Fi password included) are not served."""
+        @app.route(url)
+        async def config(request):
+            return self.stats()
+        return config
+
@@ -0,0 +1,380 @@
+"""
+Optional dual-core mode: the schedule engine and relay control run on the
+RP2040's second core, the network stack and web server on the first.
+
+The two cores share nothing but two single-producer/single-consumer rings and
+a state snapshot:
+
+* the command ring carries requests from the network side (switch a zone,
+  recompile the schedules, the clock was stepped, run a function) to the
+  engine, so while the engine runs every relay is switched on its core,
+* the notification ring carries every relay change back, plus calls the
+  engine defers (an interlock trip to log), so listeners that touch flash or
+  the network (event log, usage, pushes) keep running on the first core and
+  never race the engine,
+* the snapshot is a dictionary the engine replaces whole (one reference
+  store) whenever a zone changes, and at least every ``publish_ms``, so
+  readers always see a consistent view without taking a lock. Besides the
+  zone states it holds the interlock and zone queue statistics, which the
+  first core serves from there instead of reading the engine's structures
+  while the other core changes them.
+
+The rings need no lock either: each index is written by one side only, and a
+slot is filled before the index that publishes it is advanced. On the
+RP2040 the cores see each other's stores in order, and MicroPython's rp2
+port runs threads without a GIL, so a slow HTTP request can no longer delay
+a valve switching off.
+
+On the second core there is no asyncio loop; the engine polls the
+reconciler, the interlock and the zone queue from a plain loop every
+``interval_ms``. Their relay listeners are registered with
+:meth:`Core1Engine.add_engine_listener` and run on the engine's core only. The same code runs on CPython, where ``_thread`` starts an
+ordinary thread, so the engine can be exercised off-device.
+
+Example::
+
+    from dual_core import Core1Engine
+
+    engine = Core1Engine()
+    engine.add_listener(events_listener) # runs on the first core
+    engine.add_engine_listener(queue.on_relay_change) # runs on the second
+    engine.start(reconciler, registry.relays, interlock=interlock, queue=queue)
+    asyncio.create_task(engine.dispatch())
+    engine.switch(relay, True)
+"""
+import asyncio
+from array import array
+
+import _thread
+
+from relay import Relay
+
+try:
+    from time import ticks_ms, ticks_diff, sleep_ms # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+try:
+    from utime import time as wall_time # type: ignore
+except ImportError:
+    from time import time as wall_time
+
+try:
+    from sys import print_exception # type: ignore
+except ImportError:
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exception(exc.__class__, exc, exc.__traceback__)
+
+# commands, network side -> engine
+CMD_ON = 1
+CMD_OFF = 2
+CMD_COMPILE = 3 # argument: a schedules dictionary the caller no longer mutates
+CMD_CLOCK_STEP = 4
+CMD_CALL = 5 # argument: a function run on the engine's core
+
+_HEAD = 0 # written by the producer only
+_TAIL = 1 # written by the consumer only
+
+
+class SPSCRing:
+    """A lock-free ring for exactly one producer and one consumer thread.
+
+    :param size: The number of slots, a power of two.
+    """
+    def __init__(self, size=32):
+        if size & (size - 1):
+            raise ValueError('ring size must be a power of two')
+        self.size = size
+        self._mask = size - 1
+        self._slots = [None] * size
+        self._index = array('L', [0, 0])
+        self.overflows = 0
+
+    def __len__(self):
+        return (self._index[_HEAD] - self._index[_TAIL]) & 0xFFFFFFFF
+
+    def push(self, item):
+        """Append ``item`` (producer side). Returns ``False`` if the ring is
+        full."""
+        head = self._index[_HEAD]
+        if ((head - self._index[_TAIL]) & 0xFFFFFFFF) >= self.size:
+            self.overflows += 1
+            return False
+        self._slots[head & self._mask] = item
+        self._index[_HEAD] = (head + 1) & 0xFFFFFFFF # publishes the slot
+        return True
+
+    def pop(self):
+        """Remove and return the oldest item (consumer side), or ``None`` if
+        the ring is empty."""
+        tail = self._index[_TAIL]
+        if tail == self._index[_HEAD]:
+            return None
+        slot = tail & self._mask
+        item = self._slots[slot]
+        self._slots[slot] = None
+        self._index[_TAIL] = (tail + 1) & 0xFFFFFFFF # hands the slot back
+        return item
+
+
+class Core1Engine:
+    """Runs the schedule engine and relay control on the second core.
+
+    :param interval_ms: How often the engine loop runs.
+    :param ring_size: The number of slots of each ring.
+    :param publish_ms: How often the snapshot is refreshed when no zone
+                       changes, to keep the remaining times in the statistics
+                       current.
+    """
+    def __init__(self, interval_ms=100, ring_size=32, publish_ms=1000):
+        self.interval_ms = interval_ms
+        self.publish_ms = publish_ms
+        self.commands = SPSCRing(ring_size)
+        self.notifications = SPSCRing(ring_size * 2)
+        self.snapshot = {'zones': {}, 'updated': 0, 'interlock': {}, 'queue': {}}
+        self._listeners = []
+        self._engine_listeners = []
+        self._reconciler = None
+        self._relays = None
+        self._interlock = None
+        self._queue = None
+        self._running = False
+        self._stopped = True
+        self._dirty = True
+        self._published_ms = ticks_ms()
+        # written by the engine only; a single word store per loop
+        self._heartbeat = array('L', [0])
+        self._seen_heartbeat = 0
+        self._seen_ticks = ticks_ms()
+
+        self.loops = 0
+        self.errors = 0
+        self.max_loop_ms = 0
+
+    # --- network side (first core) ---
+
+    def add_listener(self, listener):
+        """Register ``listener(relay, is_on)``, called on the first core by
+        :meth:`dispatch` for every relay change made by the engine."""
+        self._listeners.append(listener)
+
+    def add_engine_listener(self, listener):
+        """Register ``listener(relay, is_on)``, called on the engine's core
+        right after it switched a relay; for the interlock and the zone queue,
+        which the engine drives."""
+        self._engine_listeners.append(listener)
+
+    @property
+    def running(self):
+        """True while the engine loop runs and owns the relays."""
+        return self._running and not self._stopped
+
+    def switch(self, relay, on):
+        """Ask the engine to switch ``relay``. Returns ``False`` if the
+        command ring is full."""
+        return self.commands.push((CMD_ON if on else CMD_OFF, relay))
+
+    def compile(self, schedules):
+        """Ask the engine to recompile the schedules. Pass a copy the caller
+        will not modify afterwards."""
+        return self.commands.push((CMD_COMPILE, schedules))
+
+    def notify_clock_step(self):
+        return self.commands.push((CMD_CLOCK_STEP, None))
+
+    def call(self, function):
+        """Ask the engine to run ``function()`` on its core, e.g. to switch
+        several relays at once."""
+        return self.commands.push((CMD_CALL, function))
+
+    def start(self, reconciler, relays, interlock=None, queue=None):
+        """Start the engine loop on the second core.
+
+        :param reconciler: The :class:`reconciler.ScheduleReconciler`.
+        :param relays: Function returning the relays in the snapshot.
+        :param interlock: Optional :class:`interlock.RuntimeInterlock`.
+        :param queue: Optional :class:`zone_queue.ZoneQueue`.
+        """
+        self._reconciler = reconciler
+        self._relays = relays
+        self._interlock = interlock
+        self._queue = queue
+        Relay.add_listener(self._on_relay_change)
+        self._running = True
+        self._stopped = False
+        _thread.start_new_thread(self._loop, ())
+        print("Schedule engine started on the second core.")
+
+    def stop(self, timeout_ms=2000):
+        """Stop the engine loop and wait for it to exit."""
+        self._running = False
+        started = ticks_ms()
+        while not self._stopped and ticks_diff(ticks_ms(), started) < timeout_ms:
+            sleep_ms(10)
+        self.drain()
+
+    def drain(self):
+        """Deliver the pending relay notifications to the listeners."""
+        delivered = 0
+        while True:
+            item = self.notifications.pop()
+            if item is None:
+                return delivered
+            function, args = item
+            if function is None: # a relay change
+                for listener in self._listeners:
+                    listener(*args)
+            else:
+                function(*args)
+            delivered += 1
+
+    async def dispatch(self, interval_ms=50):
+        """The notification task on the first core."""
+        while True:
+            self.drain()
+            await asyncio.sleep(interval_ms / 1000)
+
+    def alive(self, max_age_ms=5000):
+        """Return ``False`` if the engine loop has not run for
+        ``max_age_ms``; meant as the watchdog health check."""
+        beat = self._heartbeat[0]
+        now = ticks_ms()
+        if beat != self._seen_heartbeat:
+            self._seen_heartbeat = beat
+            self._seen_ticks = now
+            return True
+        return ticks_diff(now, self._seen_ticks) < max_age_ms
+
+    def states(self):
+        """Return the latest zone states published by the engine."""
+        return self.snapshot['zones']
+
+    def published(self, name):
+        """Return the latest ``stats()`` of the engine's ``'interlock'`` or
+        ``'queue'``, as published in the snapshot."""
+        return self.snapshot[name]
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'interval_ms': self.interval_ms,
+            'loops': self.loops,
+            'errors': self.errors,
+            'max_loop_ms': self.max_loop_ms,
+            'commands_pending': len(self.commands),
+            'command_overflows': self.commands.overflows,
+            'notifications_pending': len(self.notifications),
+            'notification_overflows': self.notifications.overflows,
+            'zones': self.snapshot['zones'],
+            'updated': self.snapshot['updated'],
+        }
+
+    def install(self, app, url='/core1', interlock_url='/interlock',
+                queue_url='/queue'):
+        """Register a route that returns :meth:`stats` as JSON, and the
+        interlock and queue routes (in place of their own ``install()``),
+        served from the snapshot. Pass ``None`` to leave one out."""
+        @app.route(url)
+        async def core1(request):
+            return self.stats()
+
+        def serve(name):
+            async def published(request):
+                return self.published(name)
+            return published
+
+        if interlock_url:
+            app.route(interlock_url)(serve('interlock'))
+        if queue_url:
+            app.route(queue_url)(serve('queue'))
+        return core1
+
+    # --- engine side (second core) ---
+
+    def defer(self, function, *args):
+        """Run ``function(*args)`` on the first core, from :meth:`dispatch`;
+        for callbacks of the engine's modules that touch flash or the
+        network."""
+        return self.notifications.push((function, args))
+
+    def _on_relay_change(self, relay, is_on):
+        # relay listener; relays are only switched on the engine's core while
+        # it runs, and on the first core once it has stopped
+        self._dirty = True
+        for listener in self._engine_listeners:
+            listener(relay, is_on)
+        self.notifications.push((None, (relay, is_on)))
+
+    def _execute(self, op, arg):
+        if op == CMD_ON:
+            arg.turn_on()
+        elif op == CMD_OFF:
+            arg.turn_off()
+        elif op == CMD_COMPILE:
+            self._reconciler.compile(arg)
+        elif op == CMD_CLOCK_STEP:
+            self._reconciler.notify_clock_step()
+        elif op == CMD_CALL:
+            arg()
+
+    def _publish(self):
+        zones = {}
+        for relay in self._relays():
+            zones[relay.pinTag()] = relay.status() == "On"
+        # replaced whole, never modified: readers need no lock
+        self.snapshot = {
+            'zones': zones,
+            'updated': int(wall_time()),
+            'interlock': self._interlock.stats() if self._interlock is not None else {},
+            'queue': self._queue.stats() if self._queue is not None else {},
+        }
+        self._dirty = False
+        self._published_ms = ticks_ms()
+
+    def _step(self, last_minute):
+        while True:
+            command = self.commands.pop()
+            if command is None:
+                break
+            self._execute(*command)
+        utc = int(wall_time())
+        minute = utc // 60
+        if minute != last_minute:
+            self._reconciler.tick(utc)
+        if self._interlock is not None:
+            self._interlock.advance()
+        if self._queue is not None:
+            self._queue.poll()
+        if self._dirty or \
+                ticks_diff(ticks_ms(), self._published_ms) >= self.publish_ms:
+            self._publish()
+        return minute
+
+    def _loop(self):
+        last_minute = None
+        while self._running:
+            started = ticks_ms()
+            try:
+                last_minute = self._step(last_minute)
+            except Exception as e:
+                # keep the valves under control whatever went wrong
+                self.errors += 1
+                print_exception(e)
+            elapsed = ticks_diff(ticks_ms(), started)
+            if elapsed > self.max_loop_ms:
+                self.max_loop_ms = elapsed
+            self.loops += 1
+            self._heartbeat[0] = self.loops & 0xFFFFFFFF
+            sleep_ms(max(0, self.interval_ms - elapsed))
+        self._stopped = True
@@ -0,0 +1,259 @@
+"""
+Persistent event log: a fixed-size ring of binary records on flash.
+
+Every event is a 16 byte record (sequence number, timestamp, event code, zone,
+value) instead of a line of text, so the log can hold a couple of thousand
+events in a file that is preallocated once and never grows. New records are
+staged in RAM and written out in batches (when the staging buffer fills up,
+every ``flush_interval_s``, or at once for events marked urgent), so logging
+does not rewrite a file per event.
+
+The log survives reboots: at startup the file is scanned for the highest
+sequence number and writing continues after it. ``GET /events`` streams it
+out in pages, oldest first::
+
+    GET /events?since=1200&limit=100
+
+returns ``{"first": ..., "next": ..., "events": [...]}``; pass ``next`` back as
+``since`` to continue.
+
+Other modules report what happened through plain callback attributes
+(``on_result``, ``on_trip``, ``on_stall``, ...) that ``web_server.py`` wires to
+:meth:`EventLog.log`, so they keep working without this module.
+
+Example::
+
+    from event_log import EventLog, ZONE_ON
+
+    events = EventLog("events.bin")
+    asyncio.create_task(events.run())
+    events.log(ZONE_ON, zone=21)
+    events.install(app)
+"""
+import asyncio
+import struct
+
+try:
+    from utime import time as wall_time # type: ignore
+except ImportError:
+    from time import time as wall_time
+
+MAGIC = b'EVL1'
+HEADER_SIZE = 16
+RECORD_SIZE = 16
+_RECORD = '<IIHHi' # seq, timestamp, code, zone, value
+
+# zone field values that are not pin numbers
+ZONE_NONE = 0xFFFF
+ZONE_LED = 0xFFFE
+
+# event codes
+BOOT = 1
+WATCHDOG_RESET = 2
+WIFI_CONNECTED = 3 # value: connect time in ms
+WIFI_FAILED = 4 # value: WLAN status
+AP_MODE = 5
+ZONE_ON = 10
+ZONE_OFF = 11
+INTERLOCK_TRIP = 12 # value: runtime in seconds
+SCHEDULE_CHANGED = 13
+RELAYS_CHANGED = 14
+NTP_STEP = 21 # value: step in seconds
+LOOP_STALL = 30 # value: stall in ms
+FORECAST_FAILED = 40 # value: HTTP status, or 0 for an exception
+ERROR = 50
+
+EVENT_NAMES = {
+    BOOT: 'boot', WATCHDOG_RESET: 'watchdog_reset',
+    WIFI_CONNECTED: 'wifi_connected', WIFI_FAILED: 'wifi_failed',
+    AP_MODE: 'ap_mode', ZONE_ON: 'zone_on', ZONE_OFF: 'zone_off',
+    INTERLOCK_TRIP: 'interlock_trip', SCHEDULE_CHANGED: 'schedule_changed',
+    RELAYS_CHANGED: 'relays_changed', NTP_STEP: 'ntp_step',
+    LOOP_STALL: 'loop_stall', FORECAST_FAILED: 'forecast_failed',
+    ERROR: 'error',
+}
+
+
+def zone_code(pin_tag):
+    """Return the zone field value for a relay pin tag."""
+    if isinstance(pin_tag, int) and 0 <= pin_tag < ZONE_LED:
+        return pin_tag
+    return ZONE_LED if pin_tag == "LED" else ZONE_NONE
+
+
+class EventLog:
+    """A ring-buffer event log on flash.
+
+    :param path: The log file.
+    :param capacity: The number of records kept (16 bytes each).
+    :param stage_size: The number of records staged in RAM between writes.
+    :param flush_interval_s: How often staged records are written.
+    """
+    def __init__(self, path='events.bin', capacity=2048, stage_size=32,
+                 flush_interval_s=60):
+        self.path = path
+        self.capacity = capacity
+        self.stage_size = stage_size
+        self.flush_interval_s = flush_interval_s
+        self._stage = bytearray(stage_size * RECORD_SIZE)
+        self._staged = 0
+        self._next_seq = 1 # sequence number of the next record
+        self._flushed_seq = 1 # first sequence number not on flash yet
+        self.flushes = 0
+        self.dropped = 0
+        self._open()
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'r+b')
+            header = self._file.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE or header[:4] != MAGIC \
+                    or struct.unpack_from('<I', header, 4)[0] != self.capacity:
+                raise ValueError('event log header mismatch')
+            self._scan()
+        except (OSError, ValueError) as e:
+            print(f"Creating event log ({e}).")
+            try:
+                self._file.close()
+            except AttributeError:
+                pass
+            self._create()
+
+    def _create(self):
+        self._file = open(self.path, 'w+b')
+        header = bytearray(HEADER_SIZE)
+        header[:4] = MAGIC
+        struct.pack_into('<I', header, 4, self.capacity)
+        self._file.write(header)
+        empty = bytes(RECORD_SIZE * 32)
+        for _ in range(self.capacity // 32):
+            self._file.write(empty)
+        self._file.write(bytes(RECORD_SIZE * (self.capacity % 32)))
+        self._file.flush()
+
+    def _scan(self):
+        """Find the newest record, reading the file in small chunks."""
+        newest = 0
+        buf = bytearray(RECORD_SIZE * 32)
+        self._file.seek(HEADER_SIZE)
+        remaining = self.capacity
+        while remaining:
+            n = min(32, remaining)
+            view = memoryview(buf)[:n * RECORD_SIZE]
+            if self._file.readinto(view) != n * RECORD_SIZE:
+                raise ValueError('event log truncated')
+            for i in range(n):
+                seq = struct.unpack_from('<I', buf, i * RECORD_SIZE)[0]
+                if seq > newest:
+                    newest = seq
+            remaining -= n
+        self._next_seq = self._flushed_seq = newest + 1
+
+    def log(self, code, zone=ZONE_NONE, value=0, urgent=False):
+        """Record an event. ``urgent`` writes it (and everything staged) to
+        flash right away, for events that may precede a reset."""
+        if self._staged >= self.stage_size:
+            self.flush()
+        struct.pack_into(_RECORD, self._stage, self._staged * RECORD_SIZE,
+                         self._next_seq, int(wall_time()) & 0xFFFFFFFF, code,
+                         zone, max(-0x80000000, min(0x7FFFFFFF, int(value))))
+        self._staged += 1
+        self._next_seq += 1
+        if urgent:
+            self.flush()
+
+    def flush(self):
+        """Write the staged records to flash."""
+        if not self._staged:
+            return
+        try:
+            i = 0
+            while i < self._staged:
+                slot = (self._flushed_seq + i) % self.capacity
+                # contiguous run up to the end of the staging buffer or the file
+                n = min(self._staged - i, self.capacity - slot)
+                self._file.seek(HEADER_SIZE + slot * RECORD_SIZE)
+                self._file.write(memoryview(self._stage)[i * RECORD_SIZE:(i + n) * RECORD_SIZE])
+                i += n
+            self._file.flush()
+            self.flushes += 1
+        except OSError as e:
+            # keep going without the log rather than failing the caller
+            print(f"Error writing event log: {e}")
+            self.dropped += self._staged
+        self._flushed_seq += self._staged
+        self._staged = 0
+
+    async def run(self):
+        """The flush task."""
+        while True:
+            await asyncio.sleep(self.flush_interval_s)
+            self.flush()
+
+    def first_seq(self):
+        """Return the sequence number of the oldest record available."""
+        return max(1, self._next_seq - self.capacity)
+
+    def read(self, seq):
+        """Return the record with sequence number ``seq`` as a tuple, or
+        ``None`` if it is no longer (or not yet) in the log."""
+        if not self.first_seq() <= seq < self._next_seq:
+            return None
+        if seq >= self._flushed_seq:
+            return struct.unpack_from(_RECORD, self._stage,
+                                      (seq - self._flushed_seq) * RECORD_SIZE)
+        self._file.seek(HEADER_SIZE + (seq % self.capacity) * RECORD_SIZE)
+        record = struct.unpack(_RECORD, self._file.read(RECORD_SIZE))
+        return record if record[0] == seq else None
+
+    def page(self, since=None, limit=100):
+        """Generate a JSON page of up to ``limit`` events starting at
+        sequence number ``since`` (the oldest available by default)."""
+        first = self.first_seq()
+        if since is None or since < first:
+            since = first
+        end = min(self._next_seq, since + limit)
+        yield '{"first": %d, "next": %d, "events": [' % (first, end)
+        first_row = True
+        for seq in range(since, end):
+            record = self.read(seq)
+            if record is None:
+                continue
+            _, ts, code, zone, value = record
+            if zone == ZONE_NONE:
+                zone = 'null'
+            elif zone == ZONE_LED:
+                zone = '"LED"'
+            row = '{"seq": %d, "ts": %d, "code": %d, "event": "%s", "zone": %s, "value": %d}' % (
+                seq, ts, code, EVENT_NAMES.get(code, 'unknown'), zone, value)
+            yield row if first_row else ', ' + row
+            first_row = False
+        yield ']}'
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'first': self.first_seq(),
+            'next': self._next_seq,
+            'staged': self._staged,
+            'flushes': self.flushes,
+            'dropped': self.dropped,
+        }
+
+    def install(self, app, url='/events'):
+        """Register a route streaming pages of the log (``?since=&limit=``),
+        and ``url/stats``."""
+        @app.route(url)
+        async def events(request):
+            try:
+                since = request.args.get('since')
+                since = int(since) if since is not None else None
+                limit = min(500, int(request.args.get('limit', 100)))
+            except ValueError:
+                return {'error': 'since and limit must be integers'}, 400
+            return self.page(since, limit), 200, {'Content-Type': 'application/json'}
+
+        @app.route(url + '/stats')
+        async def event_stats(request):
+            return self.stats()
+        return events
@@ -1,11 +1,11 @@
 import urequests
-import ujson as json
 
 """
 A forecast analyzer that saves latitude and longitude data to your personal PicoW and
 uses that data to query the NWS weather api for forecasts tomorrow and the next week.
 
-Configs are in ujson because it is more lightweight than yml for the pico W. Make sure to update
+The ZIP code, latitude and longitude are kept in the config store (config_store.py) under
+forecast.zipcode, forecast.latitude and forecast.longitude. Make sure to update
 latitude and longitude when moving, by running set zipcode and set lat and long. Maybe in the future
 I will add a parameter to the initialization of the forecast analyzer to account for moving. 
 
@@ -13,34 +13,31 @@ author: Dylan O'Connor
 """
 
 class ForecastAnalyzer:
-    def __init__(self, config_file):
-        self.config_file = config_file
+    def __init__(self, config):
+        self.config = config # ConfigStore shared with the rest of the firmware
         self._zipcode = None
         self._latitude = None
         self._longitude = None
+        self.on_error = None # optional callback(status_code) run when a request fails, 0 for exceptions
         self.load_config()
 
+    def _report_error(self, status_code):
+        if self.on_error:
+            self.on_error(status_code)
+
     def load_config(self):
-        try:
-            with open(self.config_file, 'r') as file:
-                config = json.load(file)
-                self._zipcode = config.get('zipcode')
-                self._latitude = config.get('latitude')
-                self._longitude = config.get('longitude')
-                print(f"Config loaded: ZIP Code: {self._zipcode}, Latitude: {self._latitude}, Longitude: {self._longitude}")
-        except Exception as e:
-            print(f"Error loading config: {e}")
+        self._zipcode = self.config.get_str('forecast.zipcode')
+        self._latitude = self.config.get_float('forecast.latitude', None)
+        self._longitude = self.config.get_float('forecast.longitude', None)
+        print(f"Config loaded: ZIP Code: {self._zipcode}, Latitude: {self._latitude}, Longitude: {self._longitude}")
 
     def save_config(self):
         try:
-            config = {
-                'zipcode': self._zipcode,
-                'latitude': self._latitude,
-                'longitude': self._longitude
-            }
-            with open(self.config_file, 'w') as file:
-                json.dump(config, file)
-            print(f"Config saved to {self.config_file}")
+            with self.config.batch(): # one flash write, none if nothing changed
+                self.config.set('forecast.zipcode', self._zipcode)
+                self.config.set('forecast.latitude', self._latitude)
+                self.config.set('forecast.longitude', self._longitude)
+            print(f"Config saved to {self.config.path}")
         except Exception as e:
             print(f"Error saving config: {e}")
 
@@ -69,8 +66,10 @@ class ForecastAnalyzer:
                 self.save_config()
             else:
                 print(f"Failed to resolve ZIP code. Status Code: {response.status_code}")
+                self._report_error(response.status_code)
         except Exception as e:
             print(f"Error resolving ZIP code: {e}")
+            self._report_error(0)
 
     def fetch_weather_tomorrow(self):
         if not self._latitude or not self._longitude:
@@ -95,10 +94,13 @@ class ForecastAnalyzer:
                     print(f"Tomorrow's Forecast: {tomorrow_forecast['name']}: {tomorrow_forecast['detailedForecast']}")
                 else:
                     print(f"Failed to fetch forecast details. Status Code: {forecast_response.status_code}")
+                    self._report_error(forecast_response.status_code)
             else:
                 print(f"Failed to fetch weather data. Status Code: {response.status_code}")
+                self._report_error(response.status_code)
         except Exception as e:
             print(f"Error fetching weather data: {e}")
+            self._report_error(0)
 
     # FIX WITH USER AGENT HEADER
     def fetch_weather_next_week(self):
@@ -120,7 +122,10 @@ class ForecastAnalyzer:
                         print(f"{period['name']}: {period['detailedForecast']}")
                 else:
                     print(f"Failed to fetch forecast details. Status Code: {forecast_response.status_code}")
+                    self._report_error(forecast_response.status_code)
             else:
                 print(f"Failed to fetch weather data. Status Code: {response.status_code}")
+                self._report_error(response.status_code)
         except Exception as e:
             print(f"Error fetching weather data: {e}")
+            self._report_error(0)
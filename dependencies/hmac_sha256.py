@@ -0,0 +1,48 @@
+"""
+HMAC-SHA256 (RFC 2104) on top of ``hashlib.sha256``, for MicroPython ports
+that ship without the ``hmac`` module.
+
+Example::
+
+    from hmac_sha256 import hmac_sha256, compare_digest
+
+    signature = hmac_sha256(b'device key', b'message').hex()
+    compare_digest(signature, received_signature)
+"""
+import hashlib
+
+_BLOCK_SIZE = 64
+_INNER_PAD = bytes(b ^ 0x36 for b in range(256))
+_OUTER_PAD = bytes(b ^ 0x5C for b in range(256))
+
+
+def _pad(key, table):
+    return bytes(table[b] for b in key)
+
+
+def hmac_sha256(key, message):
+    """Return the HMAC-SHA256 of ``message`` under ``key`` (both bytes), as
+    32 raw bytes."""
+    if len(key) > _BLOCK_SIZE:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(_BLOCK_SIZE - len(key))
+    inner = hashlib.sha256(_pad(key, _INNER_PAD))
+    inner.update(message)
+    outer = hashlib.sha256(_pad(key, _OUTER_PAD))
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+def compare_digest(a, b):
+    """Compare two digests (str or bytes) in a time that does not depend on
+    where they differ."""
+    if isinstance(a, str):
+        a = a.encode()
+    if isinstance(b, str):
+        b = b.encode()
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= x ^ y
+    return result == 0
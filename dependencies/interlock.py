@@ -0,0 +1,193 @@
+"""
+Maximum-runtime safety interlock for open valves.
+
+Every time a relay turns on it is armed in a hashed timer wheel keyed on its
+activation time plus the zone's maximum runtime. A single asyncio task turns
+the wheel once per tick and switches off any zone whose deadline has passed,
+so a missed ``turn_off_time`` (a late schedule check, a loop stall, a reboot
+in the middle of the window) can never leave a valve open indefinitely. The
+cost of a tick does not depend on the number of zones, only on the entries
+sitting in the current slot, and the task sleeps while no zone is on.
+
+The wheel runs on a monotonic clock built from ``ticks_ms``, so NTP steps of
+the wall clock do not shorten or extend a run. ``ticks_ms`` differences are
+only valid for about 6 days, and the task may sleep for longer than that, so
+the clock restarts from a fresh reading whenever a zone is armed into an
+empty wheel.
+
+Example::
+
+    from interlock import RuntimeInterlock
+
+    interlock = RuntimeInterlock(max_runtime_s=3600)
+    Relay.add_listener(interlock.on_relay_change)
+    asyncio.create_task(interlock.run())
+"""
+import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from utime import time as wall_time # type: ignore
+except ImportError:
+    from time import time as wall_time
+
+
+class RuntimeInterlock:
+    """Turns relays off once they have been on for too long.
+
+    :param max_runtime_s: The default maximum runtime of a zone, in seconds.
+    :param zone_limits: Optional per-zone overrides, keyed by pin tag. The
+                        dictionary is used as given, so limits added to it
+                        later apply too.
+    :param tick_s: The resolution of the timer wheel, in seconds.
+    :param slots: The number of slots in the wheel.
+    :param history: The number of trip events kept for reporting.
+    """
+    def __init__(self, max_runtime_s=3600, zone_limits=None, tick_s=5,
+                 slots=64, history=16):
+        self.max_runtime_s = max_runtime_s
+        self.zone_limits = zone_limits if zone_limits is not None else {}
+        self.tick_s = tick_s
+        self._wheel = [[] for _ in range(slots)]
+        self._deadlines = {} # relay -> deadline tick
+        self._activated = {} # relay -> wall clock activation time
+        self._tick = 0
+        self._elapsed_ms = 0
+        self._last_ticks = ticks_ms()
+        self._armed = asyncio.Event() # lets the task sleep while nothing is on
+
+        self.history = history
+        self.trips = []
+        self.trip_count = 0
+        self.on_trip = None # optional callback(relay, runtime_s) run after a trip
+
+    def limit_for(self, relay):
+        """Return the maximum runtime of ``relay``, in seconds."""
+        return self.zone_limits.get(relay.pinTag(), self.max_runtime_s)
+
+    def _now_tick(self):
+        now = ticks_ms()
+        self._elapsed_ms += ticks_diff(now, self._last_ticks)
+        self._last_ticks = now
+        return self._elapsed_ms // (self.tick_s * 1000)
+
+    def arm(self, relay):
+        """Start the runtime clock for ``relay``. Re-arming a zone that is
+        already armed keeps its original activation time."""
+        if relay in self._deadlines:
+            return
+        # round up, plus one tick for the partial tick already elapsed, so a
+        # zone never trips before its full limit
+        ticks = -(-self.limit_for(relay) // self.tick_s) + 1
+        if not self._deadlines:
+            # nothing read the clock while the wheel was empty: start over
+            # rather than take a difference that may have wrapped around
+            self._last_ticks = ticks_ms()
+            self._tick = self._now_tick()
+        deadline = self._now_tick() + ticks
+        self._deadlines[relay] = deadline
+        self._activated[relay] = wall_time()
+        self._wheel[deadline % len(self._wheel)].append((relay, deadline))
+        self._armed.set()
+
+    def disarm(self, relay):
+        """Stop the runtime clock for ``relay``. The wheel entry is dropped
+        lazily when its slot comes around."""
+        self._deadlines.pop(relay, None)
+        self._activated.pop(relay, None)
+
+    def on_relay_change(self, relay, is_on):
+        """Relay listener; see :meth:`Relay.add_listener`."""
+        if is_on:
+            self.arm(relay)
+        else:
+            self.disarm(relay)
+
+    def advance(self):
+        """Turn the wheel up to the current time, tripping expired zones.
+        Slots skipped during a stall are caught up, visiting each slot at most
+        once."""
+        now = self._now_tick()
+        steps = now - self._tick
+        if steps <= 0:
+            return
+        slots = len(self._wheel)
+        for i in range(1, min(steps, slots) + 1):
+            self._expire_slot((self._tick + i) % slots, now)
+        self._tick = now
+
+    def _expire_slot(self, slot, now):
+        bucket = self._wheel[slot]
+        i = 0
+        while i < len(bucket):
+            relay, deadline = bucket[i]
+            if self._deadlines.get(relay) != deadline:
+                expired = True # stale: disarmed or re-armed since
+            elif deadline <= now:
+                expired = True
+                self._trip(relay)
+            else:
+                expired = False # more than one lap away
+            if expired:
+                bucket[i] = bucket[-1]
+                bucket.pop()
+            else:
+                i += 1
+
+    def _trip(self, relay):
+        activated = self._activated.get(relay, 0)
+        self.disarm(relay)
+        now = wall_time()
+        print(f"Interlock: zone {relay.pinTag()} exceeded its maximum runtime "
+              f"({self.limit_for(relay)} s). Turning it off.")
+        relay.turn_off()
+        self.trip_count += 1
+        self.trips.append({
+            'zone': relay.pinTag(),
+            'activated': activated,
+            'tripped': now,
+            'runtime_s': now - activated,
+        })
+        if len(self.trips) > self.history:
+            self.trips.pop(0)
+        if self.on_trip:
+            self.on_trip(relay, now - activated)
+
+    async def run(self):
+        """The interlock task. Only ticks while at least one zone is armed."""
+        while True:
+            if not self._deadlines:
+                self._armed.clear()
+                await self._armed.wait()
+            await asyncio.sleep(self.tick_s)
+            self.advance()
+
+    def stats(self):
+        now = wall_time()
+        return {
+            'max_runtime_s': self.max_runtime_s,
+            'zone_limits': self.zone_limits,
+            'armed': [{'zone': relay.pinTag(),
+                       'on_for_s': now - activated,
+                       'limit_s': self.limit_for(relay)}
+                      for relay, activated in self._activated.items()],
+            'trip_count': self.trip_count,
+            'trips': list(self.trips), # a copy: stats may be published to another core
+        }
+
+    def install(self, app, url='/interlock'):
+        """Register a route that returns :meth:`stats` as JSON."""
+        @app.route(url)
+        async def interlock(request):
+            return self.stats()
+        return interlock
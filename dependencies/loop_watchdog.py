@@ -0,0 +1,157 @@
+"""
+Event loop stall watchdog backed by the hardware watchdog timer.
+
+A background task wakes up every ``interval_ms`` and measures how late it
+ran. Wakeups later than ``stall_threshold_ms`` are logged and counted as
+stalls. The hardware watchdog (``machine.WDT``) is only fed after a healthy
+wakeup, so if the loop freezes for longer than ``timeout_ms`` the Pico resets,
+and the boot sequence turns every relay off before anything else runs.
+
+Work that runs outside the loop (the schedule engine in dual-core mode) can
+set :attr:`LoopWatchdog.health_check`; the watchdog is then only fed while
+that check passes too.
+
+Known blocking sections (the Wi-Fi connect loop) can call
+:meth:`LoopWatchdog.feed_blocking` to keep the board alive; that time is still
+reported as a stall.
+
+Example::
+
+    from loop_watchdog import LoopWatchdog
+
+    watchdog = LoopWatchdog()
+    watchdog.boot_check(turn_off_all_relays)
+    asyncio.create_task(watchdog.run())
+    watchdog.install(app)
+"""
+import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    import machine
+except ImportError:
+    machine = None
+
+# RP2040 hardware limit for the watchdog timeout
+MAX_WDT_TIMEOUT_MS = 8388
+
+
+class LoopWatchdog:
+    """Measures event loop latency and feeds the hardware watchdog only while
+    the loop is healthy.
+
+    :param timeout_ms: The hardware watchdog timeout.
+    :param interval_ms: How often the loop latency is sampled.
+    :param stall_threshold_ms: Latencies above this count as stalls.
+    :param hardware: Set to ``False`` to only collect statistics.
+    """
+    def __init__(self, timeout_ms=MAX_WDT_TIMEOUT_MS, interval_ms=250,
+                 stall_threshold_ms=1000, hardware=True):
+        self.timeout_ms = min(timeout_ms, MAX_WDT_TIMEOUT_MS)
+        self.interval_ms = interval_ms
+        self.stall_threshold_ms = stall_threshold_ms
+        self.hardware = hardware and machine is not None
+        self._wdt = None
+
+        self.checks = 0
+        self.stalls = 0
+        self.blocking_feeds = 0
+        self.max_latency_ms = 0
+        self.last_latency_ms = 0
+        self.last_stall_ms = 0
+        self.last_stall_ticks = None
+        self.reset_cause = None
+        self.watchdog_reset = False
+        self.on_stall = None # optional callback(latency_ms) run after a stall
+        self.health_check = None # optional callable; False withholds the feed
+        self.failed_checks = 0
+
+    def boot_check(self, turn_off_all_relays):
+        """Call first thing at boot. Records why the board reset and forces
+        every relay off, so a valve that was open when the watchdog fired
+        does not stay open."""
+        if machine is not None:
+            self.reset_cause = machine.reset_cause()
+            self.watchdog_reset = \
+                self.reset_cause == getattr(machine, 'WDT_RESET', -1)
+        if self.watchdog_reset:
+            print("Watchdog reset detected. Forcing all relays off.")
+        turn_off_all_relays()
+
+    def feed(self):
+        if self._wdt is not None:
+            self._wdt.feed()
+
+    def feed_blocking(self):
+        """Feed the hardware watchdog from inside a known blocking call. The
+        loop is not running during that time, so it is still reported as a
+        stall by the next check."""
+        self.blocking_feeds += 1
+        self.feed()
+
+    async def run(self):
+        """The watchdog task. Starts the hardware watchdog on first run; it
+        cannot be stopped afterwards."""
+        if self.hardware and self._wdt is None:
+            self._wdt = machine.WDT(timeout=self.timeout_ms) # type: ignore
+            print(f"Hardware watchdog armed ({self.timeout_ms} ms).")
+        while True:
+            started = ticks_ms()
+            await asyncio.sleep(self.interval_ms / 1000)
+            latency = ticks_diff(ticks_ms(), started) - self.interval_ms
+            if latency < 0:
+                latency = 0
+            self.checks += 1
+            self.last_latency_ms = latency
+            if latency > self.max_latency_ms:
+                self.max_latency_ms = latency
+            if latency > self.stall_threshold_ms:
+                self.stalls += 1
+                self.last_stall_ms = latency
+                self.last_stall_ticks = ticks_ms()
+                print(f"Event loop stalled for {latency} ms.")
+                if self.on_stall:
+                    self.on_stall(latency)
+            elif self.health_check is not None and not self.health_check():
+                self.failed_checks += 1
+            else:
+                self.feed()
+
+    def stats(self):
+        """Return the stall statistics as a dictionary."""
+        last_stall_age_ms = None
+        if self.last_stall_ticks is not None:
+            last_stall_age_ms = ticks_diff(ticks_ms(), self.last_stall_ticks)
+        return {
+            'hardware_watchdog': self._wdt is not None,
+            'timeout_ms': self.timeout_ms,
+            'interval_ms': self.interval_ms,
+            'stall_threshold_ms': self.stall_threshold_ms,
+            'checks': self.checks,
+            'stalls': self.stalls,
+            'blocking_feeds': self.blocking_feeds,
+            'failed_checks': self.failed_checks,
+            'last_latency_ms': self.last_latency_ms,
+            'max_latency_ms': self.max_latency_ms,
+            'last_stall_ms': self.last_stall_ms,
+            'last_stall_age_ms': last_stall_age_ms,
+            'reset_cause': self.reset_cause,
+            'watchdog_reset': self.watchdog_reset,
+        }
+
+    def install(self, app, url='/watchdog'):
+        """Register a route that returns :meth:`stats` as JSON."""
+        @app.route(url)
+        async def watchdog(request):
+            return self.stats()
+        return watchdog
@@ -0,0 +1,232 @@
+"""
+Request metrics for the Microdot web server.
+
+Counts requests per route, status code classes, latency histograms, bytes in
+and out, open connections and heap usage. Every counter lives in an ``array``
+allocated once at startup, so recording a request does not allocate. The
+numbers are served in the Prometheus text format, usually at ``/metrics``.
+
+Example::
+
+    from metrics import Metrics
+
+    metrics = Metrics()
+    metrics.install(app)
+"""
+import gc
+from array import array
+
+from microdot import Response
+
+try:
+    from time import ticks_us, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# route slot used for requests that did not match any route
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+def _mem_free():
+    try:
+        return gc.mem_free() # type: ignore
+    except AttributeError:
+        return 0
+
+
+def _mem_alloc():
+    try:
+        return gc.mem_alloc() # type: ignore
+    except AttributeError:
+        return 0
+
+
+class Metrics:
+    """Fixed-size request metrics store.
+
+    :param max_routes: The number of route slots to preallocate. Routes
+                       registered beyond this limit are counted in the
+                       unmatched slot.
+    """
+    def __init__(self, max_routes=24):
+        self.max_routes = max_routes
+        self._routes = [UNMATCHED_ROUTE]
+        self._route_slots = {UNMATCHED_ROUTE: 0}
+
+        self._bounds = array('L', [b * 1000 for b in LATENCY_BUCKETS_MS])
+        self._nbuckets = len(LATENCY_BUCKETS_MS) + 1 # last one is +Inf
+
+        self.requests = array('L', [0] * max_routes)
+        self.status_classes = array('L', [0] * (5 * max_routes))
+        self.latency = array('L', [0] * (self._nbuckets * max_routes))
+        self.latency_sum_us = array('Q', [0] * max_routes)
+        self.bytes_in = array('Q', [0] * max_routes)
+        self.bytes_out = array('Q', [0] * max_routes)
+
+        self.open_connections = 0
+        self.mem_free = _mem_free()
+        self.mem_alloc = _mem_alloc()
+        self.min_mem_free = self.mem_free
+
+    def install(self, app, url='/metrics'):
+        """Attach this collector to a Microdot application and register the
+        Prometheus endpoint on it."""
+        for _, pattern, _ in app.url_map:
+            self._slot_for(pattern.url_pattern)
+        app.metrics = self
+
+        @app.route(url)
+        async def metrics(request):
+            return self.render(), 200, {
+                'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+        self._slot_for(url)
+        return metrics
+
+    def _slot_for(self, url_pattern):
+        slot = self._route_slots.get(url_pattern)
+        if slot is None:
+            if len(self._routes) >= self.max_routes:
+                return 0
+            slot = len(self._routes)
+            self._routes.append(url_pattern)
+            self._route_slots[url_pattern] = slot
+        return slot
+
+    def connection_opened(self):
+        """Called by Microdot when a connection is accepted."""
+        self.open_connections += 1
+
+    def connection_closed(self):
+        """Called by Microdot when a connection is closed, after its last
+        request (there can be several with keep-alive)."""
+        self.open_connections -= 1
+
+    def request_started(self):
+        """Called by Microdot when a request starts. Returns the start
+        timestamp that must be passed back to :meth:`request_finished`."""
+        return ticks_us()
+
+    def request_finished(self, started, req, res):
+        """Called by Microdot once the response has been written."""
+        elapsed = ticks_diff(ticks_us(), started)
+        route = UNMATCHED_ROUTE
+        if req is not None and req.url_pattern is not None:
+            route = req.url_pattern
+        if res is Response.already_handled:
+            # the handler took over the socket (WebSocket): counted as a 1xx,
+            # but the session length is not a request latency
+            self.observe(route, None, 101,
+                         req.bytes_received if req is not None else 0)
+            return
+        self.observe(route, elapsed, res.status_code,
+                     req.bytes_received if req is not None else 0,
+                     res.bytes_sent)
+
+    def observe(self, route, elapsed_us, status_code=200, bytes_in=0,
+                bytes_out=0):
+        """Record one request-like exchange that did not go through
+        Microdot's request cycle (e.g. a WebSocket message), under its own
+        ``route`` label. An ``elapsed_us`` of ``None`` leaves the latency
+        histogram out."""
+        slot = self._slot_for(route)
+        self.requests[slot] += 1
+
+        status_class = status_code // 100 - 1
+        if 0 <= status_class < 5:
+            self.status_classes[slot * 5 + status_class] += 1
+
+        if elapsed_us is not None:
+            bounds = self._bounds
+            bucket = 0
+            while bucket < len(bounds) and elapsed_us > bounds[bucket]:
+                bucket += 1
+            self.latency[slot * self._nbuckets + bucket] += 1
+            self.latency_sum_us[slot] += elapsed_us
+
+        self.bytes_in[slot] += bytes_in
+        self.bytes_out[slot] += bytes_out
+
+        self.mem_free = _mem_free()
+        self.mem_alloc = _mem_alloc()
+        if self.mem_free < self.min_mem_free:
+            self.min_mem_free = self.mem_free
+
+    def render(self):
+        """Generate the metrics in the Prometheus text exposition format, one
+        line at a time."""
+        yield '# TYPE picosprinkler_http_requests_total counter\n'
+        for slot, route in enumerate(self._routes):
+            if self.requests[slot]:
+                yield 'picosprinkler_http_requests_total{{route="{}"}} {}\n'.format(
+                    _label(route), self.requests[slot])
+
+        yield '# TYPE picosprinkler_http_responses_total counter\n'
+        for slot, route in enumerate(self._routes):
+            for status_class in range(5):
+                count = self.status_classes[slot * 5 + status_class]
+                if count:
+                    yield ('picosprinkler_http_responses_total'
+                           '{{route="{}",code="{}xx"}} {}\n').format(
+                               _label(route), status_class + 1, count)
+
+        yield '# TYPE picosprinkler_http_request_duration_seconds histogram\n'
+        for slot, route in enumerate(self._routes):
+            if not self.requests[slot]:
+                continue
+            label = _label(route)
+            cumulative = 0
+            for bucket in range(self._nbuckets):
+                cumulative += self.latency[slot * self._nbuckets + bucket]
+                if bucket < len(LATENCY_BUCKETS_MS):
+                    le = str(LATENCY_BUCKETS_MS[bucket] / 1000)
+                else:
+                    le = '+Inf'
+                yield ('picosprinkler_http_request_duration_seconds_bucket'
+                       '{{route="{}",le="{}"}} {}\n').format(
+                           label, le, cumulative)
+            yield ('picosprinkler_http_request_duration_seconds_sum'
+                   '{{route="{}"}} {}\n').format(
+                       label, self.latency_sum_us[slot] / 1000000)
+            yield ('picosprinkler_http_request_duration_seconds_count'
+                   '{{route="{}"}} {}\n').format(label, cumulative)
+
+        yield '# TYPE picosprinkler_http_received_bytes_total counter\n'
+        for slot, route in enumerate(self._routes):
+            if self.requests[slot]:
+                yield 'picosprinkler_http_received_bytes_total{{route="{}"}} {}\n'.format(
+                    _label(route), self.bytes_in[slot])
+
+        yield '# TYPE picosprinkler_http_sent_bytes_total counter\n'
+        for slot, route in enumerate(self._routes):
+            if self.requests[slot]:
+                yield 'picosprinkler_http_sent_bytes_total{{route="{}"}} {}\n'.format(
+                    _label(route), self.bytes_out[slot])
+
+        yield '# TYPE picosprinkler_http_open_connections gauge\n'
+        yield 'picosprinkler_http_open_connections {}\n'.format(
+            self.open_connections)
+
+        yield '# TYPE picosprinkler_heap_free_bytes gauge\n'
+        yield 'picosprinkler_heap_free_bytes {}\n'.format(_mem_free())
+        yield '# TYPE picosprinkler_heap_allocated_bytes gauge\n'
+        yield 'picosprinkler_heap_allocated_bytes {}\n'.format(_mem_alloc())
+        yield '# TYPE picosprinkler_heap_free_after_request_bytes gauge\n'
+        yield 'picosprinkler_heap_free_after_request_bytes {}\n'.format(
+            self.mem_free)
+        yield '# TYPE picosprinkler_heap_free_min_bytes gauge\n'
+        yield 'picosprinkler_heap_free_min_bytes {}\n'.format(
+            self.min_mem_free)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
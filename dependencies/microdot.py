@@ -114,10 +114,16 @@ class NoCaseDict(dict):
         >>> print(d)
         {}
     """
+    __slots__ = ('keymap',)
+
     def __init__(self, initial_dict=None):
         super().__init__(initial_dict or {})
         self.keymap = {k.lower(): k for k in self.keys() if k.lower() != k}
 
+    def clear(self):
+        super().clear()
+        self.keymap.clear()
+
     def __setitem__(self, key, value):
         kl = key.lower()
         key = self.keymap.get(kl, key)
@@ -197,6 +203,8 @@ class MultiDict(dict):
         >>> print(d.getlist('sort'))
         ['name', 'email']
     """
+    __slots__ = ()
+
     def __init__(self, initial_dict=None):
         super().__init__()
         if initial_dict:
@@ -294,6 +302,70 @@ class AsyncBytesIO:
         pass
 
 
+class ChunkedReader:
+    """An async stream that decodes a ``Transfer-Encoding: chunked``
+    request body as it is read.
+
+    :param reader: The client stream, positioned at the first chunk.
+    :param limit: The largest body accepted, in bytes. Reading past it raises
+                  ``ValueError``.
+    """
+    def __init__(self, reader, limit):
+        self.reader = reader
+        self.limit = limit
+        self.buffer = b''
+        #: The number of body bytes announced by the chunks read so far.
+        self.received = 0
+        #: ``True`` once the last chunk and the trailers have been read.
+        self.done = False
+
+    async def _next_chunk(self):
+        line = await Request._safe_readline(self.reader)
+        if not line:
+            raise EOFError('connection closed within a chunked body')
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            # optional trailers, up to the blank line ending the body
+            while (await Request._safe_readline(self.reader)).strip():
+                pass
+            self.done = True
+            return b''
+        self.received += size
+        if self.received > self.limit:
+            raise ValueError('payload too large')
+        data = await self.reader.readexactly(size)
+        await self.reader.readexactly(2)  # CRLF closing the chunk
+        return data
+
+    async def fill(self, n):
+        """Decode chunks until ``n`` bytes are buffered or the body ends."""
+        while len(self.buffer) < n and not self.done:
+            self.buffer += await self._next_chunk()
+
+    async def read(self, n=-1):
+        if n < 0:
+            while not self.done:
+                self.buffer += await self._next_chunk()
+            n = len(self.buffer)
+        else:
+            await self.fill(n)
+        data = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return data
+
+    async def readexactly(self, n):
+        data = await self.read(n)
+        if len(data) < n:
+            raise EOFError('chunked body ended early')
+        return data
+
+    async def readline(self):
+        while b'\n' not in self.buffer and not self.done:
+            self.buffer += await self._next_chunk()
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        return await self.read(end)
+
+
 class Request:
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -328,8 +400,27 @@ class Request:
     class G:
         pass
 
+    # requests are recycled by Microdot.handle_request (see
+    # Microdot.pool_size), so they have a fixed set of attributes; the slots
+    # only save RAM on CPython, MicroPython ignores __slots__
+    __slots__ = ('app', 'client_addr', 'method', 'url', 'path',
+                 'query_string', 'args', 'headers', 'cookies',
+                 'content_length', 'content_type', '_g', 'http_version',
+                 '_body', 'body_used', '_stream', 'sock', '_json', '_form',
+                 'after_request_handlers', 'url_pattern', 'url_args',
+                 'bytes_received')
+
     def __init__(self, app, client_addr, method, url, http_version, headers,
                  body=None, stream=None, sock=None):
+        self.args = MultiDict()
+        self.cookies = {}
+        self.after_request_handlers = []
+        self._reset(app, client_addr, method, url, http_version, headers,
+                    body, stream, sock)
+
+    def _reset(self, app, client_addr, method, url, http_version, headers,
+               body=None, stream=None, sock=None):
+        """(Re)initialize the request, reusing its containers."""
         #: The application instance to which this request belongs.
         self.app = app
         #: The address of the client, as a tuple (host, port).
@@ -344,23 +435,21 @@ class Request:
         self.query_string = None
         #: The parsed query string, as a
         #: :class:`MultiDict <microdot.MultiDict>` object.
-        self.args = {}
+        self.args.clear()
         #: A dictionary with the headers included in the request.
         self.headers = headers
         #: A dictionary with the cookies included in the request.
-        self.cookies = {}
+        self.cookies.clear()
         #: The parsed ``Content-Length`` header.
         self.content_length = 0
         #: The parsed ``Content-Type`` header.
         self.content_type = None
-        #: A general purpose container for applications to store data during
-        #: the life of the request.
-        self.g = Request.G()
+        self._g = None
 
         self.http_version = http_version
         if '?' in self.path:
             self.path, self.query_string = self.path.split('?', 1)
-            self.args = self._parse_urlencoded(self.query_string)
+            self._parse_urlencoded(self.query_string, self.args)
 
         if 'Content-Length' in self.headers:
             self.content_length = int(self.headers['Content-Length'])
@@ -377,10 +466,47 @@ class Request:
         self.sock = sock
         self._json = None
         self._form = None
-        self.after_request_handlers = []
+        del self.after_request_handlers[:]
+        #: The URL pattern of the route that matched this request, or
+        #: ``None`` if no route matched.
+        self.url_pattern = None
+        self.url_args = None
+        #: The number of bytes read from the client for this request.
+        self.bytes_received = 0
+
+    def _release(self):
+        """Drop the references held by a finished request before it is
+        pooled."""
+        self.headers.clear()
+        self._body = None
+        self._stream = None
+        self.sock = None
+        self._json = None
+        self._form = None
+        self._g = None
+        self.url_args = None
+
+    def _body_consumed(self):
+        """Return ``True`` if no part of the body is left unread on the
+        connection, so that another request can follow on it."""
+        stream = self._stream
+        if stream is None or isinstance(stream, AsyncBytesIO):
+            return True
+        if isinstance(stream, ChunkedReader):
+            return stream.done
+        return self.content_length == 0
+
+    @property
+    def g(self):
+        """A general purpose container for applications to store data
+        during the life of the request. Created on first use."""
+        if self._g is None:
+            self._g = Request.G()
+        return self._g
 
     @staticmethod
-    async def create(app, client_reader, client_writer, client_addr):
+    async def create(app, client_reader, client_writer, client_addr,
+                     request_line=None):
         """Create a request object.
 
         :param app: The Microdot application instance.
@@ -389,23 +515,30 @@ class Request:
         :param client_writer: An output stream where the response data can be
                               written.
         :param client_addr: The address of the client, as a tuple.
+        :param request_line: The request line, if the caller already read it
+                             from ``client_reader``.
 
         This method is a coroutine. It returns a newly created ``Request``
         object.
         """
         # request line
-        line = (await Request._safe_readline(client_reader)).strip().decode()
+        line = request_line if request_line is not None else \
+            await Request._safe_readline(client_reader)
+        received = len(line)
+        line = line.strip().decode()
         if not line:  # pragma: no cover
             return None
         method, url, http_version = line.split()
         http_version = http_version.split('/', 1)[1]
 
         # headers
-        headers = NoCaseDict()
+        req = app._acquire_request() if app is not None else None
+        headers = req.headers if req is not None else NoCaseDict()
         content_length = 0
         while True:
-            line = (await Request._safe_readline(
-                client_reader)).strip().decode()
+            line = await Request._safe_readline(client_reader)
+            received += len(line)
+            line = line.strip().decode()
             if line == '':
                 break
             header, value = line.split(':', 1)
@@ -416,19 +549,49 @@ class Request:
 
         # body
         body = b''
-        if content_length and content_length <= Request.max_body_length:
+        chunked = None
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            # a body that fits in max_body_length is decoded into body; a
+            # longer one is left for the handler to read from the stream
+            chunked = ChunkedReader(client_reader, Request.max_content_length)
+            try:
+                await chunked.fill(Request.max_body_length + 1)
+            except ValueError:
+                if chunked.received <= Request.max_content_length:
+                    raise
+                # too large: rejected with a 413 by dispatch_request
+            if chunked.done:
+                body = chunked.buffer
+                received += len(body)
+                stream = None
+            else:
+                stream = chunked
+        elif content_length and content_length <= Request.max_body_length:
             body = await client_reader.readexactly(content_length)
+            received += len(body)
             stream = None
         else:
             body = b''
             stream = client_reader
 
-        return Request(app, client_addr, method, url, http_version, headers,
+        if req is not None:
+            req._reset(app, client_addr, method, url, http_version, headers,
                        body=body, stream=stream,
                        sock=(client_reader, client_writer))
-
-    def _parse_urlencoded(self, urlencoded):
-        data = MultiDict()
+        else:
+            req = Request(app, client_addr, method, url, http_version,
+                          headers, body=body, stream=stream,
+                          sock=(client_reader, client_writer))
+        if chunked is not None:
+            # no Content-Length: count what was decoded, so that the
+            # max_content_length check still applies
+            req.content_length = chunked.received
+        req.bytes_received = received
+        return req
+
+    def _parse_urlencoded(self, urlencoded, data=None):
+        if data is None:
+            data = MultiDict()
         if len(urlencoded) > 0:  # pragma: no branch
             if isinstance(urlencoded, str):
                 for kv in [pair.split('=', 1)
@@ -554,15 +717,34 @@ class Response:
     #: written to the client. Used to exit WebSocket connections cleanly.
     already_handled = None
 
+    # responses created by Microdot itself are recycled (see
+    # Microdot.pool_size), so they have a fixed set of attributes (slots
+    # only matter on CPython, see Request)
+    __slots__ = ('status_code', 'headers', 'reason', 'data', 'body',
+                 'is_head', 'http_version', 'bytes_sent', '_pooled')
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
+        self.headers = NoCaseDict()
+        self._pooled = False
+        self._reset(body, status_code, headers, reason)
+
+    def _reset(self, body='', status_code=200, headers=None, reason=None):
+        """(Re)initialize the response, reusing its headers dictionary."""
         if body is None and status_code == 200:
             body = ''
             status_code = 204
         self.status_code = status_code
-        self.headers = NoCaseDict(headers or {})
+        self.headers.clear()
+        if headers:
+            self.headers.update(headers)
         self.reason = reason
+        #: The dictionary or list of a JSON response. It is encoded when the
+        #: response is written, so an after request handler can still pick
+        #: another encoding.
+        self.data = None
         if isinstance(body, (dict, list)):
-            self.body = json.dumps(body).encode()
+            self.data = body
+            self.body = b''
             self.headers['Content-Type'] = 'application/json; charset=UTF-8'
         elif isinstance(body, str):
             self.body = body.encode()
@@ -570,10 +752,16 @@ class Response:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        #: The HTTP version of the response, set to the request's by
+        #: Microdot. Streamed bodies are sent chunked to HTTP/1.1 clients.
+        self.http_version = '1.0'
+        #: The number of bytes written to the client, updated by
+        #: :meth:`write`.
+        self.bytes_sent = 0
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False,
-                   partitioned=False):
+                   partitioned=False, same_site=None):
         """Add a cookie to the response.
 
         :param cookie: The cookie's name.
@@ -586,6 +774,8 @@ class Response:
         :param secure: The cookie's ``secure`` flag.
         :param http_only: The cookie's ``HttpOnly`` flag.
         :param partitioned: Whether the cookie is partitioned.
+        :param same_site: The cookie's ``SameSite`` value (``'Strict'``,
+                          ``'Lax'`` or ``'None'``), or ``None`` to omit it.
         """
         http_cookie = '{cookie}={value}'.format(cookie=cookie, value=value)
         if path:
@@ -606,6 +796,8 @@ class Response:
             http_cookie += '; HttpOnly'
         if partitioned:
             http_cookie += '; Partitioned'
+        if same_site:
+            http_cookie += '; SameSite=' + same_site
         if 'Set-Cookie' in self.headers:
             self.headers['Set-Cookie'].append(http_cookie)
         else:
@@ -622,9 +814,17 @@ class Response:
                         max_age=0, **kwargs)
 
     def complete(self):
-        if isinstance(self.body, bytes) and \
-                'Content-Length' not in self.headers:
-            self.headers['Content-Length'] = str(len(self.body))
+        if self.data is not None:
+            self.body = json.dumps(self.data).encode()
+            self.data = None
+        if 'Content-Length' not in self.headers:
+            if isinstance(self.body, bytes):
+                self.headers['Content-Length'] = str(len(self.body))
+            elif self.http_version == '1.1' and \
+                    self.status_code not in (204, 304):
+                # a stream of unknown length: frame it, so the connection
+                # does not have to close to mark its end
+                self.headers['Transfer-Encoding'] = 'chunked'
         if 'Content-Type' not in self.headers:
             self.headers['Content-Type'] = self.default_content_type
             if 'charset=' not in self.headers['Content-Type']:
@@ -637,25 +837,38 @@ class Response:
             # status code
             reason = self.reason if self.reason is not None else \
                 ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
+            line = 'HTTP/{version} {status_code} {reason}\r\n'.format(
+                version=self.http_version, status_code=self.status_code,
+                reason=reason).encode()
+            await stream.awrite(line)
+            self.bytes_sent += len(line)
 
             # headers
             for header, value in self.headers.items():
                 values = value if isinstance(value, list) else [value]
                 for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
-                        header=header, value=value).encode())
+                    line = '{header}: {value}\r\n'.format(
+                        header=header, value=value).encode()
+                    await stream.awrite(line)
+                    self.bytes_sent += len(line)
             await stream.awrite(b'\r\n')
+            self.bytes_sent += 2
 
             # body
             if not self.is_head:
+                chunked = self.headers.get('Transfer-Encoding') == 'chunked'
                 iter = self.body_iter()
                 async for body in iter: # type: ignore
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
+                    if chunked:
+                        if not body:
+                            continue  # an empty chunk would end the body
+                        body = '{:x}\r\n'.format(len(body)).encode() + \
+                            body + b'\r\n'
                     try:
                         await stream.awrite(body)
+                        self.bytes_sent += len(body)
                     except OSError as exc:  # pragma: no cover
                         if exc.errno in MUTED_SOCKET_ERRORS or \
                                 exc.args[0] == 'Connection lost':
@@ -664,6 +877,9 @@ class Response:
                         raise
                 if hasattr(iter, 'aclose'):  # pragma: no branch
                     await iter.aclose() # type: ignore
+                if chunked:
+                    await stream.awrite(b'0\r\n\r\n')
+                    self.bytes_sent += 5
 
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS or \
@@ -925,6 +1141,27 @@ class Microdot:
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
+        #: An optional metrics collector. When set, it is notified when a
+        #: connection opens and closes, and at the start and end of every
+        #: request. See the ``metrics`` module.
+        self.metrics = None
+        #: The number of finished ``Request`` and ``Response`` objects kept
+        #: for reuse, so a request does not allocate them (and their header
+        #: dictionaries) again. Handlers must not keep a reference to the
+        #: request or a response built by Microdot after returning. Set to
+        #: 0 to disable pooling.
+        self.pool_size = 4
+        #: How long, in seconds, an idle HTTP/1.1 connection is kept open
+        #: waiting for the next request. Set to 0 to close every connection
+        #: after one response.
+        self.keep_alive_timeout = 5
+        #: The number of requests served on one connection before it is
+        #: closed.
+        self.max_keep_alive_requests = 100
+        self._request_pool = []
+        self._response_pool = []
+        self.pool_hits = 0
+        self.pool_misses = 0
 
     def route(self, url_pattern, methods=None):
         """Decorator that is used to register a function as a request handler
@@ -1311,6 +1548,7 @@ class Microdot:
             if req.url_args is not None:
                 if method in route_methods:
                     f = route_handler
+                    req.url_pattern = route_pattern.url_pattern
                     break
                 else:
                     f = 405
@@ -1327,16 +1565,51 @@ class Microdot:
         return {'Allow': ', '.join(allow)}
 
     async def handle_request(self, reader, writer):
-        req = None
-        try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
-        if res != Response.already_handled:  # pragma: no branch
-            await res.write(writer)
+        client_addr = writer.get_extra_info('peername')
+        request_line = None
+        served = 0
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        while True:
+            metrics = self.metrics
+            if metrics is not None:
+                started = metrics.request_started()
+            req = None
+            try:
+                req = await Request.create(self, reader, writer, client_addr,
+                                           request_line)
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+
+            res = await self.dispatch_request(req)
+            served += 1
+            keep_alive = self._keep_alive(req, res, served)
+            if res != Response.already_handled:  # pragma: no branch
+                if req is not None:
+                    res.http_version = req.http_version
+                    if not keep_alive and req.http_version == '1.1':
+                        res.headers['Connection'] = 'close'
+                await res.write(writer)
+            if metrics is not None:
+                metrics.request_finished(started, req, res)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            self._release(req, res)
+            if not keep_alive:
+                break
+
+            # wait for the next request on the same connection
+            try:
+                request_line = await asyncio.wait_for(
+                    Request._safe_readline(reader), self.keep_alive_timeout)
+            except (asyncio.TimeoutError, OSError, ValueError):
+                break
+            if not request_line.strip():
+                break
+        if self.metrics is not None:
+            self.metrics.connection_closed()
         try:
             await writer.aclose()
         except OSError as exc:  # pragma: no cover
@@ -1344,10 +1617,47 @@ class Microdot:
                 pass
             else:
                 raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    def _keep_alive(self, req, res, served):
+        """Return ``True`` if the connection can stay open for another
+        request after ``res``. Only HTTP/1.1 connections are kept."""
+        if req is None or res == Response.already_handled or \
+                not self.keep_alive_timeout or self.shutdown_requested or \
+                served >= self.max_keep_alive_requests:
+            return False
+        if req.http_version != '1.1' or not req._body_consumed():
+            return False
+        return 'close' not in req.headers.get('Connection', '').lower() and \
+            'close' not in res.headers.get('Connection', '').lower()
+
+    def _acquire_request(self):
+        """Return a pooled request to reinitialize, or ``None``."""
+        if self._request_pool:
+            self.pool_hits += 1
+            return self._request_pool.pop()
+        self.pool_misses += 1
+        return None
+
+    def _response(self, body='', status_code=200, headers=None, reason=None):
+        """Return a response, recycled from the pool when possible."""
+        if self._response_pool:
+            res = self._response_pool.pop()
+            res._reset(body, status_code, headers, reason)
+        else:
+            res = Response(body, status_code, headers, reason)
+            res._pooled = True
+        return res
+
+    def _release(self, req, res):
+        """Return a finished request and response to the pools."""
+        if req is not None and len(self._request_pool) < self.pool_size:
+            req._release()
+            self._request_pool.append(req)
+        if res is not None and res._pooled and \
+                len(self._response_pool) < self.pool_size:
+            res.body = None
+            res.data = None
+            self._response_pool.append(res)
 
     async def dispatch_request(self, req):
         after_request_handled = False
@@ -1382,9 +1692,9 @@ class Microdot:
                             else:
                                 status_code = 200
                                 headers = res[1]
-                            res = Response(body, status_code, headers)
+                            res = self._response(body, status_code, headers)
                         elif not isinstance(res, Response):
-                            res = Response(res)
+                            res = self._response(res)
                         for handler in self.after_request_handlers:
                             res = await invoke_handler(
                                 handler, req, res) or res
@@ -1393,14 +1703,15 @@ class Microdot:
                                 handler, req, res) or res
                         after_request_handled = True
                     elif isinstance(f, dict):
-                        res = Response(headers=f)
+                        res = self._response(headers=f)
                     elif f in self.error_handlers:
                         res = await invoke_handler(self.error_handlers[f], req)
                     else:
                         res = 'Not found', f
                 except HTTPException as exc:
                     if exc.status_code in self.error_handlers:
-                        res = self.error_handlers[exc.status_code](req)
+                        res = await invoke_handler(
+                            self.error_handlers[exc.status_code], req)
                     else:
                         res = exc.reason, exc.status_code
                 except Exception as exc:
@@ -1432,9 +1743,9 @@ class Microdot:
             else:
                 res = 'Bad request', 400
         if isinstance(res, tuple):
-            res = Response(*res) # type: ignore
+            res = self._response(*res) # type: ignore
         elif not isinstance(res, Response):
-            res = Response(res)
+            res = self._response(res)
         if not after_request_handled:
             for handler in self.after_error_request_handlers:
                 res = await invoke_handler(
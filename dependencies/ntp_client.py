@@ -0,0 +1,279 @@
+"""
+Periodic NTP synchronization that never blocks the event loop.
+
+``ntptime.settime()`` waits on a blocking socket and is a one-shot. This client
+sends SNTP requests over a non-blocking UDP socket and polls for the reply
+with ``asyncio.sleep``, so the web server and schedules keep running while a
+server is slow to answer.
+
+The RTC only counts whole seconds, so the client first waits for it to tick
+over and notes ``ticks_ms`` at that moment; the offset is then measured to
+the millisecond from that anchor and the monotonic round trip. Corrections
+are applied at the right moment within the second, so the clock moves by
+exactly the intended amount. Offsets of at least ``step_threshold_s`` are
+stepped at once and ``on_step`` is called so the scheduler can reconcile the
+zones; smaller ones are stepped one second at most per minute, so the clock
+never jumps by more than a second.
+
+With millisecond offsets the RTC drift between syncs can be estimated, and
+the sync interval is adapted to it: a stable clock is checked rarely, a
+drifting one more often.
+
+Name resolution (``getaddrinfo``) is blocking on MicroPython, so the server
+address is resolved once and cached until a request to it fails.
+
+Example::
+
+    from ntp_client import NTPClient
+
+    ntp = NTPClient(on_step=reconciler.notify_clock_step)
+    asyncio.create_task(ntp.run())
+"""
+import asyncio
+import socket
+import struct
+import time
+
+try:
+    import machine
+except ImportError:
+    machine = None
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    # some MicroPython ports count seconds from 2000-01-01 instead of 1970
+    _EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+except (AttributeError, OverflowError):
+    _EPOCH_OFFSET = 0
+
+# seconds between the NTP epoch (1900) and the platform epoch
+NTP_DELTA = 2208988800 + _EPOCH_OFFSET
+
+# how far apart the gradual (at most one second) corrections are
+CORRECTION_PERIOD_S = 60
+# pending corrections smaller than this are dropped
+MIN_CORRECTION_S = 0.02
+
+
+def _set_rtc(utc):
+    tm = time.gmtime(utc)
+    machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], # type: ignore
+                            tm[5], 0))
+
+
+class NTPClient:
+    """Keeps the RTC in sync with an NTP server.
+
+    :param host: The NTP server.
+    :param min_interval_s: The shortest interval between syncs.
+    :param max_interval_s: The longest interval between syncs.
+    :param step_threshold_s: Offsets at least this large are stepped at once
+                             instead of one second a minute.
+    :param max_error_s: The clock error the interval adaptation aims to stay
+                        under between syncs.
+    :param on_step: Called with the step in seconds after the clock is
+                    stepped.
+    :param set_clock: Called with the new time to step the clock. Defaults to
+                      setting ``machine.RTC``; does nothing off-device.
+    """
+    def __init__(self, host='pool.ntp.org', min_interval_s=900,
+                 max_interval_s=86400, step_threshold_s=5, max_error_s=1,
+                 timeout_s=2, on_step=None, set_clock=None):
+        self.host = host
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.step_threshold_s = step_threshold_s
+        self.max_error_s = max_error_s
+        self.timeout_s = timeout_s
+        self.on_step = on_step
+        if set_clock is None and machine is not None:
+            set_clock = _set_rtc
+        self.set_clock = set_clock
+
+        self.interval_s = min_interval_s
+        self._retry_s = 30
+        self._addr = None
+        self._pending_s = 0 # correction still to apply, in seconds
+        self._last_sync_ticks = None
+        self._last_offset = 0
+
+        self.syncs = 0
+        self.failures = 0
+        self.steps = 0
+        self.last_offset_s = None
+        self.last_rtt_ms = None
+        self.drift_ppm = None
+        self.last_sync = None
+
+    def _resolve(self):
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.host, 123)[0][-1]
+        return self._addr
+
+    async def _second_edge(self):
+        """Wait until the clock ticks over to a new second. Returns that
+        second and ``ticks_ms()`` at the moment it was seen."""
+        second = int(time.time())
+        while int(time.time()) == second:
+            await asyncio.sleep(0.005)
+        return int(time.time()), ticks_ms()
+
+    async def query(self):
+        """Ask the server for the time. Returns ``(offset_s, rtt_ms)``, where
+        ``offset_s`` is what must be added to the local clock."""
+        addr = self._resolve()
+        request = bytearray(48)
+        request[0] = 0x1B # LI 0, version 3, mode 3 (client)
+        edge, edge_ticks = await self._second_edge()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sent = ticks_ms()
+            # the local time to the millisecond: the second that just started
+            # plus the monotonic time since it started
+            local_send = edge + ticks_diff(sent, edge_ticks) / 1000
+            struct.pack_into('!I', request, 40, (int(local_send) + NTP_DELTA) & 0xFFFFFFFF)
+            sock.sendto(request, addr)
+            while True:
+                try:
+                    reply = sock.recv(48)
+                    break
+                except OSError:
+                    if ticks_diff(ticks_ms(), sent) > self.timeout_s * 1000:
+                        self._addr = None # re-resolve on the next attempt
+                        raise OSError('NTP request timed out')
+                    await asyncio.sleep(0.02)
+            rtt = ticks_diff(ticks_ms(), sent)
+        finally:
+            sock.close()
+
+        if len(reply) < 48 or reply[0] & 0x07 != 4 or reply[1] == 0:
+            raise ValueError('invalid NTP reply')
+        if reply[24:28] != request[40:44]:
+            raise ValueError('NTP reply does not match request')
+        seconds, fraction = struct.unpack_from('!II', reply, 40)
+        server = seconds - NTP_DELTA + fraction / 4294967296
+        local_receive = local_send + rtt / 1000
+        offset = server + rtt / 2000 - local_receive
+        return offset, rtt
+
+    async def sync(self):
+        """Query the server once and correct the clock."""
+        offset, rtt = await self.query()
+        now_ticks = ticks_ms()
+        self.syncs += 1
+        self.last_offset_s = offset
+        self.last_rtt_ms = rtt
+        self.last_sync = int(time.time())
+
+        if abs(offset) >= self.step_threshold_s:
+            await self._step(offset)
+            self._last_sync_ticks = None # drift can't be estimated across a step
+            return offset
+
+        if self._last_sync_ticks is not None:
+            elapsed = ticks_diff(now_ticks, self._last_sync_ticks) / 1000
+            if elapsed > 0:
+                # the error that built up since the previous sync, not
+                # counting corrections still pending from it
+                error = offset - self._pending_s
+                self.drift_ppm = error / elapsed * 1000000
+                self._adapt_interval()
+        self._last_sync_ticks = now_ticks
+        self._pending_s = offset if abs(offset) >= MIN_CORRECTION_S else 0
+        return offset
+
+    async def _adjust(self, delta):
+        """Move the clock by ``delta`` seconds. The RTC can only be set to a
+        whole second, so it is set when the corrected time reaches one."""
+        edge, edge_ticks = await self._second_edge()
+        target = edge + delta # what the clock should have read at the edge
+        whole = int(target)
+        if whole < target:
+            whole += 1
+        wait_ms = (whole - target) * 1000 - ticks_diff(ticks_ms(), edge_ticks)
+        if wait_ms > 0:
+            await asyncio.sleep(wait_ms / 1000)
+        if self.set_clock is not None:
+            self.set_clock(whole)
+
+    async def _step(self, offset):
+        step = int(round(offset))
+        print(f"NTP: stepping clock by {offset:.3f} s.")
+        await self._adjust(offset)
+        self._pending_s = 0
+        self.steps += 1
+        if self.on_step is not None:
+            self.on_step(step)
+
+    async def _correct_once(self):
+        """Apply up to one second of the pending correction."""
+        delta = max(-1, min(1, self._pending_s))
+        await self._adjust(delta)
+        self._pending_s -= delta
+        if abs(self._pending_s) < MIN_CORRECTION_S:
+            self._pending_s = 0
+
+    def _adapt_interval(self):
+        drift = abs(self.drift_ppm) / 1000000 # type: ignore
+        if drift > 0:
+            interval = self.max_error_s / drift
+        else:
+            interval = self.max_interval_s
+        self.interval_s = int(max(self.min_interval_s,
+                                  min(self.max_interval_s, interval)))
+
+    async def _wait(self, seconds):
+        while seconds > 0:
+            if self._pending_s:
+                step = min(CORRECTION_PERIOD_S, seconds)
+                await asyncio.sleep(step)
+                await self._correct_once()
+            else:
+                step = seconds
+                await asyncio.sleep(step)
+            seconds -= step
+
+    async def run(self):
+        """The synchronization task."""
+        while True:
+            try:
+                offset = await self.sync()
+                print(f"NTP: offset {offset:.3f} s, next sync in {self.interval_s} s.")
+                self._retry_s = 30
+                delay = self.interval_s
+            except Exception as e:
+                self.failures += 1
+                print(f"Failed to sync time: {e}")
+                delay = self._retry_s
+                self._retry_s = min(self._retry_s * 2, self.min_interval_s)
+            await self._wait(delay)
+
+    def stats(self):
+        return {
+            'host': self.host,
+            'syncs': self.syncs,
+            'failures': self.failures,
+            'steps': self.steps,
+            'last_sync': self.last_sync,
+            'last_offset_s': self.last_offset_s,
+            'last_rtt_ms': self.last_rtt_ms,
+            'pending_correction_s': self._pending_s,
+            'drift_ppm': self.drift_ppm,
+            'interval_s': self.interval_s,
+        }
+
+    def install(self, app, url='/ntp'):
+        """Register a route that returns :meth:`stats` as JSON."""
+        @app.route(url)
+        async def ntp(request):
+            return self.stats()
+        return ntp
@@ -0,0 +1,448 @@
+"""
+Over-the-air code updates into A/B slots.
+
+The application code lives in one of two slot directories on flash
+(``slot_a`` and ``slot_b``); a small pointer file, ``ota.json``, names the
+active one. ``main.py`` calls :func:`activate` before importing anything
+else, which puts the active slot (and its ``dependencies`` folder) first on
+``sys.path``. Without a pointer file nothing changes and the code is run
+from the root, as when it is uploaded by hand.
+
+An update is an uncompressed tar (ustar) bundle of the code files, laid out
+as in the repository (``web_server.py``, ``dependencies/...``,
+``www/...``). ``POST /ota`` reads it from ``Request.stream`` and writes it
+into the inactive slot ``chunk_size`` bytes at a time, computing its
+SHA-256 digest on the way, so the bundle is never held in RAM. The client
+sends the digest in ``X-OTA-SHA256``, a bundle version in ``X-OTA-Version``
+and an HMAC-SHA256 of ``<hex digest>.<version>``, under the device key, in
+``X-OTA-Signature``; the signature is checked before anything is written and
+the digest once the last byte is in. Only then is the slot marked pending.
+The version must be higher than that of every bundle staged before (the
+push tool uses the current time), so a captured upload of older code can't
+be replayed to downgrade the device.
+
+At the next boot :func:`activate` swaps the pointer (a temporary file
+renamed over the old one, so a power cut leaves either the old or the new
+pointer) and boots the new slot on trial. The application runs
+:meth:`OTAUpdater.confirm_when_up`, which confirms the slot once the web
+server has been up for ``confirm_after_s`` seconds and has served a request;
+a trial slot that never got there (crash, watchdog reset, no network) is
+rolled back at the following boot.
+
+``main.py`` and ``ota.py`` stay at the root, outside the slots.
+
+Example::
+
+    # main.py
+    import ota
+    ota.activate()
+    import web_server
+
+    # web_server.py
+    updater = OTAUpdater(key=ota.load_key('ota.key'))
+    updater.install(app) # POST /ota to upload, GET /ota for the state
+    asyncio.create_task(updater.confirm_when_up()) # the running slot works
+"""
+import asyncio
+import binascii
+import hashlib
+import json
+import os
+import sys
+
+from hmac_sha256 import hmac_sha256, compare_digest
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+STATE_FILE = 'ota.json'
+SLOTS = ('slot_a', 'slot_b')
+
+_BLOCK = 512
+_EMPTY_BLOCK = bytes(_BLOCK)
+_REGULAR = (b'0', b'\0')
+_DIRECTORY = b'5'
+_DIR_MODE = 0x4000
+
+# the slot booted by activate(), or None when running from the root
+_active = None
+
+
+def _hex(digest):
+    return binascii.hexlify(digest).decode()
+
+
+def _is_dir(path):
+    try:
+        return os.stat(path)[0] & _DIR_MODE != 0
+    except OSError:
+        return False
+
+
+def _makedirs(path):
+    current = ''
+    for part in path.split('/'):
+        current = current + '/' + part if current else part
+        if not _is_dir(current):
+            os.mkdir(current)
+
+
+def _rmtree(path):
+    if not _is_dir(path):
+        return
+    for name in os.listdir(path):
+        child = path + '/' + name
+        if _is_dir(child):
+            _rmtree(child)
+        else:
+            os.remove(child)
+    os.rmdir(path)
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path, state):
+    """Replace the pointer file atomically: write a copy, then rename it."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def load_key(path):
+    """Return the device key stored in ``path`` as bytes, or ``None`` if
+    there is none (uploads are then refused)."""
+    try:
+        with open(path, 'rb') as f:
+            key = f.read().strip()
+    except OSError:
+        return None
+    return key or None
+
+
+def activate(state_file=STATE_FILE):
+    """Select the code slot to boot and put it first on ``sys.path``.
+    Call it from ``main.py`` before importing the application. Returns the
+    slot, or ``None`` to run the code at the root."""
+    global _active
+    state = _load_state(state_file)
+    if state is None:
+        return None
+    if state.get('trial'):
+        # the slot booted on trial never confirmed: go back to the old one
+        print(f"OTA: {state['active']} was not confirmed, rolling back.")
+        state['failed'] = state['active']
+        state['active'] = state.get('previous')
+        state['previous'] = None
+        state['trial'] = False
+        _save_state(state_file, state)
+    elif state.get('pending'):
+        state['previous'] = state.get('active')
+        state['active'] = state['pending']
+        state['pending'] = None
+        state['trial'] = True
+        state['failed'] = None
+        _save_state(state_file, state)
+        print(f"OTA: booting {state['active']} on trial.")
+    slot = state.get('active')
+    if not slot or not _is_dir(slot):
+        return None
+    sys.path.insert(0, slot + '/dependencies')
+    sys.path.insert(0, slot)
+    _active = slot
+    return slot
+
+
+def slot_path(path):
+    """Return ``path`` (relative to the code root) inside the active slot."""
+    return _active + '/' + path if _active else path
+
+
+class UploadRejected(Exception):
+    """The upload is not signed with the device key."""
+
+
+class _HashingReader:
+    """Reads at most ``length`` bytes (``None``: up to the end of the stream)
+    from ``stream``, feeding everything read to a SHA-256 digest."""
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+        self.sha256 = hashlib.sha256()
+        self.received = 0
+
+    async def read(self, n):
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+            if n <= 0:
+                return b''
+        data = await self.stream.read(n)
+        if data:
+            self.sha256.update(data)
+            self.received += len(data)
+            if self.remaining is not None:
+                self.remaining -= len(data)
+        return data
+
+    async def readexactly(self, n):
+        data = await self.read(n)
+        while len(data) < n:
+            more = await self.read(n - len(data))
+            if not more:
+                raise ValueError('bundle truncated')
+            data += more
+        return data
+
+    async def drain(self, chunk_size):
+        while await self.read(chunk_size):
+            pass
+
+
+def _parse_header(header):
+    """Return ``(name, size, type)`` from a tar header block."""
+    checksum = int(header[148:156].rstrip(b'\0 ').strip() or b'0', 8)
+    if sum(header[:148]) + 8 * 32 + sum(header[156:]) != checksum:
+        raise ValueError('bad tar header checksum')
+    name = header[:100].split(b'\0', 1)[0]
+    if header[257:262] == b'ustar':
+        prefix = header[345:500].split(b'\0', 1)[0]
+        if prefix:
+            name = prefix + b'/' + name
+    size = int(header[124:136].rstrip(b'\0 ').strip() or b'0', 8)
+    name = name.decode()
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.rstrip('/')
+    if name.startswith('/') or '..' in name.split('/'):
+        raise ValueError(f'unsafe path in bundle: {name}')
+    return name, size, header[156:157]
+
+
+class OTAUpdater:
+    """Receives code bundles into the inactive slot.
+
+    :param key: The device key (bytes) uploads must be signed with, or
+                ``None`` to refuse all uploads.
+    :param state_file: The slot pointer file.
+    :param slots: The two slot directories.
+    :param chunk_size: The size of the pieces read and written to flash, a
+                       multiple of 512.
+    :param max_bundle: The largest bundle accepted, in bytes.
+    :param confirm_after_s: How long the server must have been up before
+                            :meth:`confirm_when_up` keeps a trial slot.
+    """
+    def __init__(self, key=None, state_file=STATE_FILE, slots=SLOTS,
+                 chunk_size=1024, max_bundle=512 * 1024, confirm_after_s=60):
+        self.key = key
+        self.state_file = state_file
+        self.slots = slots
+        self.chunk_size = chunk_size
+        self.max_bundle = max_bundle
+        self.confirm_after_s = confirm_after_s
+        self._busy = False
+        self._served = 0 # requests answered since boot, for confirm_when_up()
+        #: Called before the board resets after an upload with
+        #: ``?reboot=1``, to turn the zones off and flush what is in RAM.
+        self.on_reboot = None
+
+        self.updates = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_bytes = 0
+        self.last_files = 0
+        self.last_ms = 0
+
+    def state(self):
+        return _load_state(self.state_file) or {
+            'active': None, 'previous': None, 'pending': None,
+            'trial': False, 'failed': None, 'version': 0}
+
+    def _inactive(self, state):
+        return self.slots[1] if state.get('active') == self.slots[0] \
+            else self.slots[0]
+
+    def confirm(self):
+        """Mark the running slot as good, so it is not rolled back at the
+        next boot."""
+        state = _load_state(self.state_file)
+        if state is not None and state.get('trial'):
+            state['trial'] = False
+            _save_state(self.state_file, state)
+            print(f"OTA: {state['active']} confirmed.")
+
+    async def confirm_when_up(self):
+        """Confirm a slot booted on trial once the server has been up for
+        ``confirm_after_s`` seconds and has answered a request (needs
+        :meth:`install`). Run it as a task."""
+        if not self.state().get('trial'):
+            return
+        started = ticks_ms()
+        while ticks_diff(ticks_ms(), started) < self.confirm_after_s * 1000 \
+                or not self._served:
+            await asyncio.sleep(1)
+        self.confirm()
+
+    def _authorize(self, request, state):
+        digest = request.headers.get('X-OTA-SHA256', '').lower()
+        signature = request.headers.get('X-OTA-Signature', '').lower()
+        version = request.headers.get('X-OTA-Version', '')
+        if self.key is None:
+            raise UploadRejected('no OTA key on the device')
+        if len(digest) != 64 or not signature or not version.isdigit():
+            raise UploadRejected(
+                'X-OTA-SHA256, X-OTA-Version and X-OTA-Signature required')
+        signed = f'{digest}.{version}'.encode()
+        if not compare_digest(_hex(hmac_sha256(self.key, signed)), signature):
+            raise UploadRejected('bad signature')
+        version = int(version)
+        if version <= state.get('version', 0):
+            raise UploadRejected('bundle version not newer than the last one')
+        return digest, version
+
+    async def _extract(self, reader, slot):
+        files = 0
+        while True:
+            header = await reader.readexactly(_BLOCK)
+            if header == _EMPTY_BLOCK:
+                break # end of archive; the rest is padding
+            name, size, kind = _parse_header(header)
+            padding = -size % _BLOCK
+            if kind == _DIRECTORY:
+                if name:
+                    _makedirs(slot + '/' + name)
+            elif kind in _REGULAR:
+                path = slot + '/' + name
+                if '/' in name:
+                    _makedirs(path.rsplit('/', 1)[0])
+                with open(path, 'wb') as f:
+                    remaining = size
+                    while remaining:
+                        data = await reader.readexactly(
+                            min(self.chunk_size, remaining))
+                        f.write(data)
+                        remaining -= len(data)
+                files += 1
+            else:
+                padding += size # links, pax headers...: skipped
+            while padding:
+                padding -= len(await reader.readexactly(
+                    min(self.chunk_size, padding)))
+        await reader.drain(self.chunk_size)
+        return files
+
+    async def receive(self, request):
+        """Stage the bundle uploaded in ``request``. Returns the updated
+        state; raises :class:`UploadRejected` or ``ValueError`` on a bad upload."""
+        state = self.state()
+        digest, version = self._authorize(request, state)
+        if self._busy:
+            raise ValueError('an update is already in progress')
+        chunked = request.headers.get('Transfer-Encoding', '').lower() == \
+            'chunked'
+        if not chunked and request.content_length > self.max_bundle:
+            raise ValueError('bundle too large')
+        if state.get('trial'):
+            # the inactive slot is the one to roll back to
+            raise ValueError('the running slot is not confirmed yet')
+        self._busy = True
+        started = ticks_ms()
+        slot = self._inactive(state)
+        try:
+            if state.get('pending'):
+                # an update staged earlier is about to be overwritten
+                state['pending'] = None
+                _save_state(self.state_file, state)
+            _rmtree(slot)
+            os.mkdir(slot)
+            reader = _HashingReader(
+                request.stream, None if chunked else request.content_length)
+            files = await self._extract(reader, slot)
+            if not compare_digest(_hex(reader.sha256.digest()), digest):
+                raise ValueError('SHA-256 mismatch')
+            state['pending'] = slot
+            state['version'] = version
+            _save_state(self.state_file, state)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            _rmtree(slot)
+            raise
+        finally:
+            self._busy = False
+        self.updates += 1
+        self.last_error = None
+        self.last_bytes = reader.received
+        self.last_files = files
+        self.last_ms = ticks_diff(ticks_ms(), started)
+        print(f"OTA: {files} files staged in {slot}, active at the next boot.")
+        return state
+
+    async def _reboot(self, delay_s=1):
+        await asyncio.sleep(delay_s) # let the response go out
+        if self.on_reboot is not None:
+            self.on_reboot()
+        import machine
+        machine.reset()
+
+    def stats(self):
+        state = self.state()
+        state.update({
+            'running': _active,
+            'enabled': self.key is not None,
+            'updates': self.updates,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_bytes': self.last_bytes,
+            'last_files': self.last_files,
+            'last_ms': self.last_ms,
+        })
+        return state
+
+    def install(self, app, url='/ota'):
+        """Register ``POST url`` (upload a bundle, ``?reboot=1`` to reset
+        once it is staged) and ``GET url`` (the slot state), and count the
+        requests served for :meth:`confirm_when_up`."""
+        from microdot import Request
+        # large bodies are streamed, not buffered (see Request.max_body_length)
+        if Request.max_content_length < self.max_bundle:
+            Request.max_content_length = self.max_bundle
+
+        @app.after_request
+        async def count_served(request, response):
+            self._served += 1
+            return response
+
+        @app.route(url, methods=['POST'])
+        async def ota_upload(request):
+            try:
+                state = await self.receive(request)
+            except UploadRejected as e:
+                return {'error': str(e)}, 403
+            except (ValueError, EOFError) as e:
+                return {'error': str(e)}, 400
+            except OSError as e:
+                return {'error': f'flash error: {e}'}, 500
+            reboot = request.args.get('reboot') == '1'
+            if reboot:
+                asyncio.create_task(self._reboot())
+            return {'pending': state['pending'], 'files': self.last_files,
+                    'bytes': self.last_bytes, 'reboot': reboot}
+
+        @app.route(url)
+        async def ota_state(request):
+            return self.stats()
+        return ota_upload
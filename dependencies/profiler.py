@@ -0,0 +1,269 @@
+"""
+A cooperative profiler for Microdot handlers, blocking helpers and asyncio
+background tasks.
+
+Three things are measured:
+
+* sections: plain function calls (``save_schedules``, ``Wifi_Connector.connect``)
+  and HTTP handlers, timed from call to return.
+* tasks: background coroutines, timed per step, i.e. the time each resume
+  runs before it awaits again. A long step is exactly what freezes the event
+  loop, so the maximum step time points straight at the culprit.
+* loop stalls: a monitor task sleeps for a fixed interval and records how late
+  it woke up into a ring buffer.
+
+All counters are preallocated arrays. Works on MicroPython and CPython.
+
+Example::
+
+    from profiler import Profiler
+
+    profiler = Profiler()
+
+    @profiler.profile('save_schedules')
+    def save_schedules():
+        ...
+
+    asyncio.create_task(profiler.task('schedule_checker', schedule_checker()))
+    asyncio.create_task(profiler.monitor())
+    profiler.wrap_app(app)
+    profiler.install(app)
+"""
+import asyncio
+from array import array
+
+try:
+    from time import ticks_us, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from inspect import iscoroutinefunction # type: ignore
+except ImportError:  # MicroPython can't tell async handlers from sync ones
+    iscoroutinefunction = None
+
+
+def _is_coroutine(obj):
+    return hasattr(obj, 'send') and hasattr(obj, 'throw')
+
+
+class _TimedCoroutine:
+    """Drives a coroutine step by step, timing each resume."""
+    def __init__(self, profiler, slot, coro):
+        self._profiler = profiler
+        self._slot = slot
+        self._coro = coro
+
+    def __await__(self):
+        coro = self._coro
+        value = None
+        error = None
+        while True:
+            started = ticks_us()
+            try:
+                if error is None:
+                    yielded = coro.send(value)
+                else:
+                    yielded = coro.throw(error)
+            except StopIteration as exc:
+                self._profiler.record(self._slot, ticks_diff(ticks_us(), started))
+                return exc.value
+            except BaseException:
+                self._profiler.record(self._slot, ticks_diff(ticks_us(), started))
+                raise
+            self._profiler.record(self._slot, ticks_diff(ticks_us(), started))
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as exc:
+                value = None
+                error = exc
+
+    __iter__ = __await__ # MicroPython awaits through __iter__
+
+
+class Profiler:
+    """Collects timing statistics for named sections.
+
+    :param max_sections: The number of section slots to preallocate.
+    :param ring_size: The number of loop latency samples kept.
+    :param stall_threshold_ms: Wakeups later than this count as stalls.
+    """
+    def __init__(self, max_sections=32, ring_size=64, stall_threshold_ms=100):
+        self.max_sections = max_sections
+        self._names = []
+        self._kinds = []
+        self._slots = {}
+        self.calls = array('L', [0] * max_sections)
+        self.total_us = array('Q', [0] * max_sections)
+        self.max_us = array('L', [0] * max_sections)
+
+        self.stall_threshold_us = stall_threshold_ms * 1000
+        self.latency_us = array('L', [0] * ring_size)
+        self._ring_pos = 0
+        self.samples = 0
+        self.stalls = 0
+        self.max_latency_us = 0
+
+    def slot(self, name, kind='section'):
+        """Return the slot index for ``name``, allocating it if needed."""
+        slot = self._slots.get(name)
+        if slot is None:
+            if len(self._names) >= self.max_sections:
+                raise ValueError('too many profiler sections')
+            slot = len(self._names)
+            self._names.append(name)
+            self._kinds.append(kind)
+            self._slots[name] = slot
+        return slot
+
+    def record(self, slot, elapsed_us):
+        self.calls[slot] += 1
+        self.total_us[slot] += elapsed_us
+        if elapsed_us > self.max_us[slot]:
+            self.max_us[slot] = elapsed_us
+
+    def profile(self, name):
+        """Decorator that times every call of a regular function."""
+        slot = self.slot(name)
+
+        def decorated(f):
+            def wrapper(*args, **kwargs):
+                started = ticks_us()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.record(slot, ticks_diff(ticks_us(), started))
+            return wrapper
+        return decorated
+
+    def wrap(self, name, f):
+        """Return ``f`` wrapped with :meth:`profile`."""
+        return self.profile(name)(f)
+
+    def task(self, name, coro):
+        """Wrap a coroutine so each of its steps is timed. Pass the result to
+        ``asyncio.create_task``."""
+        slot = self.slot(name, 'task')
+
+        async def run():
+            return await _TimedCoroutine(self, slot, coro)
+        return run()
+
+    def wrap_app(self, app):
+        """Time every route handler currently registered on ``app``, from
+        call to response."""
+        for i, (methods, pattern, handler) in enumerate(app.url_map):
+            app.url_map[i] = (methods, pattern,
+                              self._wrap_handler(pattern.url_pattern, handler))
+
+    def _wrap_handler(self, name, handler):
+        # the wrapper keeps the handler's kind, so Microdot still runs sync
+        # handlers in its executor and leaves generator bodies alone
+        slot = self.slot(name, 'handler')
+
+        if iscoroutinefunction is not None and not iscoroutinefunction(handler):
+            def sync_wrapper(*args, **kwargs):
+                started = ticks_us()
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    self.record(slot, ticks_diff(ticks_us(), started))
+            return sync_wrapper
+
+        async def wrapper(*args, **kwargs):
+            started = ticks_us()
+            try:
+                ret = handler(*args, **kwargs)
+                # on MicroPython, await whatever looks like a coroutine, as
+                # Microdot does there
+                if iscoroutinefunction is not None or _is_coroutine(ret):
+                    ret = await ret
+                return ret
+            finally:
+                self.record(slot, ticks_diff(ticks_us(), started))
+        return wrapper
+
+    async def monitor(self, interval_ms=50):
+        """Background task that measures event loop latency: the difference
+        between when it asked to wake up and when it actually ran."""
+        ring = self.latency_us
+        while True:
+            started = ticks_us()
+            await asyncio.sleep(interval_ms / 1000)
+            late = ticks_diff(ticks_us(), started) - interval_ms * 1000
+            if late < 0:
+                late = 0
+            ring[self._ring_pos] = late
+            self._ring_pos = (self._ring_pos + 1) % len(ring)
+            self.samples += 1
+            if late > self.stall_threshold_us:
+                self.stalls += 1
+            if late > self.max_latency_us:
+                self.max_latency_us = late
+
+    def recent_latencies(self):
+        """Return the buffered loop latency samples, oldest first, in
+        microseconds."""
+        ring = self.latency_us
+        n = min(self.samples, len(ring))
+        start = (self._ring_pos - n) % len(ring)
+        return [ring[(start + i) % len(ring)] for i in range(n)]
+
+    def summary(self):
+        """Return a dictionary with all the collected statistics."""
+        sections = []
+        for slot, name in enumerate(self._names):
+            calls = self.calls[slot]
+            sections.append({
+                'name': name,
+                'kind': self._kinds[slot],
+                'calls': calls,
+                'total_ms': self.total_us[slot] // 1000,
+                'mean_us': self.total_us[slot] // calls if calls else 0,
+                'max_us': self.max_us[slot],
+            })
+        sections.sort(key=lambda s: s['max_us'], reverse=True)
+        recent = self.recent_latencies()
+        ordered = sorted(recent)
+        return {
+            'sections': sections,
+            'loop': {
+                'samples': self.samples,
+                'stalls': self.stalls,
+                'stall_threshold_us': self.stall_threshold_us,
+                'max_latency_us': self.max_latency_us,
+                'p50_latency_us': ordered[len(ordered) // 2] if ordered else 0,
+                'p95_latency_us': ordered[len(ordered) * 95 // 100] if ordered else 0,
+                'recent_us': recent,
+            },
+        }
+
+    def reset(self):
+        for slot in range(len(self._names)):
+            self.calls[slot] = 0
+            self.total_us[slot] = 0
+            self.max_us[slot] = 0
+        for i in range(len(self.latency_us)):
+            self.latency_us[i] = 0
+        self._ring_pos = 0
+        self.samples = 0
+        self.stalls = 0
+        self.max_latency_us = 0
+
+    def install(self, app, url='/profile'):
+        """Register a route that returns :meth:`summary` as JSON. Send a
+        ``DELETE`` request to the same URL to reset the counters."""
+        @app.route(url, methods=['GET', 'DELETE'])
+        async def profile(request):
+            if request.method == 'DELETE':
+                self.reset()
+                return {'reset': True}
+            return self.summary()
+        return profile
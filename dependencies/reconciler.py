@@ -0,0 +1,227 @@
+"""
+Schedule reconciliation: computes the state every zone should be in right now
+and applies only the difference.
+
+Schedules are compiled once (whenever they change) into a per-zone
+minute-of-week bitmap (see :mod:`schedule_bitmap`). Each check then evaluates
+the desired state of every zone in a single pass of bit tests:
+
+* on a normal tick, only zones whose desired state changed since the previous
+  tick are switched, so manual commands from the app are left alone until the
+  schedule itself moves;
+* at boot or after a detected clock jump (NTP correction, long stall), every
+  scheduled zone is forced to its desired state;
+* after the schedules change, only the zones whose windows changed are
+  forced, so editing one zone's schedule does not switch off another zone
+  opened by hand.
+
+Nothing depends on a tick landing on the exact ``turn_on_time`` minute, so a
+reboot at 06:03 inside a 06:00-06:30 window turns the zone back on.
+
+When a :class:`zone_queue.ZoneQueue` is given, zones are not switched on
+directly: a run for the rest of the window is requested from the queue, which
+also decides when it ends.
+
+Example::
+
+    from reconciler import ScheduleReconciler
+
+    reconciler = ScheduleReconciler(timezone, relay_for_key)
+    reconciler.compile(schedules)
+    reconciler.tick(utime.time())
+"""
+import time
+
+from schedule_bitmap import ScheduleBitmap, MINUTES_PER_WEEK
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+DAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+# wall clock drift against the monotonic clock that counts as a jump
+CLOCK_JUMP_THRESHOLD_S = 90
+
+# the RTC starts in 2021 after a power loss; earlier times mean "not synced"
+MIN_VALID_YEAR = 2024
+
+
+def parse_hhmm(value):
+    """Parse ``"HH:MM"`` into minutes since midnight."""
+    hour, minute = value.split(':')
+    hour, minute = int(hour), int(minute)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError('invalid time of day')
+    return hour * 60 + minute
+
+
+def schedule_windows(schedule):
+    """Return the ``(start, end)`` minute-of-week windows of a schedule entry.
+    ``end`` is exclusive and may exceed a week for windows that wrap around
+    Sunday midnight."""
+    on = parse_hhmm(schedule.get("turn_on_time"))
+    off = parse_hhmm(schedule.get("turn_off_time"))
+    if on == off:
+        return []
+    length = off - on if off > on else off + 1440 - on
+    windows = []
+    for day in schedule.get("days", []):
+        if day not in DAY_NAMES:
+            raise ValueError(f"invalid day name '{day}'")
+        start = DAY_NAMES.index(day) * 1440 + on
+        windows.append((start, start + length))
+    return windows
+
+
+class ScheduleReconciler:
+    """Drives relays from compiled schedules.
+
+    :param timezone: A :class:`timezone.Timezone` instance.
+    :param relay_for_key: A function returning the relay for a schedule key,
+                          or ``None`` if the zone does not exist.
+    :param queue: An optional :class:`zone_queue.ZoneQueue` to run zones
+                  through.
+    :param max_zones: The number of zones the schedule bitmap has room for.
+    """
+    def __init__(self, timezone, relay_for_key, queue=None, max_zones=16):
+        self.timezone = timezone
+        self.relay_for_key = relay_for_key
+        self.queue = queue
+        self.bitmap = ScheduleBitmap(max_zones)
+        self._zones = [] # list of (key, relay, bitmap row)
+        self._windows = {} # key -> (relay, windows) as last compiled
+        self._last = None # key -> last desired state; None forces a full pass
+        self._force = set() # keys forced to their desired state on the next tick
+        self._last_utc = None
+        self._last_ticks = None
+        self.reconciliations = 0
+        self.clock_jumps = 0
+
+    def compile(self, schedules):
+        """Compile the schedules dictionary (``_SCHEDULES``). Invalid entries
+        and entries for unknown zones are skipped with a message. The next
+        :meth:`tick` forces the zones whose windows changed to their desired
+        state; the others keep following the schedule edge by edge."""
+        zones = []
+        windows_of = {}
+        bitmap = self.bitmap
+        bitmap.clear()
+        for key, schedule in schedules.items():
+            relay = self.relay_for_key(key)
+            if relay is None:
+                print(f"Schedule found for non-existent pin: {key}. Skipping.")
+                continue
+            try:
+                windows = schedule_windows(schedule)
+                row = bitmap.row(key)
+            except (AttributeError, TypeError, ValueError) as e:
+                print(f"Invalid schedule for pin {key}: {e}. Skipping.")
+                continue
+            for start, end in windows:
+                bitmap.set_window(row, start, end)
+            zones.append((key, relay, row))
+            windows_of[key] = (relay, windows)
+        if self.queue is not None:
+            # stop queued runs of zones whose schedule was removed
+            kept = [relay for _, relay, _ in zones]
+            for _, relay, _ in self._zones:
+                if relay not in kept and self.queue.owns(relay):
+                    self.queue.cancel(relay)
+        for key, compiled in windows_of.items():
+            if self._windows.get(key) != compiled:
+                self._force.add(key)
+        if self._last is not None:
+            for key in [key for key in self._last if key not in windows_of]:
+                del self._last[key]
+        self._zones = zones
+        self._windows = windows_of
+
+    def desired_states(self, utc):
+        """Return a dictionary of schedule key to desired on/off state."""
+        mow = self.timezone.minute_of_week(utc)
+        return {key: self.bitmap.is_on(row, mow)
+                for key, _, row in self._zones}
+
+    def clock_valid(self, utc):
+        return time.gmtime(utc)[0] >= MIN_VALID_YEAR
+
+    def notify_clock_step(self):
+        """Force a full reconciliation on the next tick, e.g. after NTP
+        stepped the clock."""
+        self._last = None
+
+    def _detect_jump(self, utc):
+        now = ticks_ms()
+        jumped = False
+        if self._last_utc is not None:
+            expected = ticks_diff(now, self._last_ticks) // 1000
+            if abs((utc - self._last_utc) - expected) > CLOCK_JUMP_THRESHOLD_S:
+                jumped = True
+        self._last_utc = utc
+        self._last_ticks = now
+        return jumped
+
+    def tick(self, utc):
+        """Evaluate all zones at ``utc`` and apply the changes. Returns the
+        number of relays switched."""
+        if not self.clock_valid(utc):
+            return 0
+        if self._detect_jump(utc):
+            self.clock_jumps += 1
+            print("Clock jump detected. Reconciling all zones.")
+            self._last = None
+        full = self._last is None
+        if full:
+            self._last = {}
+            self.reconciliations += 1
+        force = self._force
+        self._force = set()
+
+        mow = self.timezone.minute_of_week(utc)
+        last = self._last
+        queue = self.queue
+        switched = 0
+        bitmap = self.bitmap
+        for key, relay, row in self._zones:
+            want = bitmap.is_on(row, mow)
+            if full or key in force:
+                apply = want != (relay.status() == "On")
+            else:
+                apply = want != last.get(key, want)
+            last[key] = want
+            if not apply:
+                continue
+            if queue is not None:
+                if want:
+                    remaining = bitmap.run_length(row, mow)
+                    queue.request(relay, remaining * 60 - utc % 60)
+                    switched += 1
+                    print(f"Scheduled run queued for {key}")
+                elif not queue.owns(relay):
+                    # queued runs end on their own once their duration is up
+                    relay.turn_off()
+                    switched += 1
+                    print(f"Scheduled OFF for {key}")
+            elif want:
+                relay.turn_on()
+                switched += 1
+                print(f"Scheduled ON for {key}")
+            else:
+                relay.turn_off()
+                switched += 1
+                print(f"Scheduled OFF for {key}")
+        return switched
+
+    def stats(self):
+        return {
+            'zones': len(self._zones),
+            'reconciliations': self.reconciliations,
+            'clock_jumps': self.clock_jumps,
+            'desired': dict(self._last or {}),
+        }
@@ -1,34 +1,57 @@
 from microdot import Microdot
-import machine
+from relay_backends import GPIOBackend
 
 """
 Relay class controls pins on Pico W, turning them off and on as well as
 saving the status of those pins 
 
+By default a relay drives its own GPIO pin; pass a backend from
+relay_backends (shift register, I2C expander, simulated) and a channel to put
+it on a shared bank instead.
+
 author: Dylan O'Connor
 """
 
 class Relay:
-    def __init__(self, pinTag="LED", status="Off"):
+    _listeners = [] # callbacks notified of every state change, shared by all relays
+
+    def __init__(self, pinTag="LED", status="Off", backend=None, channel=0):
         self._pinTag = pinTag # refers to the name of the pin on the pico
         self._status = status
-    
+        if backend is None:
+            backend = GPIOBackend((pinTag,))
+            channel = 0
+        self._backend = backend
+        self._channel = channel
+
+    @classmethod
+    def add_listener(cls, callback):
+        """Registers callback(relay, is_on), called after every turn_on/turn_off."""
+        cls._listeners.append(callback)
+
+    def _notify(self, is_on):
+        for callback in Relay._listeners:
+            callback(self, is_on)
+
     def turn_on(self):
-        led = machine.Pin(self._pinTag, machine.Pin.OUT)
         self._status = "On"
-        led.on()
-    
+        self._backend.set(self._channel, True)
+        self._notify(True)
+
     def turn_off(self):
-        led = machine.Pin(self._pinTag, machine.Pin.OUT)
         self._status = "Off"
-        led.off()
-    
+        self._backend.set(self._channel, False)
+        self._notify(False)
+
     def status(self):
         return self._status
 
     def pinTag(self):
         return self._pinTag
 
+    def backend(self):
+        return self._backend
+
         
 
         
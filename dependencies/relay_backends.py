@@ -0,0 +1,216 @@
+"""
+Output backends for relays.
+
+A backend drives a bank of relay channels. Every backend keeps a shadow
+register of the channel states; changing a channel updates the shadow and
+writes it out, and inside a ``with backend.batch():`` block the write is
+deferred until the block ends, so a whole bank of zones is switched in a
+single bus transaction.
+
+* :class:`GPIOBackend` - one Pico pin per channel (the original wiring).
+* :class:`ShiftRegisterBackend` - daisy-chained 74HC595s, 8 channels per
+  chip, over SPI or three bit-banged pins.
+* :class:`MCP23017Backend` - a 16 channel I2C GPIO expander.
+* :class:`SimulatedBackend` - no hardware; records the writes, for CPython.
+
+Example::
+
+    from machine import I2C, Pin
+    from relay import Relay
+    from relay_backends import MCP23017Backend
+
+    bank = MCP23017Backend(I2C(0, scl=Pin(1), sda=Pin(0)))
+    zones = [Relay(pinTag=100 + i, backend=bank, channel=i) for i in range(16)]
+    with bank.batch():
+        zones[0].turn_off()
+        zones[1].turn_on()
+"""
+try:
+    import machine
+except ImportError:
+    machine = None
+
+
+class RelayBackend:
+    """Base class of the relay backends. Subclasses implement :meth:`_write`,
+    which outputs the whole shadow register.
+
+    :param channels: The number of channels of the bank.
+    :param active_low: Invert the outputs, for relay boards that switch on a
+                       low level.
+    """
+    def __init__(self, channels, active_low=False):
+        self.channels = channels
+        self.active_low = active_low
+        self._shadow = 0
+        self._depth = 0
+        self._dirty = False
+        self.writes = 0
+
+    def set(self, channel, on):
+        """Switch ``channel`` on or off."""
+        if not 0 <= channel < self.channels:
+            raise ValueError('invalid relay channel')
+        if on:
+            self._shadow |= 1 << channel
+        else:
+            self._shadow &= ~(1 << channel)
+        self._dirty = True
+        if not self._depth:
+            self.flush()
+
+    def get(self, channel):
+        """Return the last state written to ``channel``."""
+        return (self._shadow >> channel) & 1 == 1
+
+    def flush(self):
+        """Write the shadow register out, if it changed."""
+        if self._dirty:
+            self._dirty = False
+            self.writes += 1
+            mask = (1 << self.channels) - 1
+            self._write(~self._shadow & mask if self.active_low else self._shadow)
+
+    def _write(self, bits):
+        raise NotImplementedError
+
+    def batch(self):
+        """Return a context manager deferring writes until it exits."""
+        return self
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if not self._depth:
+            self.flush()
+
+
+class batch:
+    """Batch several backends at once::
+
+        with batch(bank_a, bank_b):
+            ...
+    """
+    def __init__(self, *backends):
+        self.backends = backends
+
+    def __enter__(self):
+        for backend in self.backends:
+            backend.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for backend in self.backends:
+            backend.__exit__(exc_type, exc, tb)
+
+
+class GPIOBackend(RelayBackend):
+    """One GPIO pin per channel.
+
+    :param pins: The pin of every channel, e.g. ``(21, 20, "LED")``. Pins are
+                 set up on their first write.
+    """
+    def __init__(self, pins, active_low=False):
+        super().__init__(len(pins), active_low)
+        self.pins = pins
+        self._outputs = [None] * len(pins)
+        self._written = None
+
+    def _write(self, bits):
+        # each pin is its own write, so only touch the ones that changed
+        changed = ~0 if self._written is None else bits ^ self._written
+        for i in range(self.channels):
+            if changed & (1 << i):
+                output = self._outputs[i]
+                if output is None:
+                    output = self._outputs[i] = machine.Pin(self.pins[i], machine.Pin.OUT) # type: ignore
+                output.value((bits >> i) & 1)
+        self._written = bits
+
+
+class ShiftRegisterBackend(RelayBackend):
+    """Daisy-chained 74HC595 shift registers. Channel 0 is output QA of the
+    first chip in the chain.
+
+    :param latch: The RCLK (latch) pin.
+    :param spi: A configured ``machine.SPI`` wired to SER and SRCLK, or
+                ``None`` to bit-bang on ``data`` and ``clock``.
+    :param data: The SER pin when bit-banging.
+    :param clock: The SRCLK pin when bit-banging.
+    :param chips: The number of chips in the chain.
+    :param oe: The optional OE pin. It is held high (outputs off) until the
+               first write, so relays don't chatter at power on.
+    """
+    def __init__(self, latch, spi=None, data=None, clock=None, chips=1,
+                 oe=None, active_low=False):
+        super().__init__(chips * 8, active_low)
+        self.chips = chips
+        self.spi = spi
+        self._latch = machine.Pin(latch, machine.Pin.OUT, value=0) # type: ignore
+        if spi is None:
+            self._data = machine.Pin(data, machine.Pin.OUT, value=0) # type: ignore
+            self._clock = machine.Pin(clock, machine.Pin.OUT, value=0) # type: ignore
+        self._oe = None
+        if oe is not None:
+            self._oe = machine.Pin(oe, machine.Pin.OUT, value=1) # type: ignore
+        self._buf = bytearray(chips)
+        self._dirty = True # clear the random power on state on the first flush
+
+    def _write(self, bits):
+        buf = self._buf
+        # the last chip in the chain is shifted out first
+        for i in range(self.chips):
+            buf[self.chips - 1 - i] = (bits >> (8 * i)) & 0xFF
+        if self.spi is not None:
+            self.spi.write(buf)
+        else:
+            data, clock = self._data, self._clock
+            for byte in buf:
+                for bit in range(7, -1, -1):
+                    data.value((byte >> bit) & 1)
+                    clock.value(1)
+                    clock.value(0)
+        self._latch.value(1)
+        self._latch.value(0)
+        if self._oe is not None:
+            self._oe.value(0)
+
+
+class MCP23017Backend(RelayBackend):
+    """An MCP23017 I2C GPIO expander; channels 0-7 are GPA0-7 and 8-15 are
+    GPB0-7. Both ports are written in one I2C transaction.
+
+    :param i2c: A configured ``machine.I2C``.
+    :param address: The I2C address of the chip (0x20-0x27).
+    """
+    _IODIRA = 0x00
+    _OLATA = 0x14
+
+    def __init__(self, i2c, address=0x20, active_low=False):
+        super().__init__(16, active_low)
+        self.i2c = i2c
+        self.address = address
+        self._buf = bytearray(2)
+        self._dirty = True
+        self.flush() # set the latches before switching the pins to outputs
+        i2c.writeto_mem(address, self._IODIRA, b'\x00\x00')
+
+    def _write(self, bits):
+        self._buf[0] = bits & 0xFF
+        self._buf[1] = (bits >> 8) & 0xFF
+        # OLATA and OLATB are adjacent with IOCON.BANK = 0 (the reset default)
+        self.i2c.writeto_mem(self.address, self._OLATA, self._buf)
+
+
+class SimulatedBackend(RelayBackend):
+    """A backend without hardware. Keeps the output state and the number of
+    bus transactions, for tests and the simulator."""
+    def __init__(self, channels=32, active_low=False):
+        super().__init__(channels, active_low)
+        self.outputs = 0
+
+    def _write(self, bits):
+        self.outputs = bits
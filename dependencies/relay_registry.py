@@ -0,0 +1,194 @@
+"""
+Registry of the relays (zones) wired to the board, configured from flash.
+
+The zones are listed in the config store (:mod:`config_store`, under the key
+``relays``; it imports the ``relays.json`` file used before) as entries with
+an id, a display name and a pin::
+
+    [{"id": "LED", "name": "Onboard LED", "pin": "LED"},
+     {"id": 21, "name": "Zone 1", "pin": 21}]
+
+An entry may also name a backend from :mod:`relay_backends` and a channel on
+it instead of a pin: ``{"id": 30, "name": "Back lawn", "backend": "bank",
+"channel": 2}``.
+
+At load time every id (as a string, the way it arrives in a URL or a schedule
+key) and every name is resolved into a single dictionary, so a lookup is one
+``dict.get`` with no per-request parsing. Zones can be added and removed at
+runtime over HTTP; the list is committed to the store and the lookup rebuilt
+without a restart.
+
+Example::
+
+    from config_store import ConfigStore
+    from relay_registry import RelayRegistry
+
+    relays = RelayRegistry(ConfigStore("settings.json"))
+    relays.get("21").turn_on()
+    relays.get("Zone 1").turn_off()
+    relays.install(app) # GET/POST /relays, DELETE /relays/<id>
+"""
+from relay import Relay
+
+DEFAULT_RELAYS = (
+    {"id": "LED", "name": "Onboard LED", "pin": "LED"},
+    {"id": 21, "name": "Zone 1", "pin": 21},
+)
+
+
+class RelayRegistry:
+    """Loads, looks up and edits the configured relays.
+
+    :param config: The :class:`config_store.ConfigStore` holding the list.
+    :param key: The key of the list in the store.
+    :param defaults: The entries used when the list is missing or invalid.
+    :param backends: Optional dictionary of backend name to
+                     :class:`relay_backends.RelayBackend`, for entries that
+                     use a ``backend`` and ``channel`` instead of a pin.
+    """
+    def __init__(self, config, key='relays', defaults=DEFAULT_RELAYS,
+                 backends=None):
+        self.config = config
+        self.key = key
+        self.defaults = defaults
+        self.backends = backends or {}
+        self.on_change = None # called after a relay is added or removed
+        self.switch = None # optional callback(relay, on) switching relays, e.g. on another core
+        self._entries = [] # list of (entry, relay)
+        self._lookup = {} # str(id) and name -> relay
+        self._ids = {} # relay -> str(id)
+        self.load()
+
+    def load(self):
+        """(Re)load the relays from the store, falling back to the defaults."""
+        entries = self.config.get_list(self.key)
+        if entries is None:
+            print(f"No valid relay config under '{self.key}'. Using the default relays.")
+            entries = [dict(entry) for entry in self.defaults]
+        self._entries = []
+        for entry in entries:
+            try:
+                self._entries.append((entry, self._create(entry)))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Invalid relay entry {entry}: {e}. Skipping.")
+        self._rebuild()
+
+    def save(self):
+        self.config.set(self.key, [entry for entry, _ in self._entries])
+
+    def _create(self, entry):
+        backend = entry.get("backend")
+        if backend is not None:
+            if backend not in self.backends:
+                raise ValueError(f"unknown backend '{backend}'")
+            return Relay(pinTag=entry.get("pin", entry["id"]),
+                         backend=self.backends[backend],
+                         channel=int(entry["channel"]))
+        pin = entry["pin"]
+        if pin != "LED" and not isinstance(pin, int):
+            raise ValueError("pin must be 'LED' or an integer")
+        return Relay(pinTag=pin)
+
+    def _rebuild(self):
+        lookup = {}
+        ids = {}
+        for entry, relay in self._entries:
+            key = str(entry["id"])
+            lookup[key] = relay
+            ids[relay] = key
+        # ids win over names if the two ever clash
+        for entry, relay in self._entries:
+            name = entry.get("name")
+            if name and name not in lookup:
+                lookup[name] = relay
+        self._lookup = lookup
+        self._ids = ids
+
+    def get(self, key):
+        """Return the relay with id or name ``key``, or ``None``."""
+        return self._lookup.get(key if isinstance(key, str) else str(key))
+
+    def id_of(self, relay):
+        """Return the id of ``relay`` as a string (the schedule key)."""
+        return self._ids.get(relay)
+
+    def relays(self):
+        return [relay for _, relay in self._entries]
+
+    def entries(self):
+        return [entry for entry, _ in self._entries]
+
+    def add(self, entry):
+        """Add a relay from an entry dictionary and save the list. Raises
+        ``ValueError`` if the entry is invalid or its id or name is taken."""
+        if not isinstance(entry, dict) or "id" not in entry:
+            raise ValueError("relay entry needs an 'id'")
+        if not isinstance(entry["id"], (int, str)):
+            raise ValueError("relay id must be a string or an integer")
+        name = entry.get("name")
+        if name is not None and not isinstance(name, str):
+            raise ValueError("relay name must be a string")
+        if str(entry["id"]) in self._lookup or (name and name in self._lookup):
+            raise ValueError("relay id or name already in use")
+        if "pin" in entry and entry.get("backend") is None:
+            for existing, _ in self._entries:
+                if existing.get("backend") is None and existing.get("pin") == entry["pin"]:
+                    raise ValueError(f"pin {entry['pin']} already in use")
+        try:
+            relay = self._create(entry)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"invalid relay entry: {e}")
+        self._entries.append((entry, relay))
+        self._rebuild()
+        self.save()
+        if self.on_change is not None:
+            self.on_change()
+        return relay
+
+    def remove(self, key):
+        """Turn off and remove the relay with id or name ``key`` and save the
+        list. Returns the removed relay, or ``None`` if there is none."""
+        relay = self.get(key)
+        if relay is None:
+            return None
+        if self.switch is not None:
+            self.switch(relay, False)
+        else:
+            relay.turn_off()
+        self._entries = [(e, r) for e, r in self._entries if r is not relay]
+        self._rebuild()
+        self.save()
+        if self.on_change is not None:
+            self.on_change()
+        return relay
+
+    def install(self, app, url='/relays'):
+        """Register ``GET url`` (list), ``POST url`` (add, JSON entry body)
+        and ``DELETE url/<id>`` (remove)."""
+        @app.route(url, methods=['GET', 'POST'])
+        async def relays(request):
+            if request.method == 'POST':
+                try:
+                    self.add(request.json)
+                except ValueError as e:
+                    return {'error': str(e)}, 400
+                except OSError as e:
+                    return {'error': f'could not save relay config: {e}'}, 500
+                return {'relays': self.entries()}, 201
+            listing = []
+            for entry, relay in self._entries:
+                item = dict(entry)
+                item['status'] = relay.status()
+                listing.append(item)
+            return {'relays': listing}
+
+        @app.route(url + '/<key>', methods=['DELETE'])
+        async def remove_relay(request, key):
+            try:
+                relay = self.remove(key)
+            except OSError as e:
+                return {'error': f'could not save relay config: {e}'}, 500
+            if relay is None:
+                return {'error': 'relay not found'}, 404
+            return {'relays': self.entries()}
+        return relays
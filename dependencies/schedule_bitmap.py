@@ -0,0 +1,120 @@
+"""
+Minute-of-week bitmap representation of zone schedules.
+
+Each zone gets a row of 10080 bits (one per minute of the week, Monday 00:00
+first) in a single preallocated ``bytearray``: 1260 bytes per zone, about
+20 KB for 16 zones. "Should zone X be on now" is a single bit test, several
+windows for the same zone are simply ORed into its row, and the length of
+the run starting at a given minute is found by skipping whole ``0xFF`` bytes.
+
+Example::
+
+    from schedule_bitmap import ScheduleBitmap
+
+    bitmap = ScheduleBitmap()
+    row = bitmap.row("21")
+    bitmap.set_window(row, 6 * 60, 6 * 60 + 30) # Monday 06:00-06:30
+    bitmap.is_on(row, 6 * 60 + 10) # True
+"""
+MINUTES_PER_WEEK = 7 * 1440
+ROW_BYTES = MINUTES_PER_WEEK // 8
+
+
+class ScheduleBitmap:
+    """A fixed-size set of per-zone minute-of-week bitmaps.
+
+    :param max_zones: The number of zone rows to preallocate.
+    """
+    def __init__(self, max_zones=16):
+        self.max_zones = max_zones
+        self.bits = bytearray(max_zones * ROW_BYTES)
+        self._zero_row = bytes(ROW_BYTES)
+        self._rows = {} # zone key -> row index
+
+    def row(self, key):
+        """Return the row index of zone ``key``, assigning a free row if
+        needed. Raises ``ValueError`` when all rows are in use."""
+        row = self._rows.get(key)
+        if row is None:
+            if len(self._rows) >= self.max_zones:
+                raise ValueError('no free schedule bitmap rows')
+            row = len(self._rows)
+            self._rows[key] = row
+        return row
+
+    def clear(self):
+        """Clear every row and forget the zone assignments."""
+        for row in range(self.max_zones):
+            self.clear_row(row)
+        self._rows = {}
+
+    def clear_row(self, row):
+        base = row * ROW_BYTES
+        self.bits[base:base + ROW_BYTES] = self._zero_row
+
+    def set_window(self, row, start, end):
+        """Set the minutes ``start`` (inclusive) to ``end`` (exclusive). Windows
+        running past the end of the week wrap around to Monday."""
+        length = end - start
+        if length <= 0:
+            return
+        if length >= MINUTES_PER_WEEK:
+            start, length = 0, MINUTES_PER_WEEK
+        start %= MINUTES_PER_WEEK
+        end = start + length
+        if end > MINUTES_PER_WEEK:
+            self._set_range(row, start, MINUTES_PER_WEEK)
+            self._set_range(row, 0, end - MINUTES_PER_WEEK)
+        else:
+            self._set_range(row, start, end)
+
+    def _set_range(self, row, start, end):
+        bits = self.bits
+        base = row * ROW_BYTES
+        minute = start
+        # leading partial byte, whole bytes, trailing partial byte
+        while minute < end and minute & 7:
+            bits[base + (minute >> 3)] |= 1 << (minute & 7)
+            minute += 1
+        while minute + 8 <= end:
+            bits[base + (minute >> 3)] = 0xFF
+            minute += 8
+        while minute < end:
+            bits[base + (minute >> 3)] |= 1 << (minute & 7)
+            minute += 1
+
+    def is_on(self, row, mow):
+        """Return ``True`` if the zone is scheduled on at minute ``mow``."""
+        return (self.bits[row * ROW_BYTES + (mow >> 3)] >> (mow & 7)) & 1 == 1
+
+    def run_length(self, row, mow):
+        """Return the number of consecutive scheduled minutes starting at
+        ``mow`` (0 if the zone is off then), wrapping around the week and
+        capped at a full week."""
+        bits = self.bits
+        base = row * ROW_BYTES
+        minute = mow
+        length = 0
+        while length < MINUTES_PER_WEEK:
+            m = minute % MINUTES_PER_WEEK
+            if not m & 7 and bits[base + (m >> 3)] == 0xFF \
+                    and length + 8 <= MINUTES_PER_WEEK:
+                length += 8
+                minute += 8
+                continue
+            if not (bits[base + (m >> 3)] >> (m & 7)) & 1:
+                break
+            length += 1
+            minute += 1
+        return length
+
+    def minutes_on(self, row):
+        """Return the total number of scheduled minutes in the week."""
+        count = 0
+        base = row * ROW_BYTES
+        for i in range(base, base + ROW_BYTES):
+            b = self.bits[i]
+            while b:
+                b &= b - 1
+                count += 1
+        return count
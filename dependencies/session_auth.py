@@ -0,0 +1,249 @@
+"""
+Signed session tokens for the control API.
+
+Logging in with the device password (``POST /auth/login``) returns a token
+``<expires>.<nonce>.<signature>``: the expiry time and a random nonce, signed
+with HMAC-SHA256 under a key kept in the config store. Nothing is stored per
+session, so tokens survive reboots; changing the password replaces the key,
+which ends every session at once.
+
+A ``before_request`` hook lets a request through if it carries a valid token,
+in an ``Authorization: Bearer`` header, the ``session`` cookie set at login
+(so the bundled web UI needs nothing else) or a ``token`` query argument (for
+WebSocket clients that can't set headers). The cookie is ``HttpOnly`` and
+``SameSite=Strict``, so a page on another site can't make the browser send
+it along with a forged request. The HMAC is computed once per
+session: verified tokens are kept in a small LRU cache and later requests
+only check the expiry. Until a password is set, every request is let
+through, as before; the first password can only be set while ``setup_open``
+returns True (the setup AP is up), so nobody else on the network can claim
+the device first.
+
+Example::
+
+    from session_auth import SessionAuth
+
+    auth = SessionAuth(config) # a config_store.ConfigStore
+    auth.allow = lambda request: ap_manager.is_ap_active and \
+        request.path == '/configure_wifi' # open for setup only
+    auth.setup_open = lambda request: ap_manager.is_ap_active
+    auth.install(app) # before any route that needs protecting
+"""
+import binascii
+import os
+
+from hmac_sha256 import hmac_sha256, compare_digest
+
+try:
+    from utime import time as wall_time # type: ignore
+except ImportError:
+    from time import time as wall_time
+
+COOKIE = 'session'
+# reachable without a token: the UI itself and logging in; a path ending in a
+# slash covers everything below it
+PUBLIC_PATHS = ('/', '/setup', '/ui/', '/auth/login')
+
+
+def _hex(digest):
+    return binascii.hexlify(digest).decode()
+
+
+def _json_field(request, name):
+    try:
+        data = request.json
+    except ValueError:
+        return None
+    return data.get(name) if isinstance(data, dict) else None
+
+
+class SessionAuth:
+    """Issues and checks the session tokens.
+
+    :param config: The :class:`config_store.ConfigStore` holding the signing
+                   key (``auth.key``) and the password hash
+                   (``auth.password``).
+    :param ttl_s: How long a token stays valid, in seconds.
+    :param cache_size: How many verified tokens to remember; 0 verifies the
+                       signature on every request.
+    :param public: Paths served without a token.
+    """
+    def __init__(self, config, ttl_s=30 * 24 * 3600, cache_size=8,
+                 public=PUBLIC_PATHS):
+        self.config = config
+        self.ttl_s = ttl_s
+        self.cache_size = cache_size
+        self.public = public
+        self.allow = None # optional callback(request) returning True to skip the check
+        self.setup_open = None # callback(request) returning True while the first password may be set
+        self._cache = {} # token -> [expires, last use]
+        self._uses = 0
+        self._key = None
+        self._load_key()
+
+        self.issued = 0
+        self.cache_hits = 0
+        self.verified = 0 # signatures computed
+        self.rejected = 0 # missing, malformed, badly signed or expired tokens
+
+    def _load_key(self):
+        key = self.config.get_str('auth.key')
+        if key is None:
+            key = _hex(os.urandom(32))
+            self.config.set('auth.key', key)
+        self._key = binascii.unhexlify(key)
+
+    @property
+    def enabled(self):
+        """True once a password is set."""
+        return self.config.get_str('auth.password') is not None
+
+    def _password_hash(self, password):
+        return _hex(hmac_sha256(self._key, password.encode()))
+
+    def check_password(self, password):
+        stored = self.config.get_str('auth.password')
+        return stored is not None and isinstance(password, str) and \
+            compare_digest(self._password_hash(password), stored)
+
+    def set_password(self, password):
+        """Set a new password and signing key (one commit), ending every
+        session issued so far."""
+        with self.config.batch():
+            self.config.delete('auth.key')
+            self._load_key()
+            self.config.set('auth.password', self._password_hash(password))
+        self._cache.clear()
+
+    def _sign(self, payload):
+        return _hex(hmac_sha256(self._key, payload.encode()))
+
+    def issue(self):
+        """Return a new token and its expiry time."""
+        expires = int(wall_time()) + self.ttl_s
+        payload = f'{expires}.{_hex(os.urandom(8))}'
+        self.issued += 1
+        return f'{payload}.{self._sign(payload)}', expires
+
+    def verify(self, token):
+        """Return True if ``token`` is correctly signed and not expired."""
+        now = int(wall_time())
+        entry = self._cache.get(token)
+        if entry is not None:
+            if entry[0] > now:
+                self.cache_hits += 1
+                self._uses += 1
+                entry[1] = self._uses
+                return True
+            del self._cache[token]
+            self.rejected += 1
+            return False
+        parts = token.split('.')
+        try:
+            expires = int(parts[0])
+        except ValueError:
+            expires = 0
+        if len(parts) != 3 or expires <= now:
+            self.rejected += 1
+            return False
+        self.verified += 1
+        if not compare_digest(self._sign(parts[0] + '.' + parts[1]), parts[2]):
+            self.rejected += 1
+            return False
+        if self.cache_size:
+            if len(self._cache) >= self.cache_size:
+                oldest = min(self._cache, key=lambda t: self._cache[t][1])
+                del self._cache[oldest]
+            self._uses += 1
+            self._cache[token] = [expires, self._uses]
+        return True
+
+    def token_of(self, request):
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            return header[7:].strip()
+        return request.cookies.get(COOKIE) or request.args.get('token')
+
+    def _is_public(self, path):
+        for public in self.public:
+            if path == public or (public.endswith('/') and public != '/' and
+                                  path.startswith(public)):
+                return True
+        return False
+
+    async def check(self, request):
+        """The ``before_request`` hook: returns a 401 response for requests
+        that need a token and don't carry a valid one."""
+        if not self.enabled or self._is_public(request.path) or \
+                (self.allow and self.allow(request)):
+            return None
+        token = self.token_of(request)
+        if token and self.verify(token):
+            return None
+        if not token:
+            self.rejected += 1
+        return {'error': 'authentication required'}, 401, {'WWW-Authenticate': 'Bearer'}
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'ttl_s': self.ttl_s,
+            'issued': self.issued,
+            'cached': len(self._cache),
+            'cache_size': self.cache_size,
+            'cache_hits': self.cache_hits,
+            'verified': self.verified,
+            'rejected': self.rejected,
+        }
+
+    def install(self, app, url='/auth'):
+        """Register the token check as a ``before_request`` hook, plus:
+
+        * ``POST url/login`` with ``{"password": ...}``: a token (JSON, and
+          the ``session`` cookie);
+        * ``POST url/logout``: clears the cookie;
+        * ``POST url/password`` with ``{"password": ...}``: sets the password
+          (the first one while ``setup_open`` allows it, later ones with a
+          valid token), ending all sessions;
+        * ``GET url``: stats() as JSON.
+        """
+        from microdot import Response
+
+        app.before_request(self.check)
+
+        def session(token, expires):
+            res = Response({'token': token, 'expires': expires})
+            res.set_cookie(COOKIE, token, path='/', max_age=self.ttl_s, http_only=True,
+                           same_site='Strict')
+            return res
+
+        @app.route(url + '/login', methods=['POST'])
+        async def login(request):
+            password = _json_field(request, 'password')
+            if not self.check_password(password):
+                self.rejected += 1
+                return {'error': 'wrong password'}, 403
+            return session(*self.issue())
+
+        @app.route(url + '/logout', methods=['POST'])
+        async def logout(request):
+            res = Response({'ok': True})
+            res.set_cookie(COOKIE, '', path='/', max_age=0, http_only=True,
+                           same_site='Strict')
+            return res
+
+        @app.route(url + '/password', methods=['POST'])
+        async def password(request):
+            if not self.enabled and not (self.setup_open and self.setup_open(request)):
+                self.rejected += 1
+                return {'error': 'the first password can only be set from the setup page'}, 403
+            new = _json_field(request, 'password')
+            if not isinstance(new, str) or len(new) < 8:
+                return {'error': "'password' of at least 8 characters required"}, 400
+            self.set_password(new)
+            return session(*self.issue())
+
+        @app.route(url)
+        async def auth(request):
+            return self.stats()
+        return login
@@ -0,0 +1,155 @@
+"""
+Static file serving for the bundled sprinkler web UI.
+
+Files are served from a directory on flash. When the client accepts gzip and
+a precompressed ``<name>.gz`` sits next to the file, the compressed variant
+is sent instead. Every response carries a strong ``ETag`` (a content hash
+computed once per file and cached until the file changes) so browsers can
+revalidate with ``If-None-Match`` and get a ``304`` back. File contents are
+streamed through a small pool of reusable buffers sized to the TCP maximum
+segment size, so serving a file does not allocate a new buffer per chunk.
+
+Example::
+
+    from static_files import StaticFiles
+
+    static = StaticFiles(root='www')
+
+    @app.route('/')
+    async def index(request):
+        return static.response(request, 'index.html')
+"""
+import os
+import hashlib
+import binascii
+
+from microdot import Response
+
+# lwIP's default TCP_MSS on the Pico W
+DEFAULT_MSS = 1460
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st[0] & 0x4000: # directory
+        return None
+    return st[6], st[8] # size, mtime
+
+
+def _socket_mss(request):
+    """Return the negotiated MSS of the request's socket when the platform
+    exposes it (CPython on Linux), otherwise ``None``."""
+    try:
+        import socket
+        sock = request.sock[1].get_extra_info('socket')
+        return sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG) or None
+    except Exception:
+        return None
+
+
+class StaticFiles:
+    """Serves files from a directory with gzip negotiation and caching.
+
+    :param root: The directory holding the files to serve.
+    :param max_age: The ``Cache-Control`` max-age, in seconds.
+    :param mss: The buffer size to use when the socket MSS cannot be queried.
+    :param pool_size: The maximum number of idle buffers kept for reuse.
+    """
+    def __init__(self, root='www', max_age=86400, mss=DEFAULT_MSS,
+                 pool_size=2):
+        self.root = root.rstrip('/')
+        self.max_age = max_age
+        self.mss = mss
+        self.pool_size = pool_size
+        self._buffers = []
+        self._etags = {} # path -> (size, mtime, etag)
+
+    def response(self, request, filename):
+        """Build the response for ``filename``, relative to the root
+        directory."""
+        if filename.startswith('/') or '..' in filename.split('/'):
+            return Response('Not found', status_code=404)
+        path = self.root + '/' + filename
+
+        ext = filename.rsplit('.', 1)[-1]
+        content_type = Response.types_map.get(ext, 'application/octet-stream')
+        headers = {
+            'Content-Type': content_type,
+            'Cache-Control': 'max-age={}'.format(self.max_age),
+            'Vary': 'Accept-Encoding',
+        }
+
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        info = None
+        if 'gzip' in accept_encoding:
+            info = _stat(path + '.gz')
+            if info is not None:
+                path += '.gz'
+                headers['Content-Encoding'] = 'gzip'
+        if info is None:
+            info = _stat(path)
+        if info is None:
+            if _stat(path + '.gz') is not None:
+                # only a compressed copy is bundled and the client can't
+                # decode it
+                return Response('Not acceptable', status_code=406)
+            return Response('Not found', status_code=404)
+
+        size, mtime = info
+        etag = self._etag(path, size, mtime)
+        headers['ETag'] = etag
+        if etag in request.headers.get('If-None-Match', ''):
+            del headers['Content-Type']
+            return Response(status_code=304, headers=headers,
+                            reason='Not Modified')
+
+        headers['Content-Length'] = str(size)
+        if size == 0:
+            return Response(b'', headers=headers)
+        return Response(body=self._stream(request, path), headers=headers)
+
+    def _etag(self, path, size, mtime):
+        cached = self._etags.get(path)
+        if cached is not None and cached[0] == size and cached[1] == mtime:
+            return cached[2]
+        digest = hashlib.sha256()
+        buf = self._acquire(None)
+        try:
+            mv = memoryview(buf)
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    digest.update(mv[:n])
+        finally:
+            self._release(buf)
+        etag = '"' + binascii.hexlify(digest.digest()[:12]).decode() + '"'
+        self._etags[path] = (size, mtime, etag)
+        return etag
+
+    def _acquire(self, request):
+        if self._buffers:
+            return self._buffers.pop()
+        mss = _socket_mss(request) if request is not None else None
+        return bytearray(mss or self.mss)
+
+    def _release(self, buf):
+        if len(self._buffers) < self.pool_size:
+            self._buffers.append(buf)
+
+    def _stream(self, request, path):
+        buf = self._acquire(request)
+        try:
+            mv = memoryview(buf)
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    yield mv[:n]
+        finally:
+            self._release(buf)
@@ -0,0 +1,238 @@
+"""
+Timezone and daylight saving time conversion from a POSIX TZ rule.
+
+The rule (for example ``"PST8PDT,M3.2.0,M11.1.0"`` for the US Pacific coast)
+is parsed once, and the UTC instants of the next several years of DST
+transitions are precomputed into a small sorted array. Converting UTC to
+local time is then a binary search plus an addition, with no allocation,
+which is cheap enough to run for every scheduling decision.
+
+Supported rule forms: ``Mm.w.d[/time]`` (day ``d`` of week ``w`` of month
+``m``, week 5 meaning the last one), ``Jn[/time]`` (Julian day 1-365, never
+counting February 29) and ``n[/time]`` (zero-based day of year). Zones
+without DST (``"UTC0"``, ``"MST7"``) are supported too.
+
+Example::
+
+    from timezone import Timezone
+
+    tz = Timezone("PST8PDT,M3.2.0,M11.1.0")
+    local = tz.localtime(utime.time())
+"""
+import time
+from array import array
+
+try:
+    # some MicroPython ports count seconds from 2000-01-01 instead of 1970
+    EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+except (AttributeError, OverflowError):
+    EPOCH_OFFSET = 0
+
+SECONDS_PER_DAY = 86400
+
+
+def days_from_civil(year, month, day):
+    """Return the number of days between 1970-01-01 and the given date."""
+    year -= month <= 2
+    era = (year if year >= 0 else year - 399) // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def weekday(days):
+    """Return the weekday (Monday is 0) of a day number from
+    :func:`days_from_civil`."""
+    return (days + 3) % 7
+
+
+_MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _month_days(year, month):
+    if month == 2 and is_leap(year):
+        return 29
+    return _MONTH_DAYS[month - 1]
+
+
+def _parse_name(rule, i):
+    if rule[i] == '<':
+        end = rule.index('>', i)
+        return rule[i + 1:end], end + 1
+    start = i
+    while i < len(rule) and rule[i].isalpha():
+        i += 1
+    if i - start < 3:
+        raise ValueError('invalid TZ name')
+    return rule[start:i], i
+
+
+def _parse_offset(rule, i):
+    """Parse ``[+|-]hh[:mm[:ss]]`` and return the value in seconds."""
+    sign = 1
+    if i < len(rule) and rule[i] in '+-':
+        if rule[i] == '-':
+            sign = -1
+        i += 1
+    seconds = 0
+    for mult in (3600, 60, 1):
+        start = i
+        while i < len(rule) and rule[i].isdigit():
+            i += 1
+        if start == i:
+            if mult == 3600:
+                raise ValueError('invalid TZ offset')
+            break
+        seconds += int(rule[start:i]) * mult
+        if i < len(rule) and rule[i] == ':' and mult > 1:
+            i += 1
+        else:
+            break
+    return sign * seconds, i
+
+
+def _parse_date_rule(part):
+    if '/' in part:
+        date, at = part.split('/', 1)
+        at, _ = _parse_offset(at, 0)
+    else:
+        date, at = part, 7200 # 02:00 local time by default
+    if date[0] == 'M':
+        month, week, day = (int(x) for x in date[1:].split('.'))
+        if not (1 <= month <= 12 and 1 <= week <= 5 and 0 <= day <= 6):
+            raise ValueError('invalid TZ date rule')
+        return ('M', month, week, day), at
+    if date[0] == 'J':
+        return ('J', int(date[1:])), at
+    return ('n', int(date)), at
+
+
+def _rule_day(rule, year):
+    """Return the day number (since 1970-01-01) a date rule falls on in
+    ``year``."""
+    if rule[0] == 'M':
+        _, month, week, day = rule
+        first = days_from_civil(year, month, 1)
+        # POSIX day 0 is Sunday; weekday() has Monday as 0
+        offset = (day - (weekday(first) + 1) % 7) % 7
+        mday = 1 + offset + (week - 1) * 7
+        while mday > _month_days(year, month):
+            mday -= 7
+        return first + mday - 1
+    if rule[0] == 'J':
+        n = rule[1]
+        if is_leap(year) and n >= 60:
+            n += 1
+        return days_from_civil(year, 1, 1) + n - 1
+    return days_from_civil(year, 1, 1) + rule[1]
+
+
+class Timezone:
+    """Converts UTC timestamps to local time for a POSIX TZ rule.
+
+    :param rule: The POSIX TZ string.
+    :param years: The number of years of transitions to precompute. The table
+                  is rebuilt automatically when a timestamp falls outside.
+    """
+    def __init__(self, rule, years=8):
+        self.rule = rule
+        self.years = years
+        i = 0
+        self.std_name, i = _parse_name(rule, i)
+        offset, i = _parse_offset(rule, i)
+        self.std_offset = -offset # POSIX offsets are positive west of UTC
+        self.dst_name = None
+        self.dst_offset = self.std_offset
+        self._start = self._end = None
+        if i < len(rule):
+            self.dst_name, i = _parse_name(rule, i)
+            self.dst_offset = self.std_offset + 3600
+            if i < len(rule) and rule[i] != ',':
+                offset, i = _parse_offset(rule, i)
+                self.dst_offset = -offset
+            if i >= len(rule) or rule[i] != ',':
+                raise ValueError('DST rule without transition dates')
+            start, end = rule[i + 1:].split(',')
+            self._start = _parse_date_rule(start)
+            self._end = _parse_date_rule(end)
+
+        self.transitions = array('q')
+        self.offsets = array('l')
+        self._first = self._last = 0
+        self._offset_before = self.std_offset
+        self._build(time.gmtime(time.time())[0] - 1)
+
+    def _build(self, first_year):
+        """Precompute the transition table starting at ``first_year``."""
+        transitions = array('q')
+        offsets = array('l')
+        if self._start is not None:
+            for year in range(first_year, first_year + self.years):
+                (start_rule, start_at), (end_rule, end_at) = self._start, self._end
+                start = _rule_day(start_rule, year) * SECONDS_PER_DAY \
+                    + start_at - self.std_offset
+                end = _rule_day(end_rule, year) * SECONDS_PER_DAY \
+                    + end_at - self.dst_offset
+                pairs = ((start, self.dst_offset), (end, self.std_offset))
+                if end < start: # southern hemisphere
+                    pairs = (pairs[1], pairs[0])
+                for instant, offset in pairs:
+                    transitions.append(instant - EPOCH_OFFSET)
+                    offsets.append(offset)
+        self.transitions = transitions
+        self.offsets = offsets
+        self._first = days_from_civil(first_year, 1, 1) * SECONDS_PER_DAY \
+            - EPOCH_OFFSET
+        self._last = days_from_civil(first_year + self.years, 1, 1) \
+            * SECONDS_PER_DAY - EPOCH_OFFSET
+        # before the first transition of the year the previous year's last
+        # state applies, i.e. the opposite of the first transition
+        if len(offsets):
+            self._offset_before = self.std_offset \
+                if offsets[0] == self.dst_offset else self.dst_offset
+
+    def offset(self, utc):
+        """Return the UTC offset in seconds in effect at ``utc`` (seconds
+        since the platform epoch)."""
+        if self._start is None:
+            return self.std_offset
+        if utc < self._first or utc >= self._last:
+            self._build(time.gmtime(utc)[0] - 1)
+        transitions = self.transitions
+        lo, hi = 0, len(transitions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if transitions[mid] <= utc:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return self._offset_before
+        return self.offsets[lo - 1]
+
+    def is_dst(self, utc):
+        return self._start is not None and self.offset(utc) == self.dst_offset
+
+    def to_local(self, utc):
+        """Return the local time at ``utc`` as seconds since the epoch."""
+        return utc + self.offset(utc)
+
+    def localtime(self, utc):
+        """Return the local time at ``utc`` as a ``time.localtime`` tuple."""
+        return time.gmtime(self.to_local(utc))
+
+    def minute_of_week(self, utc):
+        """Return the local minute of the week (Monday 00:00 is 0) at ``utc``,
+        without building a time tuple."""
+        local = self.to_local(utc) + EPOCH_OFFSET
+        days = local // SECONDS_PER_DAY
+        return weekday(days) * 1440 + (local % SECONDS_PER_DAY) // 60
+
+    def local_day(self, utc):
+        """Return the local day number (days since 1970-01-01) at ``utc``."""
+        return (self.to_local(utc) + EPOCH_OFFSET) // SECONDS_PER_DAY
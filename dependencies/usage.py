@@ -0,0 +1,316 @@
+"""
+Water usage accounting: how long every zone ran and roughly how much water it
+used.
+
+A relay listener times every run on the monotonic clock and splits it over
+hour boundaries. Runtimes (seconds) and estimated gallons (from each zone's
+flow rate) are added to fixed-size binary buckets, hourly for the last week
+and daily for the last year, in a ring file that is preallocated on first use
+and never grows (about 36 KB for 8 zones). Each bucket stores its own hour or
+day number, so a slot left over from a previous lap of the ring is recognised
+and reset instead of needing a separate write pointer.
+
+Updates are kept in RAM and written back every ``flush_interval_s``, so a run
+costs a handful of bucket rewrites instead of a write per relay change; after
+a power loss at most one flush interval of runtime is lost. Reports read one
+bucket at a time and never load the history into RAM.
+
+Buckets follow local time when a :class:`timezone.Timezone` is given.
+
+Example::
+
+    from usage import UsageRecorder
+
+    usage = UsageRecorder("usage.bin", flow_rates={"21": 2.5})
+    Relay.add_listener(usage.on_relay_change)
+    asyncio.create_task(usage.run())
+    usage.install(app) # GET /usage, /usage/hourly, /usage/daily
+"""
+import asyncio
+import struct
+import time
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from utime import time as wall_time # type: ignore
+except ImportError:
+    from time import time as wall_time
+
+MAGIC = b'USG1'
+HOURLY_BUCKETS = 7 * 24
+DAILY_BUCKETS = 366
+KEY_BYTES = 8
+
+# the RTC starts in 2021 after a power loss; earlier times mean "not synced"
+MIN_VALID_YEAR = 2024
+
+_HOURLY = 0
+_DAILY = 1
+
+
+class UsageRecorder:
+    """Records per-zone runtime and water use in a ring file.
+
+    :param path: The ring file.
+    :param timezone: Optional :class:`timezone.Timezone` for local buckets.
+    :param flow_rates: Dictionary of zone key to flow rate in gallons per
+                       minute.
+    :param default_flow_gpm: The flow rate of zones not in ``flow_rates``.
+    :param key_for: Function returning the zone key of a relay, or ``None``
+                    for relays that should not be recorded. Defaults to the
+                    pin tag as a string.
+    :param max_zones: The number of zone columns in the file.
+    :param flush_interval_s: How often pending updates are written.
+    """
+    def __init__(self, path='usage.bin', timezone=None, flow_rates=None,
+                 default_flow_gpm=0.0, key_for=None, max_zones=8,
+                 flush_interval_s=600):
+        self.path = path
+        self.timezone = timezone
+        self.flow_rates = flow_rates if flow_rates is not None else {}
+        self.default_flow_gpm = default_flow_gpm
+        self.key_for = key_for or (lambda relay: str(relay.pinTag()))
+        self.max_zones = max_zones
+        self.flush_interval_s = flush_interval_s
+
+        self._fmt = '<I' + 'If' * max_zones
+        self._bucket_size = struct.calcsize(self._fmt)
+        self._header_size = 8 + KEY_BYTES * max_zones
+        self._keys = [] # zone key of every column
+        self._running = {} # relay -> (zone key, start ticks)
+        self._pending = {} # (kind, bucket number) -> [seconds..., gallons...]
+
+        self.writes = 0
+        self.dropped_s = 0 # runtime that could not be placed (no clock, no column)
+        self._open()
+
+    # --- file layout ---
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'r+b')
+            header = self._file.read(self._header_size)
+            if len(header) != self._header_size or header[:4] != MAGIC \
+                    or struct.unpack_from('<H', header, 4)[0] != self.max_zones:
+                raise ValueError('usage file header mismatch')
+            self._file.seek(0, 2)
+            if self._file.tell() != self._offset(_DAILY, DAILY_BUCKETS - 1) + self._bucket_size:
+                raise ValueError('usage file truncated')
+            for i in range(self.max_zones):
+                raw = header[8 + i * KEY_BYTES:8 + (i + 1) * KEY_BYTES]
+                key = bytes(raw).rstrip(b'\0').decode()
+                if key:
+                    self._keys.append(key)
+        except (OSError, ValueError) as e:
+            print(f"Creating usage file ({e}).")
+            try:
+                self._file.close()
+            except AttributeError:
+                pass
+            self._create()
+
+    def _create(self):
+        self._keys = []
+        self._file = open(self.path, 'w+b')
+        self._write_header()
+        empty = bytes(self._bucket_size)
+        for _ in range(HOURLY_BUCKETS + DAILY_BUCKETS):
+            self._file.write(empty)
+        self._file.flush()
+
+    def _write_header(self):
+        header = bytearray(self._header_size)
+        header[:4] = MAGIC
+        struct.pack_into('<H', header, 4, self.max_zones)
+        for i, key in enumerate(self._keys):
+            raw = key.encode()[:KEY_BYTES]
+            header[8 + i * KEY_BYTES:8 + i * KEY_BYTES + len(raw)] = raw
+        self._file.seek(0)
+        self._file.write(header)
+
+    def _offset(self, kind, number):
+        if kind == _HOURLY:
+            return self._header_size + (number % HOURLY_BUCKETS) * self._bucket_size
+        return self._header_size + (HOURLY_BUCKETS + number % DAILY_BUCKETS) \
+            * self._bucket_size
+
+    def _column(self, key):
+        key = key[:KEY_BYTES]
+        if key in self._keys:
+            return self._keys.index(key)
+        if len(self._keys) >= self.max_zones:
+            return None
+        self._keys.append(key)
+        self._write_header()
+        self._file.flush()
+        return len(self._keys) - 1
+
+    def _read_bucket(self, kind, number):
+        """Return the stored ``[seconds..., gallons...]`` of a bucket, zeros
+        if the slot holds another lap of the ring, plus pending updates."""
+        self._file.seek(self._offset(kind, number))
+        values = struct.unpack(self._fmt, self._file.read(self._bucket_size))
+        zones = self.max_zones
+        if values[0] == number:
+            result = [values[1 + 2 * i] for i in range(zones)] + \
+                     [values[2 + 2 * i] for i in range(zones)]
+        else:
+            result = [0] * (2 * zones)
+        pending = self._pending.get((kind, number))
+        if pending is not None:
+            for i in range(2 * zones):
+                result[i] += pending[i]
+        return result
+
+    # --- recording ---
+
+    def _local(self, utc):
+        return self.timezone.to_local(utc) if self.timezone is not None else utc
+
+    def flow_for(self, key):
+        return self.flow_rates.get(key, self.default_flow_gpm)
+
+    def on_relay_change(self, relay, is_on):
+        """Relay listener; see :meth:`Relay.add_listener`."""
+        if is_on:
+            if relay not in self._running:
+                key = self.key_for(relay)
+                if key is not None:
+                    self._running[relay] = (key, ticks_ms())
+        elif relay in self._running:
+            key, started = self._running.pop(relay)
+            self._account(key, ticks_diff(ticks_ms(), started) / 1000)
+
+    def _account(self, key, seconds):
+        """Add a run of ``seconds`` that ended now to the pending buckets."""
+        if seconds <= 0:
+            return
+        now = int(wall_time())
+        column = self._column(key) if time.gmtime(now)[0] >= MIN_VALID_YEAR else None
+        if column is None:
+            self.dropped_s += seconds
+            return
+        gallons_per_s = self.flow_for(key) / 60
+        end = self._local(now)
+        t = end - seconds
+        while t < end:
+            hour = int(t // 3600)
+            segment = min(end, (hour + 1) * 3600) - t
+            for kind, number in ((_HOURLY, hour), (_DAILY, hour // 24)):
+                pending = self._pending.get((kind, number))
+                if pending is None:
+                    pending = self._pending[(kind, number)] = [0] * (2 * self.max_zones)
+                pending[column] += segment
+                pending[self.max_zones + column] += segment * gallons_per_s
+            t += segment
+
+    def flush(self):
+        """Account the zones still running up to now and write the pending
+        buckets to the file."""
+        now = ticks_ms()
+        for relay, (key, started) in list(self._running.items()):
+            self._running[relay] = (key, now)
+            self._account(key, ticks_diff(now, started) / 1000)
+        pending = self._pending
+        if not pending:
+            return
+        zones = self.max_zones
+        packed = bytearray(self._bucket_size)
+        for (kind, number) in list(pending):
+            values = self._read_bucket(kind, number) # includes the pending values
+            del pending[(kind, number)]
+            args = [number]
+            for i in range(zones):
+                args.append(int(values[i] + 0.5))
+                args.append(values[zones + i])
+            struct.pack_into(self._fmt, packed, 0, *args)
+            self._file.seek(self._offset(kind, number))
+            self._file.write(packed)
+            self.writes += 1
+        self._file.flush()
+
+    async def run(self):
+        """The flush task."""
+        while True:
+            await asyncio.sleep(self.flush_interval_s)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Error writing usage file: {e}")
+
+    # --- reporting ---
+
+    def _sum(self, kind, first, last):
+        totals = [0] * (2 * self.max_zones)
+        for number in range(first, last + 1):
+            values = self._read_bucket(kind, number)
+            for i in range(len(totals)):
+                totals[i] += values[i]
+        return totals
+
+    def _by_zone(self, totals):
+        zones = self.max_zones
+        return {key: {'seconds': int(totals[i] + 0.5),
+                      'gallons': round(totals[zones + i], 2)}
+                for i, key in enumerate(self._keys)}
+
+    def summary(self):
+        """Return per-zone totals for today, the last 7, 30 and 365 days."""
+        today = int(self._local(int(wall_time())) // 86400)
+        return {
+            'today': self._by_zone(self._sum(_DAILY, today, today)),
+            'last_7_days': self._by_zone(self._sum(_DAILY, today - 6, today)),
+            'last_30_days': self._by_zone(self._sum(_DAILY, today - 29, today)),
+            'last_365_days': self._by_zone(self._sum(_DAILY, today - 364, today)),
+            'running': [self.key_for(relay) for relay in self._running],
+            'flow_gpm': {key: self.flow_for(key) for key in self._keys},
+            'writes': self.writes,
+            'dropped_s': int(self.dropped_s),
+        }
+
+    def series(self, kind, zone=None):
+        """Generate a JSON array of ``[start, zone, seconds, gallons]`` rows
+        for every non-empty bucket of the ring, oldest first. ``start`` is the
+        local start time of the bucket."""
+        size = HOURLY_BUCKETS if kind == _HOURLY else DAILY_BUCKETS
+        span = 3600 if kind == _HOURLY else 86400
+        last = int(self._local(int(wall_time())) // span)
+        zones = self.max_zones
+        yield '['
+        first_row = True
+        for number in range(last - size + 1, last + 1):
+            values = self._read_bucket(kind, number)
+            tm = time.gmtime(number * span)
+            start = '%04d-%02d-%02d %02d:00' % (tm[0], tm[1], tm[2], tm[3])
+            for i, key in enumerate(self._keys):
+                if values[i] == 0 or (zone is not None and key != zone):
+                    continue
+                row = '["%s", "%s", %d, %.2f]' % (start, key, int(values[i] + 0.5),
+                                                  values[zones + i])
+                yield row if first_row else ', ' + row
+                first_row = False
+        yield ']'
+
+    def install(self, app, url='/usage'):
+        """Register ``url`` (totals), ``url/hourly`` and ``url/daily``
+        (streamed buckets, optionally filtered with ``?zone=``)."""
+        @app.route(url)
+        async def usage(request):
+            return self.summary()
+
+        @app.route(url + '/<period>')
+        async def usage_series(request, period):
+            if period not in ('hourly', 'daily'):
+                return {'error': 'period must be hourly or daily'}, 404
+            kind = _HOURLY if period == 'hourly' else _DAILY
+            return self.series(kind, request.args.get('zone')), 200, \
+                {'Content-Type': 'application/json'}
+        return usage
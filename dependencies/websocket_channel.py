@@ -0,0 +1,358 @@
+"""
+WebSocket control channel for the app.
+
+A manual zone toggle over HTTP costs a new TCP connection plus a full request
+parse and response write. The app can instead open one WebSocket per session
+at ``/ws`` and send small JSON commands over it::
+
+    {"id": 7, "op": "on", "zone": "21"}
+    {"id": 8, "op": "status"}
+    {"id": 9, "op": "schedule", "zone": "21", "on": "06:00", "off": "06:30",
+     "days": ["Mon"]}
+
+Every command gets a reply carrying the same ``id`` (``"ok": true`` or an
+``"error"``). State changes are pushed without being asked: the channel is a
+relay listener and sends ``{"ev": "zone", "zone": "21", "on": true}`` to every
+open session, and a new session starts with a ``{"ev": "state", ...}``
+message holding the status of every zone.
+
+The operations themselves are registered by the application (see
+:meth:`ControlChannel.op`), so they share their code with the HTTP routes.
+When a :class:`metrics.Metrics` collector is given, every message is timed
+and recorded under a ``ws:<op>`` route label, next to the HTTP routes doing
+the same job.
+
+The handshake and framing follow RFC 6455 (text, binary, ping, pong, close
+and fragmented messages); the connection is taken over through Microdot's
+``Response.already_handled``.
+
+Example::
+
+    from websocket_channel import ControlChannel
+
+    channel = ControlChannel(key_for=registry.id_of, metrics=metrics)
+
+    @channel.op('on')
+    def zone_on(message):
+        registry.get(message['zone']).turn_on()
+        return {'status': 'On'}
+
+    Relay.add_listener(channel.on_relay_change)
+    channel.install(app)
+"""
+import asyncio
+import binascii
+import hashlib
+import json
+import struct
+
+from microdot import Response
+
+try:
+    from time import ticks_us, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from sys import print_exception # type: ignore
+except ImportError:
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exception(exc.__class__, exc, exc.__traceback__)
+
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+
+def accept_key(key):
+    """Return the ``Sec-WebSocket-Accept`` value for a client key."""
+    digest = hashlib.sha1(key.encode() + _GUID).digest()
+    return binascii.b2a_base64(digest).strip()
+
+
+def frame(opcode, payload=b''):
+    """Encode a single unmasked (server to client) frame."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class WebSocketError(Exception):
+    """The peer broke the protocol; carries the close code to send."""
+    def __init__(self, code, reason=''):
+        super().__init__(reason)
+        self.code = code
+
+
+class _Session:
+    """One open WebSocket. Replies and pushes go through an outbox drained by
+    a single writer task, so frames never interleave."""
+    def __init__(self, reader, writer, max_message, max_outbox):
+        self.reader = reader
+        self.writer = writer
+        self.max_message = max_message
+        self.max_outbox = max_outbox
+        self.outbox = []
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+    def send(self, opcode, payload, droppable=False):
+        if self.closed:
+            return
+        if droppable and len(self.outbox) >= self.max_outbox:
+            self.dropped += 1 # slow client: lose a push rather than the heap
+            return
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.outbox.append(frame(opcode, payload))
+        self.ready.set()
+
+    def close(self, code=CLOSE_NORMAL):
+        self.send(OP_CLOSE, struct.pack('!H', code))
+        self.closed = True
+        self.ready.set()
+
+    async def run_writer(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.outbox:
+                self.writer.write(self.outbox.pop(0))
+                await self.writer.drain()
+            if self.closed:
+                return
+
+    async def receive(self):
+        """Return the next text or binary message as ``(opcode, payload)``,
+        answering pings on the way, or ``None`` once the peer closed."""
+        message = None
+        message_opcode = None
+        while True:
+            header = await self.reader.readexactly(2)
+            fin = header[0] & 0x80
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if not header[1] & 0x80:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'client frames must be masked')
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            if length + (len(message) if message else 0) > self.max_message:
+                raise WebSocketError(CLOSE_TOO_BIG, 'message too big')
+            mask = await self.reader.readexactly(4)
+            payload = bytearray(await self.reader.readexactly(length)) if length else bytearray()
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+
+            if opcode == OP_PING:
+                self.send(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                pass
+            elif opcode == OP_CLOSE:
+                return None
+            elif opcode == OP_CONTINUATION:
+                if message is None:
+                    raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'unexpected continuation')
+                message += payload
+                if fin:
+                    return message_opcode, bytes(message)
+            elif opcode in (OP_TEXT, OP_BINARY):
+                if message is not None:
+                    raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'fragmented message interrupted')
+                if fin:
+                    return opcode, bytes(payload)
+                message, message_opcode = payload, opcode
+            else:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'unknown opcode')
+
+
+class ControlChannel:
+    """Serves zone commands and state pushes over WebSockets.
+
+    :param key_for: Function returning the zone key sent in pushes for a
+                    relay, or ``None`` for relays that are not pushed.
+                    Defaults to the pin tag as a string.
+    :param metrics: Optional :class:`metrics.Metrics` recording the latency
+                    of every message.
+    :param max_sessions: The number of sessions open at once.
+    :param max_message: The largest message accepted, in bytes.
+    :param max_outbox: The number of frames queued per session before pushes
+                       are dropped.
+    """
+    def __init__(self, key_for=None, metrics=None, max_sessions=2,
+                 max_message=512, max_outbox=16):
+        self.key_for = key_for or (lambda relay: str(relay.pinTag()))
+        self.metrics = metrics
+        self.max_sessions = max_sessions
+        self.max_message = max_message
+        self.max_outbox = max_outbox
+        self.ops = {}
+        self._sessions = []
+
+        self.sessions_opened = 0
+        self.rejected = 0
+        self.messages = 0
+        self.errors = 0
+        self.pushes = 0
+        self.dropped = 0
+
+    def op(self, name):
+        """Decorator registering ``handler(message)`` for operation ``name``.
+        The handler returns a dictionary merged into the reply (or ``None``)
+        and raises ``ValueError`` for a bad request or ``KeyError`` for
+        something that does not exist; the exception message is the error
+        sent back."""
+        def decorated(handler):
+            self.ops[name] = handler
+            return handler
+        return decorated
+
+    def on_relay_change(self, relay, is_on):
+        """Relay listener pushing the change to every open session."""
+        if not self._sessions:
+            return
+        key = self.key_for(relay)
+        if key is None:
+            return
+        payload = json.dumps({'ev': 'zone', 'zone': key, 'on': is_on})
+        for session in self._sessions:
+            session.send(OP_TEXT, payload, droppable=True)
+            self.pushes += 1
+
+    def _handle(self, session, data):
+        started = ticks_us()
+        op = '<invalid>'
+        reply = {}
+        status = 200
+        try:
+            message = json.loads(data)
+            if not isinstance(message, dict):
+                raise ValueError('message must be a JSON object')
+            if 'id' in message:
+                reply['id'] = message['id']
+            op = message.get('op')
+            handler = self.ops.get(op)
+            if handler is None:
+                status = 404
+                reply['error'] = f'unknown op {op}'
+                op = '<unknown>'
+            else:
+                result = handler(message)
+                if result:
+                    reply.update(result)
+                reply['ok'] = True
+        except KeyError as e:
+            status = 404
+            reply['error'] = e.args[0] if e.args else 'not found'
+        except ValueError as e:
+            status = 400
+            reply['error'] = str(e)
+        except Exception as e:
+            print_exception(e)
+            status = 500
+            reply['error'] = f'internal error: {e}'
+        if status != 200:
+            self.errors += 1
+        self.messages += 1
+        payload = json.dumps(reply)
+        session.send(OP_TEXT, payload)
+        if self.metrics is not None:
+            self.metrics.observe('ws:' + op, ticks_diff(ticks_us(), started),
+                                 status, len(data), len(payload))
+
+    def _greet(self, session):
+        status = self.ops.get('status')
+        if status is not None:
+            state = {'ev': 'state'}
+            state.update(status({}))
+            session.send(OP_TEXT, json.dumps(state))
+
+    async def serve(self, request):
+        """Upgrade ``request`` to a WebSocket and serve it until it closes."""
+        key = request.headers.get('Sec-WebSocket-Key')
+        if not key or request.headers.get('Upgrade', '').lower() != 'websocket':
+            return {'error': 'websocket upgrade required'}, 400
+        if len(self._sessions) >= self.max_sessions:
+            self.rejected += 1
+            return {'error': 'too many sessions'}, 503
+
+        reader, writer = request.sock
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept_key(key) + b'\r\n\r\n')
+        await writer.drain()
+
+        session = _Session(reader, writer, self.max_message, self.max_outbox)
+        self._sessions.append(session)
+        self.sessions_opened += 1
+        writer_task = asyncio.create_task(session.run_writer())
+        code = CLOSE_NORMAL
+        try:
+            self._greet(session)
+            while True:
+                message = await session.receive()
+                if message is None:
+                    break
+                self._handle(session, message[1])
+        except WebSocketError as e:
+            code = e.code
+        except (EOFError, OSError):
+            pass # the peer went away
+        finally:
+            self._sessions.remove(session)
+            self.dropped += session.dropped
+            session.close(code)
+        try:
+            await writer_task
+        except OSError:
+            pass
+        return Response.already_handled
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'sessions_opened': self.sessions_opened,
+            'rejected': self.rejected,
+            'messages': self.messages,
+            'errors': self.errors,
+            'pushes': self.pushes,
+            'dropped': self.dropped + sum(s.dropped for s in self._sessions),
+            'ops': sorted(self.ops),
+        }
+
+    def install(self, app, url='/ws'):
+        """Register the WebSocket endpoint at ``url`` and its statistics at
+        ``url/stats``."""
+        @app.route(url)
+        async def websocket(request):
+            return await self.serve(request)
+
+        @app.route(url + '/stats')
+        async def websocket_stats(request):
+            return self.stats()
+        return websocket
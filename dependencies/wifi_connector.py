@@ -1,7 +1,18 @@
+import binascii
+import json
 import network
 import time
 import sys
 
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
 """
 Connects your micropico to wifi based based off of entered password and ssid.
 Set password = your internet password
@@ -9,18 +20,68 @@ Set ssid = your internet ssid (internet name)
 
 and you will be able to connect to the internet
 
+Give it a cache_file and it remembers the access point, channel and address of
+the last good connection: the next connect() skips the interface reset and goes
+straight to that access point (optionally reusing the address, skipping DHCP),
+and only falls back to a full connect if that fails. The Pico W driver does not
+report the BSSID of the current connection, so after a full connect the access
+point and channel are taken from the strongest scan entry for the SSID.
+
 author: Dylan O'Connor
 """
 
 class Wifi_Connector:
-    def __init__(self, password='F@RG0000', ssid='DALEWOOD_5G') -> None:
+    def __init__(self, password='F@RG0000', ssid='DALEWOOD_5G', cache_file=None,
+                 static_ip=None, reuse_lease=False, fast_timeout_seconds=5) -> None:
         self.ssid = ssid
         self.password = password
         self.wlan = network.WLAN(network.STA_IF) # Initialize WLAN object here
+        self.on_wait = None # optional callback run on every wait in connect(), e.g. to feed a watchdog
+        self.on_result = None # optional callback(connected, wlan_status) run when connect() finishes
+        # Fast reconnect: the access point (BSSID), channel and address of the last
+        # good connection are kept in cache_file, and the next connect() goes straight
+        # to that access point before falling back to a full connect
+        self.cache_file = cache_file
+        self.static_ip = static_ip # optional (ip, subnet, gateway, dns) used instead of DHCP
+        self.reuse_lease = reuse_lease # fast path only: reuse the cached DHCP address, skipping DHCP
+        self.fast_timeout_seconds = fast_timeout_seconds
+        self._cache = None
+        # connect-time measurements, served by install()
+        self.last_connect_ms = None
+        self.last_path = None # 'resumed' (still connected), 'fast', 'full', or None after a failure
+        self.connects = {'resumed': 0, 'fast': 0, 'full': 0, 'failed': 0}
+        self.fast_fallbacks = 0
 
     def connect(self, timeout_seconds=30): # Added a timeout parameter
         SSID = self.ssid
         PASSWORD = self.password
+        started = ticks_ms()
+
+        # After a soft reset the radio is still associated: nothing to do
+        if self.wlan.active() and self.wlan.isconnected() and self._config('ssid') == SSID:
+            print(f"Still connected to WiFi '{SSID}'.")
+            return self._finish('resumed', started, self.wlan.status())
+
+        cache = self._load_cache()
+        reused_lease = False
+        if cache is not None:
+            # Fast path: no interface reset, straight to the cached access point
+            self.wlan.active(True)
+            ip_config = self.static_ip or (cache.get('ifconfig') if self.reuse_lease else None)
+            if ip_config:
+                self.wlan.ifconfig(tuple(ip_config))
+                reused_lease = not self.static_ip
+            print(f"Connecting to WiFi '{SSID}' via {cache.get('bssid') or 'the last access point'} "
+                  f"(channel {cache.get('channel')})...")
+            if cache.get('bssid'):
+                self.wlan.connect(SSID, PASSWORD, bssid=binascii.unhexlify(cache['bssid']))
+            else:
+                self.wlan.connect(SSID, PASSWORD)
+            connected, current_status = self._wait(self.fast_timeout_seconds)
+            if connected:
+                return self._finish('fast', started, current_status)
+            self.fast_fallbacks += 1
+            print("Fast reconnect failed, doing a full connect.")
 
         # Deactivate first to ensure a clean start, especially after a previous failed connection
         if self.wlan.active():
@@ -28,50 +89,158 @@ class Wifi_Connector:
             time.sleep(0.5) # Give it a moment to de-activate
 
         self.wlan.active(True)
+        if self.static_ip:
+            self.wlan.ifconfig(tuple(self.static_ip))
+        elif reused_lease:
+            self._restore_dhcp() # the cached address may be the reason it failed
 
         print(f"Connecting to WiFi '{SSID}'...")
         self.wlan.connect(SSID, PASSWORD)
+        connected, current_status = self._wait(timeout_seconds)
+        return self._finish('full' if connected else None, started, current_status)
 
-        start_time = time.time()
+    def _wait(self, timeout_seconds):
+        """Waits for the connection to come up; returns (connected, wlan_status)."""
+        start_time = ticks_ms()
+        polls = 0
         while True:
             current_status = self.wlan.status()
-            elapsed_time = time.time() - start_time
+            elapsed_time = ticks_diff(ticks_ms(), start_time) / 1000
 
             if self.wlan.isconnected():
                 print("\nConnected to WiFi!")
                 print("IP Address:", self.wlan.ifconfig()[0])
-                return True
-            
+                return True, current_status
+
             if elapsed_time > timeout_seconds:
                 print(f"\nConnection timed out after {timeout_seconds} seconds.")
                 # print final status for debugging
                 print(f"Final WLAN Status: {current_status}")
-                return False
+                return False, current_status
 
             # More informative status messages
-            if current_status == network.STAT_CONNECTING:
-                print(".", end="")
+            if current_status == network.STAT_CONNECTING or current_status == network.STAT_IDLE:
+                # STAT_IDLE could happen if it tried to connect and failed, but didn't give a specific error code yet
+                if polls % 10 == 0:
+                    print(".", end="") # Keep waiting
             elif current_status == network.STAT_WRONG_PASSWORD:
                 print("\nError: Wrong password!")
-                return False
+                return False, current_status
             elif current_status == network.STAT_NO_AP_FOUND:
                 print("\nError: No access point found (SSID may be incorrect or out of range).")
-                return False
+                return False, current_status
             elif current_status == network.STAT_CONNECT_FAIL:
                 print("\nError: Connection failed for an unknown reason.")
-                return False
-            elif current_status == network.STAT_IDLE:
-                # This could happen if it tried to connect and failed, but didn't give a specific error code yet
-                print(".", end="") # Keep waiting
-            else:
+                return False, current_status
+            elif polls % 10 == 0: # once a second, like the dots
                 print(f"\nUnexpected WLAN Status: {current_status}") # For any other status codes
-            
-            time.sleep(1)
 
-        # Fallback return (should be caught by the loop)
-        print("Failed to connect.")
-        return False
-    
+            if self.on_wait:
+                self.on_wait()
+            polls += 1
+            time.sleep(0.1) # short polls, so the connect time is measured to 100 ms
+
+    def _finish(self, path, started, status):
+        connected = path is not None
+        self.last_connect_ms = ticks_diff(ticks_ms(), started)
+        self.last_path = path
+        self.connects[path or 'failed'] += 1
+        if connected:
+            print(f"WiFi connect took {self.last_connect_ms} ms ({path}).")
+            if path == 'full':
+                self._save_cache(self._scan_ap())
+            elif path == 'fast':
+                self._save_cache((self._cache.get('bssid'), self._cache.get('channel')))
+        return self._result(connected, status)
+
+    def _result(self, connected, status):
+        if self.on_result:
+            self.on_result(connected, status)
+        return connected
+
+    def _config(self, name):
+        """Returns a WLAN config value, or None if this port does not report it."""
+        try:
+            return self.wlan.config(name)
+        except (ValueError, OSError, TypeError):
+            return None
+
+    def _restore_dhcp(self):
+        try:
+            self.wlan.ipconfig(dhcp4=True) # MicroPython 1.23+
+        except (AttributeError, ValueError, OSError, TypeError):
+            pass
+
+    def _load_cache(self):
+        if self.cache_file is None:
+            return None
+        if self._cache is None:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+        # the cache only helps for the network it was recorded on
+        return self._cache if self._cache.get('ssid') == self.ssid else None
+
+    def _scan_ap(self):
+        """Returns (bssid hex, channel) of the strongest access point for the SSID."""
+        if self.cache_file is None:
+            return None, None
+        try:
+            found = self.wlan.scan()
+        except OSError as e:
+            print(f"WiFi scan failed: {e}")
+            return None, self._config('channel')
+        ssid = self.ssid.encode()
+        best = None
+        for entry in found: # (ssid, bssid, channel, RSSI, security, hidden)
+            if entry[0] == ssid and (best is None or entry[3] > best[3]):
+                best = entry
+        if best is None:
+            return None, self._config('channel')
+        return binascii.hexlify(best[1]).decode(), best[2]
+
+    def _save_cache(self, ap):
+        if self.cache_file is None:
+            return
+        bssid, channel = ap
+        cache = {
+            'ssid': self.ssid,
+            'bssid': bssid,
+            'channel': channel,
+            'ifconfig': list(self.wlan.ifconfig()),
+        }
+        if cache == self._cache:
+            return # unchanged: spare the flash
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(cache, f)
+            self._cache = cache
+        except OSError as e:
+            print(f"Error saving WiFi cache: {e}")
+
+    def stats(self):
+        cache = self._load_cache() or {}
+        return {
+            'ssid': self.ssid,
+            'connected': self.wlan.isconnected(),
+            'ip': self.get_ip_address(),
+            'last_path': self.last_path,
+            'last_connect_ms': self.last_connect_ms,
+            'connects': self.connects,
+            'fast_fallbacks': self.fast_fallbacks,
+            'cached_bssid': cache.get('bssid'),
+            'cached_channel': cache.get('channel'),
+        }
+
+    def install(self, app, url='/wifi'):
+        """Register a route that returns :meth:`stats` as JSON."""
+        @app.route(url)
+        async def wifi(request):
+            return self.stats()
+        return wifi
+
     def get_ip_address(self) -> str | None:
         """
         Returns the IP address if connected, otherwise None.
@@ -0,0 +1,261 @@
+"""
+Zone sequencing: limits how many valves are open at once.
+
+Scheduled runs are requested with a zone and a duration. Up to
+``max_concurrent`` of them run at the same time; the rest wait in a FIFO queue
+and start, with their full duration, as soon as a slot frees up, so
+overlapping schedules are delayed in the order they were requested instead of
+dropping line pressure. Requesting a zone that is already queued or running
+just updates its duration rather than adding a second run.
+
+An optional master valve (or pump) relay is switched on ``master_lead_s``
+before the first zone opens and off ``master_lag_s`` after the last one
+closes.
+
+A single task drives the queue. It sleeps until the next run ends or a new
+request arrives; running runs sit in a heap keyed on their end time, so the
+cost of an update does not depend on how many runs are queued. Without
+asyncio (e.g. on the second core), call :meth:`ZoneQueue.poll` periodically
+instead.
+
+Example::
+
+    from zone_queue import ZoneQueue
+
+    queue = ZoneQueue(max_concurrent=1, master=pump_relay)
+    asyncio.create_task(queue.run())
+    queue.request(relay, 30 * 60)
+"""
+import asyncio
+import heapq
+from collections import deque
+
+try:
+    from time import ticks_ms, ticks_diff # type: ignore
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return time.monotonic_ns() // 1000000
+
+    def ticks_diff(end, start):
+        return end - start
+
+# index of the fields in a queued run entry
+_RELAY = 0
+_DURATION = 1
+_CANCELLED = 2
+
+
+class ZoneQueue:
+    """Runs zones for a given duration, at most ``max_concurrent`` at a time.
+
+    :param max_concurrent: The maximum number of zones open at once.
+    :param master: An optional master valve or pump relay.
+    :param master_lead_s: Seconds between opening the master and the zone.
+    :param master_lag_s: Seconds the master stays open after the last zone,
+                         so back-to-back runs do not cycle it.
+    :param max_pending: The maximum number of runs waiting in the queue.
+    """
+    def __init__(self, max_concurrent=1, master=None, master_lead_s=2,
+                 master_lag_s=5, max_pending=256):
+        self.max_concurrent = max_concurrent
+        self.master = master
+        self.master_lead_s = master_lead_s
+        self.master_lag_s = master_lag_s
+        self.max_pending = max_pending
+
+        self._pending = deque((), max_pending)
+        self._queued = {} # relay -> pending entry
+        self._ends = [] # heap of (end_ms, seq, relay)
+        self._active = {} # relay -> end_ms
+        self._seq = 0
+        self._idle_since = None
+        self._master_ready = None # when the master valve has been open long enough
+        self._wakeup = asyncio.Event()
+        self._elapsed_ms = 0
+        self._last_ticks = ticks_ms()
+
+        self.started = 0
+        self.completed = 0
+        self.delayed = 0
+        self.dropped = 0
+
+    def _now(self):
+        now = ticks_ms()
+        self._elapsed_ms += ticks_diff(now, self._last_ticks)
+        self._last_ticks = now
+        return self._elapsed_ms
+
+    def _peek(self):
+        """Return the current time like _now(), without advancing the
+        clock, so reading stats() changes nothing."""
+        return self._elapsed_ms + ticks_diff(ticks_ms(), self._last_ticks)
+
+    def owns(self, relay):
+        """Return ``True`` if ``relay`` is running or queued by this queue."""
+        return relay in self._active or relay in self._queued
+
+    def request(self, relay, duration_s):
+        """Queue a run of ``relay`` for ``duration_s`` seconds."""
+        if relay in self._active:
+            end = self._now() + duration_s * 1000
+            if end > self._active[relay]:
+                self._push_end(relay, end)
+            return
+        entry = self._queued.get(relay)
+        if entry is not None:
+            entry[_DURATION] = max(entry[_DURATION], duration_s)
+            return
+        if len(self._active) >= self.max_concurrent:
+            self.delayed += 1
+        if len(self._pending) >= self.max_pending:
+            self._compact()
+        if len(self._queued) >= self.max_pending:
+            self.dropped += 1
+            print(f"Zone queue full. Dropping run for {relay.pinTag()}.")
+            return
+        entry = [relay, duration_s, False]
+        self._queued[relay] = entry
+        self._pending.append(entry)
+        self._wakeup.set()
+
+    def cancel(self, relay):
+        """Remove ``relay`` from the queue and stop it if it is running."""
+        entry = self._queued.pop(relay, None)
+        if entry is not None:
+            entry[_CANCELLED] = True
+        if relay in self._active:
+            del self._active[relay] # its heap entry becomes stale
+            relay.turn_off()
+            self.completed += 1
+            self._wakeup.set()
+
+    def _compact(self):
+        """Drop the entries of cancelled runs from the pending deque, which
+        would otherwise push out live ones once it is full."""
+        pending = deque((), self.max_pending)
+        for entry in self._pending:
+            if not entry[_CANCELLED]:
+                pending.append(entry)
+        self._pending = pending
+
+    def on_relay_change(self, relay, is_on):
+        """Relay listener; frees the slot of a running zone that was turned
+        off by something else (the app, the interlock)."""
+        if not is_on and relay in self._active:
+            del self._active[relay]
+            self.completed += 1
+            self._wakeup.set()
+
+    def _push_end(self, relay, end):
+        self._active[relay] = end
+        self._seq += 1
+        heapq.heappush(self._ends, (end, self._seq, relay))
+
+    def _finish_expired(self, now):
+        ends = self._ends
+        while ends and ends[0][0] <= now:
+            end, _, relay = heapq.heappop(ends)
+            if self._active.get(relay) != end:
+                continue # cancelled or extended since
+            del self._active[relay]
+            relay.turn_off()
+            self.completed += 1
+            print(f"Queued run finished for {relay.pinTag()}")
+
+    def _next_pending(self):
+        while self._pending:
+            entry = self._pending.popleft()
+            if not entry[_CANCELLED]:
+                del self._queued[entry[_RELAY]]
+                return entry
+        return None
+
+    def _start_runs(self, now):
+        while len(self._active) < self.max_concurrent and self._queued:
+            if self.master is not None:
+                if self.master.status() != "On":
+                    self.master.turn_on()
+                    self._master_ready = now + self.master_lead_s * 1000
+                if now < self._master_ready:
+                    return # let the line pressurize first
+            entry = self._next_pending()
+            if entry is None:
+                break
+            relay = entry[_RELAY]
+            relay.turn_on()
+            self._push_end(relay, self._now() + entry[_DURATION] * 1000)
+            self.started += 1
+            print(f"Queued run started for {relay.pinTag()} ({entry[_DURATION]} s)")
+
+    def _timeout_s(self, now):
+        """Return how long the task may sleep before something is due."""
+        timeout = None
+        if self._ends:
+            timeout = max(0, self._ends[0][0] - now) / 1000
+        if self._idle_since is not None:
+            lag = max(0, self._idle_since + self.master_lag_s * 1000 - now) / 1000
+            timeout = lag if timeout is None else min(timeout, lag)
+        if self._queued and self._master_ready is not None and self._master_ready > now:
+            lead = (self._master_ready - now) / 1000
+            timeout = lead if timeout is None else min(timeout, lead)
+        return timeout
+
+    def poll(self):
+        """Finish expired runs, start queued ones and switch the master
+        valve. Returns the seconds until something is due, or ``None`` if
+        nothing is until the next request."""
+        now = self._now()
+        self._finish_expired(now)
+        self._start_runs(now)
+
+        # close the master valve once the zones have been idle long enough
+        if self.master is not None and not self._active and not self._queued \
+                and self.master.status() == "On":
+            if self._idle_since is None:
+                self._idle_since = now
+            elif now - self._idle_since >= self.master_lag_s * 1000:
+                self.master.turn_off()
+                self._idle_since = None
+                self._master_ready = None
+        else:
+            self._idle_since = None
+        return self._timeout_s(now)
+
+    async def run(self):
+        """The queue task."""
+        while True:
+            self._wakeup.clear()
+            timeout = self.poll()
+            try:
+                if timeout is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        now = self._peek()
+        return {
+            'max_concurrent': self.max_concurrent,
+            'active': [{'zone': relay.pinTag(),
+                        'remaining_s': max(0, end - now) // 1000}
+                       for relay, end in self._active.items()],
+            'queued': [{'zone': entry[_RELAY].pinTag(),
+                        'duration_s': entry[_DURATION]}
+                       for entry in self._pending if not entry[_CANCELLED]],
+            'master': self.master.pinTag() if self.master is not None else None,
+            'started': self.started,
+            'completed': self.completed,
+            'delayed': self.delayed,
+            'dropped': self.dropped,
+        }
+
+    def install(self, app, url='/queue'):
+        """Register a route that returns :meth:`stats` as JSON."""
+        @app.route(url)
+        async def queue(request):
+            return self.stats()
+        return queue
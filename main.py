@@ -0,0 +1,14 @@
+"""
+Boot script of the Pico: selects the code slot to run (see
+dependencies/ota.py) and starts PicoSprinkler from it.
+
+Upload it and ota.py (with hmac_sha256.py) to the root of the Pico once;
+everything else can then be updated over the air with tools/ota_push.py.
+"""
+import ota
+
+ota.activate() # puts the active slot first on sys.path, rolls back a failed update
+
+import web_server # noqa: E402 (imported from the active slot)
+
+web_server.run()
@@ -0,0 +1,127 @@
+"""
+Measures what token checking adds to a request on ``/status``.
+
+Feeds the same ``GET /status/21`` through ``Microdot.handle_request`` from
+memory, first without authentication, then with a token checked by
+:class:`session_auth.SessionAuth` with the verification cache off (the
+HMAC-SHA256 is computed on every request) and on (computed once), and
+reports requests per second and the microseconds each check adds.
+
+Runs from the repository root under CPython or MicroPython (unix port, or
+on the Pico with ``mpremote run``)::
+
+    python tools/auth_bench.py --requests 5000
+    micropython tools/auth_bench.py
+
+Writes a scratch ``auth_bench.json`` settings file in the current directory
+and removes it at the end.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, 'dependencies')
+
+from microdot import Microdot, AsyncBytesIO # noqa: E402
+from config_store import ConfigStore, MIGRATIONS # noqa: E402
+from session_auth import SessionAuth # noqa: E402
+
+SETTINGS_FILE = 'auth_bench.json'
+
+
+class _Writer:
+    def __init__(self):
+        self.sent = 0
+        self.status_line = None
+
+    async def awrite(self, data):
+        if self.status_line is None:
+            self.status_line = bytes(data)
+        self.sent += len(data)
+
+    async def aclose(self):
+        pass
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 40000)
+
+
+def make_app(auth=None):
+    app = Microdot()
+    if auth is not None:
+        auth.install(app)
+
+    @app.route('/status/<zone>')
+    async def status(request, zone):
+        return 'Off', 200
+    return app
+
+
+def make_request(token):
+    return b'GET /status/21 HTTP/1.0\r\nHost: pico\r\nAuthorization: Bearer ' + \
+        token.encode() + b'\r\n\r\n'
+
+
+async def run(app, request, count):
+    writer = _Writer()
+    for _ in range(count):
+        await app.handle_request(AsyncBytesIO(request), writer)
+    return writer
+
+
+def _now_us():
+    if hasattr(time, 'ticks_us'):
+        return time.ticks_us()
+    return int(time.perf_counter() * 1000000)
+
+
+def _elapsed_us(started):
+    if hasattr(time, 'ticks_diff'):
+        return time.ticks_diff(time.ticks_us(), started)
+    return _now_us() - started
+
+
+def measure(label, app, request, count):
+    writer = asyncio.run(run(app, request, 1))
+    if writer.status_line is None or b' 200' not in writer.status_line:
+        raise RuntimeError('request failed: {}'.format(writer.status_line))
+    asyncio.run(run(app, request, 50)) # warm up
+    started = _now_us()
+    asyncio.run(run(app, request, count))
+    elapsed = _elapsed_us(started)
+    return {'mode': label, 'requests_per_s': int(count * 1000000 / elapsed) if elapsed else 0,
+            'us_per_request': elapsed // count}
+
+
+def main():
+    count = 2000
+    if '--requests' in sys.argv:
+        count = int(sys.argv[sys.argv.index('--requests') + 1])
+    try:
+        skip = {version: lambda values: values for version in MIGRATIONS} # no legacy import
+        config = ConfigStore(SETTINGS_FILE, migrations=skip)
+        auth = SessionAuth(config)
+        auth.set_password('benchmark')
+        token, _ = auth.issue()
+        # the same request every time, so only the check itself differs
+        results = [measure('no auth', make_app(), make_request(token), count)]
+        for cache_size in (0, 8):
+            auth = SessionAuth(config, cache_size=cache_size)
+            results.append(measure('token, cache {}'.format(cache_size),
+                                   make_app(auth), make_request(token), count))
+            results[-1]['signatures_computed'] = auth.verified
+    finally:
+        for path in (SETTINGS_FILE, SETTINGS_FILE + '.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    baseline = results[0]['us_per_request']
+    for result in results:
+        result['auth_overhead_us'] = result['us_per_request'] - baseline
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
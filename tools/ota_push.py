@@ -0,0 +1,123 @@
+"""
+Builds a code bundle and uploads it to the Pico's ``/ota`` route.
+
+The bundle is an uncompressed ustar archive of ``web_server.py``, the
+``dependencies`` modules and the ``www`` folder (``main.py``, ``ota.py`` and
+``hmac_sha256.py`` stay on the device root and are left out). It is sent
+with its SHA-256 digest and an HMAC-SHA256 of that digest under the device
+key, the same key as the Pico's ``ota.key`` file. The signature also covers
+a bundle version, the current time unless ``--version`` is given, which must
+be higher than the last one the Pico accepted. ``--reboot`` resets the board
+once the bundle is staged, so the new code boots on trial.
+
+Usage::
+
+    python tools/ota_push.py 192.168.1.50 --key-file ota.key --reboot
+    python tools/ota_push.py 192.168.1.50 --key-file ota.key --chunked
+    python tools/ota_push.py --output bundle.tar # only build the bundle
+
+Only needs the standard library.
+"""
+import argparse
+import hashlib
+import hmac
+import http.client
+import io
+import json
+import os
+import tarfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAY_ON_ROOT = ('main.py', 'dependencies/ota.py', 'dependencies/hmac_sha256.py')
+
+
+def bundle_files(root=ROOT):
+    files = ['web_server.py']
+    for folder in ('dependencies', 'www'):
+        for name in sorted(os.listdir(os.path.join(root, folder))):
+            path = folder + '/' + name
+            if os.path.isfile(os.path.join(root, path)) and \
+                    not name.endswith('.pyc') and path not in STAY_ON_ROOT:
+                files.append(path)
+    return files
+
+
+def build_bundle(files, root=ROOT):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for path in files:
+            info = tar.gettarinfo(os.path.join(root, path), arcname=path)
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            with open(os.path.join(root, path), 'rb') as f:
+                tar.addfile(info, f)
+    return buffer.getvalue()
+
+
+def chunks(data, size=1024):
+    for i in range(0, len(data), size):
+        piece = data[i:i + size]
+        yield b'%x\r\n' % len(piece) + piece + b'\r\n'
+    yield b'0\r\n\r\n'
+
+
+def upload(host, port, bundle, key, version, reboot=False, chunked=False, timeout=60):
+    digest = hashlib.sha256(bundle).hexdigest()
+    signed = f'{digest}.{version}'.encode()
+    headers = {
+        'Content-Type': 'application/x-tar',
+        'X-OTA-SHA256': digest,
+        'X-OTA-Version': str(version),
+        'X-OTA-Signature': hmac.new(key, signed, hashlib.sha256).hexdigest(),
+    }
+    if chunked:
+        headers['Transfer-Encoding'] = 'chunked'
+        body = b''.join(chunks(bundle))
+    else:
+        headers['Content-Length'] = str(len(bundle))
+        body = bundle
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    connection.request('POST', '/ota' + ('?reboot=1' if reboot else ''),
+                       body=body, headers=headers)
+    response = connection.getresponse()
+    reply = json.loads(response.read() or b'{}')
+    connection.close()
+    return response.status, reply
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('host', nargs='?')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--key-file', default='ota.key')
+    parser.add_argument('--reboot', action='store_true', help='reset the board once staged')
+    parser.add_argument('--chunked', action='store_true',
+                        help='send with Transfer-Encoding: chunked')
+    parser.add_argument('--version', type=int, default=int(time.time()),
+                        help='bundle version, higher than the last one uploaded '
+                             '(default: the current time)')
+    parser.add_argument('--output', help='write the bundle to this file instead')
+    args = parser.parse_args()
+
+    files = bundle_files()
+    bundle = build_bundle(files)
+    print(f'{len(files)} files, {len(bundle)} bytes, '
+          f'sha256 {hashlib.sha256(bundle).hexdigest()}')
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(bundle)
+        return
+    if not args.host:
+        parser.error('host required unless --output is given')
+    with open(args.key_file, 'rb') as f:
+        key = f.read().strip()
+    status, reply = upload(args.host, args.port, bundle, key, args.version,
+                           args.reboot, args.chunked)
+    print(status, reply)
+    if status != 200:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Measures the allocation pressure of the Microdot request cycle with and
+without request/response pooling.
+
+Feeds the same mix of requests (a JSON route, a text route with a query
+string, a JSON POST) through ``Microdot.handle_request`` from memory, first
+with ``pool_size = 0`` and then with pooling on, and reports per 1000
+requests:
+
+* under CPython, the garbage collections run (all generations),
+* under MicroPython, the heap bytes allocated, measured with the collector
+  off, and the collections that would take at the collector's threshold.
+
+Runs from the repository root under CPython or MicroPython (unix port, or
+on the Pico with ``mpremote run``)::
+
+    python tools/pool_bench.py --requests 5000
+    micropython tools/pool_bench.py
+"""
+import asyncio
+import gc
+import sys
+import time
+
+sys.path.insert(0, 'dependencies')
+
+from microdot import Microdot, AsyncBytesIO # noqa: E402
+
+_BODY = b'{"on": "06:00", "off": "06:30"}'
+REQUESTS = (
+    b'GET /status/21 HTTP/1.0\r\nHost: pico\r\n\r\n',
+    b'GET /events?since=10&limit=5 HTTP/1.0\r\nHost: pico\r\n'
+    b'Accept: */*\r\n\r\n',
+    b'POST /schedule/21 HTTP/1.0\r\nHost: pico\r\n'
+    b'Content-Type: application/json\r\nContent-Length: ' +
+    str(len(_BODY)).encode() + b'\r\n\r\n' + _BODY,
+)
+
+
+class _Writer:
+    def __init__(self):
+        self.sent = 0
+        self.status_line = None
+
+    async def awrite(self, data):
+        if self.status_line is None:
+            self.status_line = bytes(data)
+        self.sent += len(data)
+
+    async def aclose(self):
+        pass
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 40000)
+
+
+def make_app():
+    app = Microdot()
+
+    @app.route('/status/<zone>')
+    async def status(request, zone):
+        return {'zone': zone, 'status': 'On'}
+
+    @app.route('/events')
+    async def events(request):
+        return 'since {} limit {}'.format(request.args.get('since'),
+                                          request.args.get('limit'))
+
+    @app.route('/schedule/<zone>', methods=['POST'])
+    async def schedule(request, zone):
+        return {'zone': zone, 'ok': request.json is not None}, 201
+    return app
+
+
+async def run(app, count):
+    writer = _Writer()
+    for i in range(count):
+        await app.handle_request(AsyncBytesIO(REQUESTS[i % len(REQUESTS)]),
+                                 writer)
+    return writer.sent
+
+
+async def check(app):
+    """Make sure every benchmark request succeeds."""
+    for request in REQUESTS:
+        writer = _Writer()
+        await app.handle_request(AsyncBytesIO(request), writer)
+        if writer.status_line is None or b' 2' not in writer.status_line[:10]:
+            raise RuntimeError('request failed: {} -> {}'.format(
+                request.split(b'\r\n')[0], writer.status_line))
+
+
+def _collections():
+    if hasattr(gc, 'get_stats'):
+        return sum(generation['collections'] for generation in gc.get_stats())
+    return None
+
+
+def measure(pool_size, count):
+    app = make_app()
+    app.pool_size = pool_size
+    asyncio.run(check(app))
+    asyncio.run(run(app, 50)) # warm up the pools and the route table
+    gc.collect()
+    result = {'pool_size': pool_size}
+    if hasattr(gc, 'mem_alloc'):
+        gc.disable()
+        before = gc.mem_alloc()
+        started = time.ticks_ms()
+        asyncio.run(run(app, count))
+        elapsed = time.ticks_diff(time.ticks_ms(), started) / 1000
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        gc.collect()
+        result['bytes_per_request'] = allocated // count
+        threshold = gc.threshold() if hasattr(gc, 'threshold') else -1
+        if threshold and threshold > 0:
+            result['collections_per_1000'] = allocated * 1000 // count // threshold
+    else:
+        before = _collections()
+        started = time.perf_counter()
+        asyncio.run(run(app, count))
+        elapsed = time.perf_counter() - started
+        result['collections_per_1000'] = (_collections() - before) * 1000 / count
+    result['requests_per_s'] = int(count / elapsed) if elapsed else 0
+    result['pool_hits'] = app.pool_hits
+    return result
+
+
+def main():
+    count = 2000
+    if '--requests' in sys.argv:
+        count = int(sys.argv[sys.argv.index('--requests') + 1])
+    for pool_size in (0, 4):
+        print(measure(pool_size, count))
+
+
+if __name__ == '__main__':
+    main()
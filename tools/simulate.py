@@ -0,0 +1,478 @@
+"""
+Time-accelerated simulator for the PicoSprinkler scheduling logic.
+
+Runs the real ``web_server.py`` scheduling path (schedule checker, reconciler,
+zone queue, runtime interlock and usage recorder) under CPython against a
+virtual clock, with stub ``machine``, ``network`` and ``utime`` modules. The
+asyncio event loop never really sleeps: whenever it would wait, the virtual
+clock jumps straight to the next timer, so a year of schedules (DST changes,
+windows spanning midnight, reboots) runs in seconds.
+
+Prints a per-zone summary and the simulation speed in simulated days per
+second, which doubles as a regression benchmark for the scheduling code.
+``--check`` also fails (exit status 1) if any run outlasted the interlock's
+limit for its zone. ``ticks_ms`` wraps around every 2**30 ms (12.4 days) as
+on the rp2 port, so code that sleeps for days between two ticks readings is
+exercised too.
+
+Usage::
+
+    python tools/simulate.py                          # built-in schedules, one year
+    python tools/simulate.py -s schedules.json --days 30 --reboot-every 72
+    python tools/simulate.py --timeline timeline.csv --json summary.json
+    python tools/simulate.py -s weekly.json --days 60 --check
+
+The schedules file has the same format as the ``schedules`` entry of the
+device's ``settings.json`` (and its ``schedules.json`` before that).
+"""
+import argparse
+import asyncio
+import calendar
+import io
+import json
+import os
+import selectors
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ticks_ms() and ticks_diff() of the MicroPython ports: the counter wraps
+# around, and differences are valid up to half the period (6.2 days)
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+# exercises a plain morning window, one that spans midnight and two zones
+# overlapping so the zone queue has to delay one of them
+DEFAULT_SCHEDULES = {
+    "21": {"turn_on_time": "06:00", "turn_off_time": "06:30",
+           "days": ["Mon", "Wed", "Fri"]},
+    "LED": {"turn_on_time": "23:45", "turn_off_time": "00:15",
+            "days": ["Sat", "Sun"]},
+    "22": {"turn_on_time": "06:10", "turn_off_time": "06:20",
+           "days": ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]},
+}
+
+
+class VirtualClock:
+    """The simulated wall clock and the monotonic clock since the last boot."""
+    def __init__(self, utc):
+        self.utc = float(utc)
+        self.boot_utc = self.utc
+
+    def boot(self):
+        self.boot_utc = self.utc
+
+    def advance(self, seconds):
+        self.utc += seconds
+
+    def monotonic(self):
+        return self.utc - self.boot_utc
+
+    def time(self):
+        return int(self.utc)
+
+    def ticks_ms(self):
+        return int(self.monotonic() * 1000) & TICKS_MAX
+
+    def ticks_us(self):
+        return int(self.monotonic() * 1000000) & TICKS_MAX
+
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """Never blocks: a wait for ``timeout`` seconds advances the clock."""
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if not ready:
+            if timeout is None:
+                raise RuntimeError('simulation deadlock: nothing is scheduled')
+            if timeout > 0:
+                self._clock.advance(timeout)
+        return ready
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(_VirtualSelector(clock))
+        self._clock = clock
+        # timers due within a millisecond run now; after months of virtual
+        # time the default (1 ns) is below the float resolution of time(),
+        # and a timer due "now" would never be considered ready
+        self._clock_resolution = 0.001
+
+    def time(self):
+        return self._clock.monotonic()
+
+
+class _Pin:
+    OUT = 1
+    IN = 0
+    state = {} # pin id -> value, shared like the real GPIO block
+
+    def __init__(self, pin_id, mode=None, value=None):
+        self.id = pin_id
+        if value is not None:
+            self.value(value)
+
+    def on(self):
+        _Pin.state[self.id] = 1
+
+    def off(self):
+        _Pin.state[self.id] = 0
+
+    def value(self, v=None):
+        if v is None:
+            return _Pin.state.get(self.id, 0)
+        _Pin.state[self.id] = 1 if v else 0
+
+
+class _WLAN:
+    def __init__(self, interface=None):
+        self._active = False
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = value
+
+    def isconnected(self):
+        return False
+
+    def status(self):
+        return 0
+
+    def connect(self, *args):
+        pass
+
+    def config(self, *args, **kwargs):
+        pass
+
+    def ifconfig(self, *args):
+        return ('0.0.0.0', '0.0.0.0', '0.0.0.0', '0.0.0.0')
+
+    def disconnect(self):
+        pass
+
+
+def install_stubs(clock):
+    """Put stand-ins for the MicroPython-only modules into ``sys.modules``.
+
+    ``ticks_ms``/``ticks_us``/``ticks_diff`` are added to the ``time`` module
+    so that ``from time import ticks_ms`` in the dependencies picks up the
+    virtual clock, exactly as it picks up the real one on MicroPython.
+    """
+    machine = types.ModuleType('machine')
+    machine.Pin = _Pin
+    machine.PWRON_RESET = 1
+    machine.WDT_RESET = 3
+    machine.reset_cause = lambda: machine.PWRON_RESET
+
+    class WDT:
+        def __init__(self, timeout=0):
+            pass
+
+        def feed(self):
+            pass
+    machine.WDT = WDT
+
+    class RTC:
+        def datetime(self, value=None):
+            if value is not None:
+                year, month, day, _, hour, minute, second, _ = value
+                clock.utc = calendar.timegm((year, month, day, hour, minute, second))
+    machine.RTC = RTC
+
+    network = types.ModuleType('network')
+    network.WLAN = _WLAN
+    network.STA_IF, network.AP_IF = 0, 1
+    for i, name in enumerate(('STAT_IDLE', 'STAT_CONNECTING', 'STAT_WRONG_PASSWORD',
+                              'STAT_NO_AP_FOUND', 'STAT_CONNECT_FAIL', 'STAT_GOT_IP')):
+        setattr(network, name, i)
+
+    utime = types.ModuleType('utime')
+    utime.time = clock.time
+    utime.gmtime = time.gmtime
+    utime.localtime = time.gmtime
+    utime.sleep = clock.advance
+    utime.ticks_ms = clock.ticks_ms
+    utime.ticks_us = clock.ticks_us
+    utime.ticks_diff = ticks_diff
+
+    time.ticks_ms = clock.ticks_ms
+    time.ticks_us = clock.ticks_us
+    time.ticks_diff = utime.ticks_diff
+
+    sys.modules.update({
+        'machine': machine,
+        'network': network,
+        'utime': utime,
+        'ujson': json,
+        'uasyncio': asyncio,
+    })
+    sys.path.insert(0, os.path.join(ROOT, 'dependencies'))
+    sys.path.insert(0, ROOT)
+
+
+def _purge_device_modules():
+    """Forget everything imported from the repo, so the next import is a
+    fresh boot."""
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None) or ''
+        if path.startswith(ROOT) and name != __name__:
+            del sys.modules[name]
+
+
+class _NullWriter(io.TextIOBase):
+    def write(self, s):
+        return len(s)
+
+
+class Timeline:
+    """Records every relay transition as ``(utc, zone, is_on)``."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+        self._on = {} # zone -> utc it was switched on
+
+    def on_relay_change(self, relay, is_on):
+        zone = str(relay.pinTag())
+        if is_on == (zone in self._on):
+            return # repeated command, no transition
+        now = self.clock.time()
+        self.events.append((now, zone, is_on))
+        if is_on:
+            self._on[zone] = now
+        else:
+            del self._on[zone]
+
+    def power_loss(self):
+        for zone in list(self._on):
+            self.events.append((self.clock.time(), zone, False))
+            del self._on[zone]
+
+    def runs(self):
+        """Return ``{zone: [(start_utc, seconds), ...]}``."""
+        started = {}
+        runs = {}
+        for utc, zone, is_on in self.events:
+            if is_on:
+                started[zone] = utc
+            elif zone in started:
+                runs.setdefault(zone, []).append((started[zone], utc - started.pop(zone)))
+        for zone, utc in started.items():
+            runs.setdefault(zone, []).append((utc, self.clock.time() - utc))
+        return runs
+
+
+class Simulator:
+    def __init__(self, schedules, start_utc, days, reboot_every_h=None,
+                 downtime_s=30, timezone=None, verbose=False):
+        self.schedules = schedules
+        self.start_utc = start_utc
+        self.end_utc = start_utc + days * 86400
+        self.days = days
+        self.reboot_every_s = reboot_every_h * 3600 if reboot_every_h else None
+        self.downtime_s = downtime_s
+        self.timezone = timezone
+        self.verbose = verbose
+        self.clock = VirtualClock(start_utc)
+        self.timeline = Timeline(self.clock)
+        self.boots = 0
+        self.ws = None
+        self.stats = {}
+
+    def _boot(self):
+        """Import ``web_server`` from scratch, as after a power cycle."""
+        _purge_device_modules()
+        _Pin.state.clear()
+        self.clock.boot()
+        self.boots += 1
+        import web_server as ws
+        if self.timezone:
+            ws._TIMEZONE = ws.Timezone(self.timezone)
+            ws._RECONCILER.timezone = ws._TIMEZONE
+            ws._USAGE.timezone = ws._TIMEZONE
+        # relays the schedules refer to but the firmware does not define yet
+        for key in self.schedules:
+            if ws.relay_for_key(key) is None and key.isdigit():
+                ws._RELAYS.add({"id": int(key), "name": f"Zone {key}", "pin": int(key)})
+        ws.Relay.add_listener(self.timeline.on_relay_change)
+        self.ws = ws
+        return ws
+
+    async def _run_until(self, ws, until_utc):
+        """The part of ``main_loop`` that drives the zones."""
+        ws._WATCHDOG.boot_check(ws.turn_off_all_relays)
+        ws.load_schedules()
+        tasks = [
+            asyncio.create_task(ws._PROFILER.task('schedule_checker', ws.schedule_checker())),
+            asyncio.create_task(ws._INTERLOCK.run()),
+            asyncio.create_task(ws._PROFILER.task('zone_queue', ws._ZONE_QUEUE.run())),
+            asyncio.create_task(ws._USAGE.run()),
+        ]
+        await asyncio.sleep(until_utc - self.clock.utc)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _collect_stats(self, ws):
+        for name, value in (('reconciler', ws._RECONCILER.stats()),
+                            ('interlock', ws._INTERLOCK.stats()),
+                            ('queue', ws._ZONE_QUEUE.stats())):
+            totals = self.stats.setdefault(name, {})
+            for key, v in value.items():
+                if isinstance(v, int) and not isinstance(v, bool):
+                    totals[key] = totals.get(key, 0) + v
+
+    def run(self):
+        workdir = tempfile.mkdtemp(prefix='picosprinkler-sim-')
+        # the format of earlier firmware, imported by the config store on the first boot
+        with open(os.path.join(workdir, 'schedules.json'), 'w') as f:
+            json.dump(self.schedules, f)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        started = time.perf_counter()
+        try:
+            while self.clock.utc < self.end_utc:
+                until = self.end_utc
+                if self.reboot_every_s:
+                    until = min(until, self.clock.utc + self.reboot_every_s)
+                out = sys.stdout if self.verbose else _NullWriter()
+                real_stdout, sys.stdout = sys.stdout, out
+                try:
+                    ws = self._boot()
+                    loop = VirtualTimeLoop(self.clock)
+                    try:
+                        loop.run_until_complete(self._run_until(ws, until))
+                    finally:
+                        loop.close()
+                finally:
+                    sys.stdout = real_stdout
+                self._collect_stats(ws)
+                if until < self.end_utc:
+                    self.timeline.power_loss()
+                    self.clock.advance(self.downtime_s)
+        finally:
+            os.chdir(cwd)
+        self.elapsed_s = time.perf_counter() - started
+        return self.summary()
+
+    def local(self, utc):
+        tm = self.ws._TIMEZONE.localtime(utc)
+        return '%04d-%02d-%02d %02d:%02d:%02d' % tm[:6]
+
+    def summary(self):
+        zones = {}
+        for zone, runs in sorted(self.timeline.runs().items()):
+            zones[zone] = {
+                'runs': len(runs),
+                'on_minutes': sum(seconds for _, seconds in runs) // 60,
+                'shortest_run_s': min(seconds for _, seconds in runs),
+                'longest_run_s': max(seconds for _, seconds in runs),
+                'first_run': self.local(runs[0][0]),
+                'last_run': self.local(runs[-1][0]),
+            }
+        return {
+            'days': self.days,
+            'boots': self.boots,
+            'transitions': len(self.timeline.events),
+            'zones': zones,
+            'reconciler': self.stats.get('reconciler', {}),
+            'interlock_trips': self.stats.get('interlock', {}).get('trip_count', 0),
+            'queue': self.stats.get('queue', {}),
+            'elapsed_s': round(self.elapsed_s, 3),
+            'simulated_days_per_s': round(self.days / self.elapsed_s, 1),
+        }
+
+    def overlong_runs(self):
+        """Return the runs that lasted longer than the interlock lets a zone
+        stay on (its limit plus the wheel's rounding), as ``(zone, start,
+        seconds, limit)``."""
+        interlock = self.ws._INTERLOCK
+        overlong = []
+        for zone, runs in sorted(self.timeline.runs().items()):
+            relay = self.ws.relay_for_key(zone)
+            if relay is None:
+                continue
+            limit = interlock.limit_for(relay)
+            for start, seconds in runs:
+                if seconds > limit + 2 * interlock.tick_s:
+                    overlong.append((zone, self.local(start), seconds, limit))
+        return overlong
+
+    def write_timeline(self, path):
+        with open(path, 'w') as f:
+            f.write('utc,local,zone,state\n')
+            for utc, zone, is_on in self.timeline.events:
+                f.write(f"{utc},{self.local(utc)},{zone},{'on' if is_on else 'off'}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-s', '--schedules', help='schedules.json to simulate '
+                        '(default: a built-in set)')
+    parser.add_argument('--start', default='2025-01-01',
+                        help='UTC start date, YYYY-MM-DD (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--tz', help='POSIX TZ rule (default: TIMEZONE in web_server.py)')
+    parser.add_argument('--reboot-every', type=float, metavar='HOURS',
+                        help='power cycle the board every HOURS hours')
+    parser.add_argument('--downtime', type=int, default=30, metavar='SECONDS',
+                        help='time the board is off during a reboot (default: %(default)s)')
+    parser.add_argument('--timeline', metavar='CSV', help='write every relay transition to CSV')
+    parser.add_argument('--json', metavar='FILE', help='write the summary as JSON')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if a run outlasted its interlock limit')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the firmware output')
+    args = parser.parse_args(argv)
+
+    schedules = DEFAULT_SCHEDULES
+    if args.schedules:
+        with open(args.schedules) as f:
+            schedules = json.load(f)
+    start = calendar.timegm(time.strptime(args.start, '%Y-%m-%d'))
+
+    sim = Simulator(schedules, start, args.days, reboot_every_h=args.reboot_every,
+                    downtime_s=args.downtime, timezone=args.tz, verbose=args.verbose)
+    clock = sim.clock
+    install_stubs(clock)
+    summary = sim.run()
+
+    for zone, z in summary['zones'].items():
+        print(f"zone {zone:>4}: {z['runs']:4d} runs, {z['on_minutes']:6d} min on, "
+              f"run {z['shortest_run_s']}-{z['longest_run_s']} s, "
+              f"first {z['first_run']}, last {z['last_run']}")
+    print(f"{summary['boots']} boot(s), {summary['transitions']} transitions, "
+          f"{summary['interlock_trips']} interlock trip(s), "
+          f"{summary['reconciler'].get('clock_jumps', 0)} clock jump(s)")
+    print(f"{summary['days']} days in {summary['elapsed_s']} s: "
+          f"{summary['simulated_days_per_s']} simulated days/s")
+
+    if args.timeline:
+        sim.write_timeline(args.timeline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.check:
+        overlong = sim.overlong_runs()
+        for zone, start, seconds, limit in overlong:
+            print(f"FAIL zone {zone}: run at {start} lasted {seconds} s, limit {limit} s")
+        if overlong:
+            raise SystemExit(1)
+        print("check passed: no run outlasted its interlock limit")
+
+
+if __name__ == '__main__':
+    main()
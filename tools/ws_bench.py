@@ -0,0 +1,178 @@
+"""
+Compares zone command latency over HTTP and over the WebSocket channel.
+
+Toggles one zone ``--count`` times through ``/activate_pin`` and
+``/deactivate_pin`` (a new connection per request, the way the app used to do
+it), then the same number of times over one ``/ws`` session, and prints the
+round-trip latencies seen by the client. The device records its own side of
+both in ``/metrics`` (``ws:on``/``ws:off`` next to the HTTP routes).
+
+Once a device password is set, pass it with ``--password`` (the script logs
+in through ``/auth/login``) or pass a token from an earlier login with
+``--token``; it is sent as ``Authorization: Bearer`` over HTTP and as
+``?token=`` on the WebSocket URL.
+
+Usage::
+
+    python tools/ws_bench.py 192.168.1.50 --zone 21 --count 50
+    python tools/ws_bench.py 192.168.1.50 --zone 21 --password hunter22
+
+Only needs the standard library.
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import struct
+import time
+
+
+def http_request(host, port, method, path, timeout, token=None, body=None):
+    headers = f'{method} {path} HTTP/1.0\r\nHost: {host}\r\n'
+    if token:
+        headers += f'Authorization: Bearer {token}\r\n'
+    payload = b''
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers += f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall((headers + '\r\n').encode() + payload)
+        response = b''
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            response += chunk
+    head, _, content = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    if status != 200:
+        raise RuntimeError(f'{method} {path} returned {status}')
+    return content
+
+
+def http_get(host, port, path, timeout, token=None):
+    http_request(host, port, 'GET', path, timeout, token=token)
+
+
+def login(host, port, password, timeout):
+    """Return a session token for the device password."""
+    content = http_request(host, port, 'POST', '/auth/login', timeout,
+                           body={'password': password})
+    return json.loads(content)['token']
+
+
+class WebSocketClient:
+    """A minimal blocking WebSocket client (text frames only)."""
+    def __init__(self, host, port, path='/ws', timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+                           'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                           f'Sec-WebSocket-Key: {key}\r\n'
+                           'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = self.sock.recv(1)
+            if not chunk:
+                raise RuntimeError('connection closed during the handshake')
+            response += chunk
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            raise RuntimeError(f'handshake failed: {response.splitlines()[0]!r}')
+
+    def _recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise RuntimeError('connection closed')
+            data += chunk
+        return data
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | len(payload))
+        else:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, len(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def receive(self):
+        opcode, length = self._recv_exactly(2)
+        opcode &= 0x0F
+        length &= 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._recv_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._recv_exactly(8))[0]
+        payload = self._recv_exactly(length)
+        if opcode == 0x8:
+            raise RuntimeError('server closed the connection')
+        return json.loads(payload)
+
+    def request(self, message):
+        """Send a command and wait for its reply, skipping pushes."""
+        self.send(message)
+        while True:
+            reply = self.receive()
+            if reply.get('id') == message['id']:
+                return reply
+
+    def close(self):
+        self.sock.sendall(struct.pack('!BB', 0x88, 0x80) + os.urandom(4))
+        self.sock.close()
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    n = len(samples)
+    print(f'{name:10s} n={n:4d}  median {samples[n // 2] * 1000:7.1f} ms  '
+          f'p95 {samples[min(n - 1, int(n * 0.95))] * 1000:7.1f} ms  '
+          f'max {samples[-1] * 1000:7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('host')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--zone', default='LED', help='zone id or name to toggle')
+    parser.add_argument('--count', type=int, default=20, help='toggles per transport')
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--password', help='device password, to log in first')
+    parser.add_argument('--token', help='session token from an earlier login')
+    args = parser.parse_args()
+
+    token = args.token
+    if token is None and args.password is not None:
+        token = login(args.host, args.port, args.password, args.timeout)
+
+    http = []
+    for i in range(args.count):
+        path = f'/activate_pin/{args.zone}' if i % 2 == 0 else f'/deactivate_pin/{args.zone}'
+        started = time.perf_counter()
+        http_get(args.host, args.port, path, args.timeout, token)
+        http.append(time.perf_counter() - started)
+
+    ws_path = f'/ws?token={token}' if token else '/ws'
+    client = WebSocketClient(args.host, args.port, ws_path, timeout=args.timeout)
+    client.receive() # the initial state message
+    ws = []
+    for i in range(args.count):
+        message = {'id': i, 'op': 'on' if i % 2 == 0 else 'off', 'zone': args.zone}
+        started = time.perf_counter()
+        reply = client.request(message)
+        ws.append(time.perf_counter() - started)
+        if not reply.get('ok'):
+            raise RuntimeError(f'command failed: {reply}')
+    client.close()
+    if args.count % 2:
+        http_get(args.host, args.port, f'/deactivate_pin/{args.zone}', args.timeout, token)
+
+    summarize('http', http)
+    summarize('websocket', ws)
+
+
+if __name__ == '__main__':
+    main()
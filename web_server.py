@@ -1,13 +1,33 @@
-import ujson # For saving/loading schedules and Wi-Fi config
+import ujson # For the /get_schedules response
 import utime # For basic time functions
-import ntptime # For synchronizing time with NTP
 import uasyncio as asyncio # For concurrent tasks
 
 from microdot import Microdot, Response # Import Microdot and Response
 import sys
 from wifi_connector import Wifi_Connector
-from accesspoint import APModeManager
+from accesspoint import APModeManager, CAPTIVE_PROBES
 from relay import Relay
+from relay_backends import batch
+from relay_registry import RelayRegistry
+from metrics import Metrics
+from static_files import StaticFiles
+from profiler import Profiler
+from loop_watchdog import LoopWatchdog
+from interlock import RuntimeInterlock
+from timezone import Timezone
+from reconciler import ScheduleReconciler, schedule_windows, parse_hhmm, DAY_NAMES
+from ntp_client import NTPClient
+from zone_queue import ZoneQueue
+from usage import UsageRecorder
+import event_log
+from event_log import EventLog, zone_code
+from dual_core import Core1Engine
+from websocket_channel import ControlChannel
+from cbor import CBOREncoding
+import ota
+from ota import OTAUpdater
+from config_store import ConfigStore
+from session_auth import SessionAuth, PUBLIC_PATHS
 # Removed unused 'ssl' import
 
 """
@@ -24,80 +44,321 @@ AP_SSID = "PicoSprinklerAP"
 AP_PASSWORD = "ILOVEPICO!"
 AP_IP_ADDRESS = "192.168.4.1"
 
-# File for persisting Wi-Fi credentials
-WIFI_CONFIG_FILE = "wifi_config.json"
+# Settings kept on flash (Wi-Fi credentials, schedules), one file cached in RAM;
+# imports wifi_config.json and schedules.json of earlier versions on first boot
+CONFIG_FILE = "settings.json"
+# Access point (BSSID), channel and address of the last good connection, for a fast reconnect
+WIFI_CACHE_FILE = "wifi_cache.json"
+
+# File for the persistent event log (fixed size, survives reboots)
+EVENT_LOG_FILE = "events.bin"
+
+# Run the schedule engine and relay control on the second core, so a busy web
+# server can never delay a valve; the network side talks to it through rings
+DUAL_CORE = False
 
 # --- General Setup ---
+_CONFIG = ConfigStore(CONFIG_FILE)
+
+# Structured diagnostics that outlive the USB console, served at /events
+_EVENTS = EventLog(EVENT_LOG_FILE)
+
+# Timing of handlers, background tasks and blocking calls, served at /profile
+_PROFILER = Profiler()
+
+# Feeds the hardware watchdog only while the event loop is responsive
+_WATCHDOG = LoopWatchdog()
+_WATCHDOG.on_stall = lambda latency_ms: _EVENTS.log(event_log.LOOP_STALL, value=latency_ms)
+
 _AP_MANAGER = APModeManager(ssid=AP_SSID, password=AP_PASSWORD, ip_address=AP_IP_ADDRESS)
+_AP_MANAGER.on_result = lambda active: _EVENTS.log(event_log.AP_MODE, value=int(active))
 
 # general tasks
-_WIFI_CONNECTOR = Wifi_Connector() # current defaults to my wifi and password, can change ssid and password here by updating initialization
-_LED = Relay()
-_RELAY1 = Relay(pinTag=21)
-_RELAY_MAP = {
-    _LED.pinTag(): _LED,
-    _RELAY1.pinTag(): _RELAY1
-    }
+_WIFI_CONNECTOR = Wifi_Connector(cache_file=WIFI_CACHE_FILE, reuse_lease=True) # current defaults to my wifi and password, can change ssid and password here by updating initialization
+_WIFI_CONNECTOR.connect = _PROFILER.wrap('wifi_connect', _WIFI_CONNECTOR.connect)
+_WIFI_CONNECTOR.on_wait = _WATCHDOG.feed_blocking
+_WIFI_CONNECTOR.on_result = lambda connected, status: _EVENTS.log(
+    event_log.WIFI_CONNECTED if connected else event_log.WIFI_FAILED,
+    value=_WIFI_CONNECTOR.last_connect_ms if connected else status)
+
+_ENGINE = Core1Engine() if DUAL_CORE else None
+# Listeners that write flash or talk to the network; in dual-core mode they run
+# on this core, fed by the engine, instead of on the core that switches relays
+add_relay_listener = _ENGINE.add_listener if _ENGINE is not None else Relay.add_listener
+# Listeners of the modules that switch relays themselves (interlock, zone queue); in
+# dual-core mode they run on the engine's core, which switches every relay
+add_engine_listener = _ENGINE.add_engine_listener if _ENGINE is not None else Relay.add_listener
+
+# Zones (id, name, pin) are configured in the config store; defaults to the onboard LED and pin 21
+_RELAYS = RelayRegistry(_CONFIG)
+
+# Safety interlock: no zone stays on longer than this, whatever the schedule says
+MAX_ZONE_RUNTIME_SECONDS = 2 * 3600
+ZONE_RUNTIME_LIMITS = {} # per-zone overrides in seconds, keyed by pin tag
+_INTERLOCK = RuntimeInterlock(max_runtime_s=MAX_ZONE_RUNTIME_SECONDS, zone_limits=ZONE_RUNTIME_LIMITS)
+add_engine_listener(_INTERLOCK.on_relay_change)
+
+def log_trip(relay, runtime_s):
+    """Records an interlock trip in the event log."""
+    _EVENTS.log(event_log.INTERLOCK_TRIP, zone_code(relay.pinTag()), runtime_s, urgent=True)
+# the engine's core leaves the event log to this one
+_INTERLOCK.on_trip = log_trip if _ENGINE is None else \
+    lambda relay, runtime_s: _ENGINE.defer(log_trip, relay, runtime_s)
+
+def log_relay_change(relay, is_on):
+    """Relay listener that records every zone switching on or off in the event log."""
+    _EVENTS.log(event_log.ZONE_ON if is_on else event_log.ZONE_OFF, zone_code(relay.pinTag()))
+add_relay_listener(log_relay_change)
 
 # for scheduling
-SCHEDULE_FILE = "schedules.json"
+# POSIX TZ rule for local schedule times; San Francisco (PST/PDT) by default
+TIMEZONE = "PST8PDT,M3.2.0,M11.1.0"
+_TIMEZONE = Timezone(TIMEZONE)
 _SCHEDULES = {}
 
 # Make 'app' a global variable so it's accessible everywhere
 app = Microdot() # <--- Define app globally here!
 
+# Request counters and latency histograms, served at /metrics
+_METRICS = Metrics(max_routes=32) # HTTP routes plus one label per WebSocket op
+
+# Dict/list responses as CBOR for clients sending "Accept: application/cbor"
+_CBOR = CBOREncoding()
+
+# One persistent connection per app session at /ws: zone commands in, state changes out
+_CHANNEL = ControlChannel(key_for=_RELAYS.id_of, metrics=_METRICS)
+add_relay_listener(_CHANNEL.on_relay_change)
+
+# Bundled web UI (works in AP mode without the phone app), from the running code slot
+WEB_UI_ROOT = ota.slot_path("www")
+_STATIC = StaticFiles(root=WEB_UI_ROOT)
+
+# Over-the-air updates into the inactive code slot, signed with the key in ota.key
+# (uploads are refused without one); see tools/ota_push.py
+OTA_KEY_FILE = "ota.key"
+_OTA = OTAUpdater(key=ota.load_key(OTA_KEY_FILE))
+
+# Signed session tokens for every route once a password is set (POST /auth/password);
+# /ota checks its own signature, and while the setup AP is up only the setup page's
+# Wi-Fi form and the captive portal checks are let through without a token
+_AUTH = SessionAuth(_CONFIG, public=PUBLIC_PATHS + ('/ota',))
+AP_SETUP_PATHS = ('/configure_wifi',) + CAPTIVE_PROBES
+_AUTH.allow = lambda request: _AP_MANAGER.is_ap_active and request.path in AP_SETUP_PATHS
+# the first password is set on the setup page, from the AP only, before Wi-Fi is configured
+_AUTH.setup_open = lambda request: _AP_MANAGER.is_ap_active
+
 # --- Wi-Fi Configuration Persistence Helper Functions ---
 def save_wifi_credentials(ssid, password):
-    """Saves the given Wi-Fi SSID and password to a file for persistence."""
+    """Saves the given Wi-Fi SSID and password in the config store (one flash write)."""
     try:
-        with open(WIFI_CONFIG_FILE, 'w') as f:
-            ujson.dump({"ssid": ssid, "password": password}, f)
+        with _CONFIG.batch():
+            _CONFIG.set("wifi.ssid", ssid)
+            _CONFIG.set("wifi.password", password)
         print("Wi-Fi credentials saved successfully.")
     except Exception as e:
         print(f"Error saving Wi-Fi credentials: {e}")
 
 def load_wifi_credentials():
-    """Loads Wi-Fi SSID and password from the configuration file."""
-    try:
-        with open(WIFI_CONFIG_FILE, 'r') as f:
-            config = ujson.load(f)
-            return config.get("ssid"), config.get("password")
-    except (OSError, ValueError):
-        # OSError: File not found (e.g., first boot)
-        # ValueError: Invalid JSON in file
-        print("No Wi-Fi config file found or invalid JSON. Starting fresh.")
-        return None, None
-    except Exception as e:
-        print(f"Unexpected error loading Wi-Fi credentials: {e}")
-        return None, None
+    """Returns the saved Wi-Fi SSID and password, (None, None) if there are none."""
+    ssid, password = _CONFIG.get_str("wifi.ssid"), _CONFIG.get_str("wifi.password")
+    if ssid is None:
+        print("No Wi-Fi credentials saved. Starting fresh.")
+    return ssid, password
 
 # --- Schedule Management Functions ---
 def load_schedules():
-    """Loads schedules from the schedules.json file."""
+    """Loads the schedules from the config store."""
     global _SCHEDULES
-    try:
-        with open(SCHEDULE_FILE, 'r') as f:
-            _SCHEDULES = ujson.load(f)
-        print("Schedules loaded:", _SCHEDULES)
-    except (OSError, ValueError): # Handle file not found or invalid JSON
-        print("No schedules file found or invalid JSON. Starting fresh.")
+    _SCHEDULES = _CONFIG.get_dict("schedules")
+    if _SCHEDULES is None:
+        print("No schedules saved. Starting fresh.")
         _SCHEDULES = {}
+    else:
+        print("Schedules loaded:", _SCHEDULES)
+    compile_schedules()
 
+@_PROFILER.profile('save_schedules')
 def save_schedules():
-    """Saves current schedules to the schedules.json file."""
-    with open(SCHEDULE_FILE, 'w') as f:
-        ujson.dump(_SCHEDULES, f)
+    """Saves current schedules in the config store, which recompiles them."""
+    _CONFIG.set("schedules", _SCHEDULES)
     print("Schedules saved.")
 
+def on_schedules_changed(key, schedules):
+    """Config store subscriber: logs and recompiles every saved schedule change."""
+    _EVENTS.log(event_log.SCHEDULE_CHANGED)
+    compile_schedules()
+
+def compile_schedules():
+    """Recompiles the schedules, on the engine's core in dual-core mode."""
+    if _ENGINE is not None:
+        _ENGINE.compile(dict(_SCHEDULES)) # the engine gets a copy routes won't modify
+    else:
+        _RECONCILER.compile(_SCHEDULES)
+
+_CONFIG.subscribe("schedules", on_schedules_changed)
+
+def switch_zone(relay, on):
+    """Turns a zone on or off, through the engine's command ring while it runs."""
+    if _ENGINE is not None and _ENGINE.running:
+        return _ENGINE.switch(relay, on)
+    if on:
+        relay.turn_on()
+    else:
+        relay.turn_off()
+    return True
+
+def zone_status(relay):
+    """Returns "On" or "Off"; from the engine's snapshot while it owns the relays."""
+    if _ENGINE is not None and _ENGINE.running:
+        return "On" if _ENGINE.states().get(relay.pinTag()) else "Off"
+    return relay.status()
+
+def update_schedule(relay, action, data):
+    """Adds/updates or deletes the schedule of a zone; shared by the HTTP route
+    and the WebSocket channel. Returns a (message, status_code) tuple."""
+    pin_tag_normalized = _RELAYS.id_of(relay) # schedules are keyed by zone id
+    if action == "add_schedule":
+        turn_on_time = data.get("turn_on_time")
+        turn_off_time = data.get("turn_off_time")
+        days = data.get("days")
+
+        if not all([turn_on_time, turn_off_time, days is not None and isinstance(days, list)]):
+            print(f"Missing schedule parameters for add_schedule: {data}")
+            return "Error: Missing 'turn_on_time', 'turn_off_time', or 'days' for add_schedule", 400
+
+        schedule = {
+            "turn_on_time": turn_on_time,
+            "turn_off_time": turn_off_time,
+            "days": days
+        }
+        try:
+            schedule_windows(schedule) # validates times and day names
+        except (AttributeError, ValueError) as e:
+            print(f"Invalid schedule parameters for add_schedule: {e}")
+            return f"Error: Invalid schedule: {e}. Times must be 'HH:MM' and days one of {', '.join(DAY_NAMES)}", 400
+
+        _SCHEDULES[pin_tag_normalized] = schedule
+        save_schedules()
+        print(f"Schedule added/updated for pin {pin_tag_normalized}: {turn_on_time}-{turn_off_time} on {days}")
+        return f"Schedule added/updated for pin {pin_tag_normalized}", 200
+
+    elif action == "delete_schedule":
+        if pin_tag_normalized in _SCHEDULES:
+            del _SCHEDULES[pin_tag_normalized]
+            save_schedules()
+            print(f"Schedule deleted for pin {pin_tag_normalized}.")
+            return f"Schedule deleted for pin {pin_tag_normalized}", 200
+        else:
+            print(f"Schedule not found for pin {pin_tag_normalized}.")
+            return "Error: Schedule not found for pin", 404
+    else:
+        print(f"Invalid schedule action received: {action}")
+        return "Error: Invalid schedule action. Must be 'add_schedule' or 'delete_schedule'", 400
+
+def compact_schedules():
+    """Returns the schedules as {zone id: [on minute, off minute, day bitmask]},
+    minutes since midnight and bit 0 for Monday, e.g. {"21": [360, 390, 21]}."""
+    compact = {}
+    for key, schedule in _SCHEDULES.items():
+        try:
+            days = 0
+            for day in schedule.get("days", []):
+                days |= 1 << DAY_NAMES.index(day)
+            compact[key] = [parse_hhmm(schedule["turn_on_time"]),
+                            parse_hhmm(schedule["turn_off_time"]), days]
+        except (KeyError, ValueError, AttributeError):
+            print(f"Invalid schedule for pin {key}. Skipping.")
+    return compact
+
+def relay_for_key(pin_tag):
+    """Returns the relay for a zone id, name or schedule key ("LED", "21"), or None."""
+    return _RELAYS.get(pin_tag)
+
+# Scheduled runs go through a queue so overlapping schedules don't open too many valves
+MAX_CONCURRENT_ZONES = 1
+MASTER_VALVE_PIN = None # pin of a master valve/pump relay, or None if there is none
+_MASTER_VALVE = Relay(pinTag=MASTER_VALVE_PIN) if MASTER_VALVE_PIN is not None else None
+if _MASTER_VALVE is not None:
+    ZONE_RUNTIME_LIMITS[MASTER_VALVE_PIN] = 24 * 3600 # stays open across back-to-back runs
+_ZONE_QUEUE = ZoneQueue(max_concurrent=MAX_CONCURRENT_ZONES, master=_MASTER_VALVE)
+add_engine_listener(_ZONE_QUEUE.on_relay_change)
+
+_RECONCILER = ScheduleReconciler(_TIMEZONE, relay_for_key, queue=_ZONE_QUEUE)
+
+# Periodic, non-blocking time sync; a clock step makes the scheduler reconcile all zones
+NTP_HOST = "pool.ntp.org"
+def clock_stepped(step):
+    """Called by the NTP client after it stepped the clock by step seconds."""
+    _EVENTS.log(event_log.NTP_STEP, value=step)
+    if _ENGINE is not None:
+        _ENGINE.notify_clock_step()
+    else:
+        _RECONCILER.notify_clock_step()
+
+_NTP = NTPClient(host=NTP_HOST, on_step=clock_stepped)
+_NTP_TASK = None
+
+def start_time_sync():
+    """Starts the NTP task once, after the first successful connection to the home Wi-Fi
+    (at boot or from /configure_wifi); schedules only run once the clock is set."""
+    global _NTP_TASK
+    if _NTP_TASK is None:
+        _NTP_TASK = asyncio.create_task(_PROFILER.task('ntp_sync', _NTP.run()))
+
+# Runtime and estimated water use per zone, hourly for a week and daily for a year
+USAGE_FILE = "usage.bin"
+DEFAULT_FLOW_RATE_GPM = 2.0 # gallons per minute of a zone not in ZONE_FLOW_RATES_GPM
+ZONE_FLOW_RATES_GPM = {} # per-zone flow rates, keyed by zone id (e.g. "21": 3.5)
+_USAGE = UsageRecorder(USAGE_FILE, timezone=_TIMEZONE, flow_rates=ZONE_FLOW_RATES_GPM,
+                       default_flow_gpm=DEFAULT_FLOW_RATE_GPM, key_for=_RELAYS.id_of)
+add_relay_listener(_USAGE.on_relay_change)
+
+# Zones added or removed over HTTP take effect without a restart
+def relays_changed():
+    """Called by the relay registry after a zone was added or removed."""
+    _EVENTS.log(event_log.RELAYS_CHANGED)
+    compile_schedules()
+
+_RELAYS.on_change = relays_changed
+_RELAYS.switch = switch_zone # a removed zone is switched off on the engine's core
+
 def turn_off_all_relays():
-    """Ensures all connected relays are turned off."""
+    """Ensures all connected relays (and the master valve) are turned off, on the
+    engine's core while it runs."""
+    if _ENGINE is not None and _ENGINE.running:
+        return _ENGINE.call(switch_off_all_relays)
+    switch_off_all_relays()
+    return True
+
+def switch_off_all_relays():
+    """Turns every relay and the master valve off on the calling core."""
     print("Turning off all relays...")
-    for pin in _RELAY_MAP.values():
-        pin.turn_off()
+    # relays sharing a backend (shift register, expander) switch in one write
+    relays = _RELAYS.relays()
+    with batch(*{pin.backend() for pin in relays}):
+        for pin in relays:
+            pin.turn_off()
+    if _MASTER_VALVE is not None:
+        _MASTER_VALVE.turn_off()
     print("All relays off.")
 
 # --- Microdot Web Server Routes ---
 
+@app.route('/')
+async def index(request):
+    """Serves the bundled web UI."""
+    return _STATIC.response(request, 'index.html')
+
+@app.route('/setup')
+async def setup_page(request):
+    """Serves the Wi-Fi setup page that the captive portal sends phones to."""
+    return _STATIC.response(request, 'setup.html')
+
+@app.route('/ui/<path:filename>')
+async def static_file(request, filename):
+    """Serves other web UI assets (gzipped when the client accepts it)."""
+    return _STATIC.response(request, filename)
+
 @app.route('/configure_wifi', methods=['POST'])
 async def configure_wifi(request):
     """
@@ -116,10 +377,15 @@ async def configure_wifi(request):
             print("Error: SSID is required in Wi-Fi configuration request.")
             return Response("Error: 'ssid' is required.", status_code=400)
 
+        if not _AUTH.enabled:
+            # the API would be open to the whole home network
+            print("Error: no device password set.")
+            return Response("Error: set a device password first.", status_code=400)
+
         print(f"Attempting to connect to home Wi-Fi: {ssid}")
 
         # If currently in AP mode, disconnect from it before trying client mode
-        if _AP_MANAGER.is_ap_active: # Assuming APModeManager has a way to check if AP is active
+        if _AP_MANAGER.is_ap_active:
             _AP_MANAGER.disconnect()
             print("Disconnected from AP mode.")
             await asyncio.sleep(0.5) # Give a moment for network interface to settle
@@ -131,6 +397,7 @@ async def configure_wifi(request):
         # Attempt to connect to the new home Wi-Fi
         if _WIFI_CONNECTOR.connect():
             save_wifi_credentials(ssid, password) # Save for persistence on successful connection
+            start_time_sync() # a device set up from the AP has no clock yet
             ip_address = _WIFI_CONNECTOR.get_ip_address()
             print(f"Successfully connected to home Wi-Fi: {ssid}. IP: {ip_address}")
             # If successful, the PicoSprinkler should now be on the home network.
@@ -139,7 +406,7 @@ async def configure_wifi(request):
             print(f"Failed to connect to home Wi-Fi: {ssid}. Re-enabling AP mode.")
             # If connection fails, re-enable AP mode so the user can try again
             await asyncio.sleep(1) # Give a moment before re-starting AP
-            _AP_MANAGER.setup_ap_mode() # Re-activate AP for retry
+            await _AP_MANAGER.start() # Re-activate AP for retry
             return Response(f"Failed to connect to Wi-Fi: {ssid}. Please re-connect to PicoSprinkler AP and try again.", status_code=500)
 
     except ValueError as e:
@@ -149,6 +416,7 @@ async def configure_wifi(request):
     except Exception as e:
         sys.print_exception(e)
         print(f"Unexpected error in /configure_wifi: {e}")
+        _EVENTS.log(event_log.ERROR, urgent=True)
         return Response(f"Internal Server Error: {e}", status_code=500)
 
 
@@ -157,19 +425,11 @@ async def activate_pin(request, pin_tag):
     """Activates a specified relay pin."""
     print(f"Received request to activate pin: {pin_tag}")
 
-    # Normalize pin_tag: "LED" remains string, others converted to int
-    if pin_tag != "LED":
-        try:
-            pin_tag = int(pin_tag)
-        except ValueError:
-            error_message = f"Error: Invalid pin_tag format '{pin_tag}'. Must be 'LED' or an integer."
-            print(error_message)
-            return error_message, 400
-
-    pin = _RELAY_MAP.get(pin_tag)
+    pin = _RELAYS.get(pin_tag) # zone id or name
 
     if pin is not None:
-        pin.turn_on()
+        if not switch_zone(pin, True):
+            return f"Error: Pin '{pin_tag}' is busy, try again", 503
         return f"Successfully activated pin {pin_tag}", 200
 
     error_message = f"Error: Pin '{pin_tag}' does not exist"
@@ -181,19 +441,11 @@ async def deactivate_pin(request, pin_tag):
     """Deactivates a specified relay pin."""
     print(f"Received request to deactivate pin: {pin_tag}")
 
-    # Normalize pin_tag
-    if pin_tag != "LED":
-        try:
-            pin_tag = int(pin_tag)
-        except ValueError:
-            error_message = f"Error: Invalid pin_tag format '{pin_tag}'. Must be 'LED' or an integer."
-            print(error_message)
-            return error_message, 400
-
-    pin = _RELAY_MAP.get(pin_tag)
+    pin = _RELAYS.get(pin_tag) # zone id or name
 
     if pin is not None:
-        pin.turn_off()
+        if not switch_zone(pin, False):
+            return f"Error: Pin '{pin_tag}' is busy, try again", 503
         return f"Successfully deactivated pin {pin_tag}", 200
 
     error_message = f"Error: Pin '{pin_tag}' does not exist"
@@ -205,19 +457,10 @@ async def get_status(request, pin_tag):
     """Gets the current status of a specified relay pin."""
     print(f"Received request to get pin status: {pin_tag}")
 
-    # Normalize pin_tag
-    if pin_tag != "LED":
-        try:
-            pin_tag = int(pin_tag)
-        except ValueError:
-            error_message = f"Error: Invalid pin_tag format '{pin_tag}'. Must be 'LED' or an integer."
-            print(error_message)
-            return error_message, 400
-
-    pin = _RELAY_MAP.get(pin_tag)
+    pin = _RELAYS.get(pin_tag) # zone id or name
 
     if pin is not None:
-        return pin.status(), 200 # assume all pins have a status
+        return zone_status(pin), 200
     else:
         error_message = f"Error: Pin '{pin_tag}' does not exist"
         return error_message, 404
@@ -244,51 +487,14 @@ async def schedule_pin(request, pin_tag):
             print(f"Missing 'action' in JSON: {data}")
             return Response("Error: 'action' is required in JSON body", status_code=400)
 
-        # Normalize pin_tag from URL path
-        if isinstance(pin_tag, str) and pin_tag.upper() == "LED":
-            pin_tag_normalized = "LED"
-        else:
-            try:
-                pin_tag_normalized = int(pin_tag)
-            except (ValueError, TypeError):
-                print(f"Invalid pin_tag format in path: {pin_tag}")
-                return Response("Error: Invalid 'pin_tag' format in URL path. Must be 'LED' or an integer.", status_code=400)
-
-        if pin_tag_normalized not in _RELAY_MAP:
-            print(f"Pin tag '{pin_tag_normalized}' does not exist in RELAY_MAP.")
+        # Schedules are keyed by zone id, whether the URL names the zone by id or name
+        relay = _RELAYS.get(pin_tag)
+        if relay is None:
+            print(f"Pin tag '{pin_tag}' does not exist in the relay registry.")
             return Response("Error: Pin does not exist", status_code=404)
 
-        if action == "add_schedule":
-            turn_on_time = data.get("turn_on_time")
-            turn_off_time = data.get("turn_off_time")
-            days = data.get("days")
-
-            if not all([turn_on_time, turn_off_time, days is not None and isinstance(days, list)]):
-                print(f"Missing schedule parameters for add_schedule: {data}")
-                return Response("Error: Missing 'turn_on_time', 'turn_off_time', or 'days' for add_schedule", status_code=400)
-
-            _SCHEDULES[str(pin_tag_normalized)] = {
-                "turn_on_time": turn_on_time,
-                "turn_off_time": turn_off_time,
-                "days": days,
-                "last_triggered_date": "" # Reset for new schedule
-            }
-            save_schedules()
-            print(f"Schedule added/updated for pin {pin_tag_normalized}: {turn_on_time}-{turn_off_time} on {days}")
-            return Response(f"Schedule added/updated for pin {pin_tag_normalized}", status_code=200)
-
-        elif action == "delete_schedule":
-            if str(pin_tag_normalized) in _SCHEDULES:
-                del _SCHEDULES[str(pin_tag_normalized)]
-                save_schedules()
-                print(f"Schedule deleted for pin {pin_tag_normalized}.")
-                return Response(f"Schedule deleted for pin {pin_tag_normalized}", status_code=200)
-            else:
-                print(f"Schedule not found for pin {pin_tag_normalized}.")
-                return Response("Error: Schedule not found for pin", status_code=404)
-        else:
-            print(f"Invalid schedule action received: {action}")
-            return Response("Error: Invalid schedule action. Must be 'add_schedule' or 'delete_schedule'", status_code=400)
+        message, status_code = update_schedule(relay, action, data)
+        return Response(message, status_code=status_code)
 
     except ValueError as e:
         sys.print_exception(e)
@@ -297,148 +503,152 @@ async def schedule_pin(request, pin_tag):
     except Exception as e:
         sys.print_exception(e)
         print(f"Unexpected error processing schedule request: {e}")
+        _EVENTS.log(event_log.ERROR, urgent=True)
         return Response(f"Internal Server Error: {e}", status_code=500)
 
+@app.route('/schedules', methods=['PUT'])
+async def put_schedules(request):
+    """
+    Replaces the whole schedule set with a JSON object keyed by zone id or name,
+    e.g. {"21": {"turn_on_time": "06:00", "turn_off_time": "06:30", "days": ["Mon"]}}.
+    The body may be sent with Transfer-Encoding: chunked, so a client can stream
+    the set without knowing its length upfront. Nothing is saved unless every
+    entry is valid.
+    """
+    try:
+        data = request.json
+    except ValueError as e:
+        return Response(f"Error parsing JSON: {e}", status_code=400)
+    if not isinstance(data, dict):
+        return Response("Error: Expected a JSON object of schedules keyed by zone", status_code=400)
+
+    schedules = {}
+    for zone, entry in data.items():
+        relay = _RELAYS.get(zone)
+        if relay is None:
+            return Response(f"Error: Pin '{zone}' does not exist", status_code=404)
+        try:
+            schedule = {
+                "turn_on_time": entry["turn_on_time"],
+                "turn_off_time": entry["turn_off_time"],
+                "days": entry["days"]
+            }
+            schedule_windows(schedule) # validates times and day names
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return Response(f"Error: Invalid schedule for pin {zone}: {e}", status_code=400)
+        schedules[_RELAYS.id_of(relay)] = schedule
+
+    _SCHEDULES.clear()
+    _SCHEDULES.update(schedules)
+    save_schedules()
+    print(f"Schedule set replaced: {len(schedules)} zones.")
+    return Response(f"{len(schedules)} schedules saved", status_code=200)
+
 @app.route('/get_schedules', methods=['GET'])
 async def get_schedules(request):
-    """Returns all currently stored schedules as a JSON response."""
+    """Returns all currently stored schedules as a JSON response, or in the
+    compact form of compact_schedules() as CBOR if the client accepts it."""
+    if _CBOR.accepts(request):
+        return compact_schedules()
     return Response(ujson.dumps(_SCHEDULES), status_code=200, headers={'Content-Type': 'application/json'})
 
+# --- WEBSOCKET CONTROL CHANNEL ---
+# Compact commands over /ws, e.g. {"id": 1, "op": "on", "zone": "21"}; a KeyError
+# is reported as an unknown zone and a ValueError as a bad request
+
+def channel_zone(message):
+    """Returns the relay named by a channel message's "zone" (id or name)."""
+    relay = _RELAYS.get(message.get("zone"))
+    if relay is None:
+        raise KeyError(f"Error: Pin '{message.get('zone')}' does not exist")
+    return relay
+
+@_CHANNEL.op('on')
+def channel_on(message):
+    if not switch_zone(channel_zone(message), True):
+        raise ValueError("busy, try again")
+
+@_CHANNEL.op('off')
+def channel_off(message):
+    if not switch_zone(channel_zone(message), False):
+        raise ValueError("busy, try again")
+
+@_CHANNEL.op('status')
+def channel_status(message):
+    if message.get("zone") is not None:
+        return {"status": zone_status(channel_zone(message))}
+    return {"zones": {_RELAYS.id_of(relay): zone_status(relay) for relay in _RELAYS.relays()}}
+
+@_CHANNEL.op('schedules')
+def channel_schedules(message):
+    return {"schedules": _SCHEDULES}
+
+def channel_schedule_action(action, message):
+    data = {"turn_on_time": message.get("on"), "turn_off_time": message.get("off"),
+            "days": message.get("days")}
+    text, status_code = update_schedule(channel_zone(message), action, data)
+    if status_code == 404:
+        raise KeyError(text)
+    if status_code != 200:
+        raise ValueError(text)
+
+@_CHANNEL.op('schedule')
+def channel_schedule(message):
+    channel_schedule_action("add_schedule", message)
+
+@_CHANNEL.op('unschedule')
+def channel_unschedule(message):
+    channel_schedule_action("delete_schedule", message)
+
 # --- ERROR HANDLERS ---
 @app.errorhandler(404)
 async def not_found(request):
     """Handles 404 Not Found errors."""
     return {'error': 'resource not found'}, 404
 
-# --- Asynchronous Background Tasks ---
-async def sync_time():
-    """Synchronizes the PicoSprinkler's time with an NTP server."""
-    print("Synchronizing time with NTP...")
-    try:
-        ntptime.settime()
-        print("Time synchronized.")
-    except Exception as e:
-        print(f"Failed to sync time: {e}")
-    await asyncio.sleep(3600) # Sync every hour (3600 seconds)
+# --- METRICS AND PROFILING ---
+_PROFILER.wrap_app(app) # time every route registered above
+_AP_MANAGER.install(app) # registers the /ap route and the captive portal redirects, which need no token
+_AUTH.install(app) # checks tokens before every route; registers the /auth routes
+_PROFILER.install(app) # registers the /profile route
+_WATCHDOG.install(app) # registers the /watchdog route
+_NTP.install(app) # registers the /ntp route
+_WIFI_CONNECTOR.install(app) # registers the /wifi route
+_RELAYS.install(app) # registers the /relays routes
+_USAGE.install(app) # registers the /usage routes
+_EVENTS.install(app) # registers the /events routes
+_CBOR.install(app) # encodes dict/list responses as CBOR when accepted
+_OTA.install(app) # registers the /ota routes
+_CONFIG.install(app) # registers the /config route
+_CHANNEL.install(app) # registers /ws (not profiled: a session lasts as long as the app is open)
+if _ENGINE is not None:
+    _ENGINE.install(app) # registers /core1, and /interlock and /queue served from its snapshot
+else:
+    _INTERLOCK.install(app) # registers the /interlock route
+    _ZONE_QUEUE.install(app) # registers the /queue route
+_METRICS.install(app) # registers the /metrics route
 
+# --- Asynchronous Background Tasks ---
 async def schedule_checker():
-    """Periodically checks and applies scheduled relay operations."""
-    global _RELAY_MAP, _SCHEDULES
+    """Periodically reconciles relays with the compiled schedules."""
     print("Starting schedule checker...")
-
-    # --- MANUAL TIME ZONE OFFSET ---
-    # For San Francisco (PDT) which is UTC-7
-    # Adjust this value if your timezone changes (e.g., for PST in winter)
-    TIMEZONE_OFFSET_SECONDS = -7 * 3600 # -25200 for PDT
     while True:
-        # Get current UTC epoch seconds
-        current_utc_epoch_seconds = utime.time()
-
-        # Add the timezone offset to get local epoch seconds
-        local_epoch_seconds = current_utc_epoch_seconds + TIMEZONE_OFFSET_SECONDS
-
-        # Convert this local epoch time back to a time tuple
-        current_time_local_tuple = utime.localtime(local_epoch_seconds)
-
-        # Extract local time components
-        current_year = current_time_local_tuple[0]
-        current_month = current_time_local_tuple[1]
-        current_day_of_month = current_time_local_tuple[2]
-        current_hour = current_time_local_tuple[3]
-        current_minute = current_time_local_tuple[4]
-        current_weekday = current_time_local_tuple[6]
-
-        # Format local date string
-        current_date_str = f"{current_year}-{current_month:02d}-{current_day_of_month:02d}"
-
-        days_of_week_map = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-        current_day_name = days_of_week_map[current_weekday]
-
-        # print(f"Current Local Time: {current_date_str} {current_hour:02d}:{current_minute:02d} ({current_day_name})")
-
-        for pin_tag, schedule_data in _SCHEDULES.items():
-            # Ensure pin_tag is correctly typed for map lookup
-            if pin_tag != "LED":
-                try:
-                    pin_tag_typed = int(pin_tag)
-                except ValueError:
-                    print(f"Skipping schedule for invalid pin_tag format: {pin_tag}")
-                    continue
-            else:
-                pin_tag_typed = pin_tag
-
-
-            if pin_tag_typed not in _RELAY_MAP:
-                print(f"Schedule found for non-existent pin: {pin_tag}. Removing from schedules.")
-                del _SCHEDULES[str(pin_tag)] # Clean up invalid schedules
-                save_schedules()
-                continue
-
-            relay = _RELAY_MAP[pin_tag_typed]
-
-            scheduled_days = schedule_data.get("days", [])
-            turn_on_str = schedule_data.get("turn_on_time")
-            turn_off_str = schedule_data.get("turn_off_time")
-            last_triggered_date = schedule_data.get("last_triggered_date", "")
-
-            if current_day_name in scheduled_days:
-                try:
-                    on_hour, on_minute = map(int, turn_on_str.split(':'))
-                    off_hour, off_minute = map(int, turn_off_str.split(':'))
-                except ValueError:
-                    print(f"Invalid time format for schedule on {pin_tag_typed}. Skipping.")
-                    continue
-
-                # Check for turn ON event
-                if current_hour == on_hour and current_minute == on_minute:
-                    if last_triggered_date != current_date_str: # Only trigger once per day
-                        if relay.status() == "Off":
-                            relay.turn_on()
-                            _SCHEDULES[str(pin_tag_typed)]["last_triggered_date"] = current_date_str
-                            save_schedules()
-                            print(f"Scheduled ON for {pin_tag_typed} at {current_date_str} {turn_on_str}")
-                # Check for turn OFF event
-                elif current_hour == off_hour and current_minute == off_minute:
-                    if last_triggered_date != current_date_str: # Only trigger once per day
-                        if relay.status() == "On":
-                            relay.turn_off()
-                            _SCHEDULES[str(pin_tag_typed)]["last_triggered_date"] = current_date_str
-                            save_schedules()
-                            print(f"Scheduled OFF for {pin_tag_typed} at {current_date_str} {turn_off_str}")
-
-            # Reset last_triggered_date for the next day to allow re-triggering
-            # This logic assumes on/off times occur within the same 24-hour period.
-            if last_triggered_date == current_date_str:
-                # If current time has passed both the on and off times for the current day
-                current_minutes_since_midnight = current_hour * 60 + current_minute
-                on_minutes_since_midnight = on_hour * 60 + on_minute
-                off_minutes_since_midnight = off_hour * 60 + off_minute
-
-                # Consider if the off time is actually on the next day
-                if off_minutes_since_midnight < on_minutes_since_midnight: # Schedule spans midnight
-                    if current_minutes_since_midnight >= on_minutes_since_midnight or \
-                       current_minutes_since_midnight < off_minutes_since_midnight:
-                        # Still within the active period or hasn't passed the off time yet for next day's turn off
-                        pass # Do nothing, wait for next day or off time
-                    else: # Passed off time for this day/cycle
-                        _SCHEDULES[str(pin_tag_typed)]["last_triggered_date"] = "" # Reset
-                        save_schedules()
-                        # print(f"Resetting midnight-spanning schedule for {pin_tag_typed} for next day.")
-                else: # Schedule on same day
-                    if current_minutes_since_midnight > max(on_minutes_since_midnight, off_minutes_since_midnight):
-                        _SCHEDULES[str(pin_tag_typed)]["last_triggered_date"] = "" # Reset
-                        save_schedules()
-                        # print(f"Resetting same-day schedule for {pin_tag_typed} for next day.")
-
-
-        await asyncio.sleep(60) # Check every 60 seconds (adjust as needed)
+        # Switches only the zones whose scheduled state changed; does a full
+        # reconciliation on the first run and after a clock jump
+        _RECONCILER.tick(utime.time())
+
+        # Wake up just after the next minute boundary
+        await asyncio.sleep(61 - utime.time() % 60)
 
 async def main_loop():
     """The main execution loop for the PicoSprinkler application."""
     print("--- PicoSprinkler Bootup Sequence ---")
 
-    # 1. Turn off all relays on bootup
-    turn_off_all_relays()
+    # 1. Turn off all relays on bootup (also logs a watchdog reset)
+    _WATCHDOG.boot_check(turn_off_all_relays)
+    _EVENTS.log(event_log.BOOT, value=_WATCHDOG.reset_cause or 0)
+    if _WATCHDOG.watchdog_reset:
+        _EVENTS.log(event_log.WATCHDOG_RESET, urgent=True)
 
     # 2. Load schedules from file
     load_schedules()
@@ -451,35 +661,70 @@ async def main_loop():
         _WIFI_CONNECTOR.password = saved_password
         if _WIFI_CONNECTOR.connect():
             print(f"Connected to saved home WiFi. IP: {_WIFI_CONNECTOR.get_ip_address()}")
-            asyncio.create_task(sync_time()) # Sync time only if connected to the internet
+            start_time_sync() # Sync time only if connected to the internet
         else:
             print("Failed to connect to saved home WiFi. Starting AP mode for initial setup.")
             # If saved connection fails, fall back to AP mode for new setup
-            if not _AP_MANAGER.setup_ap_mode():
+            if not await _AP_MANAGER.start():
                 print("AP mode setup failed. Exiting.")
                 sys.exit() # Critical failure
     else:
         print("No saved home WiFi credentials found. Starting AP mode for initial setup.")
         # No saved credentials, directly start AP mode
-        if not _AP_MANAGER.setup_ap_mode():
+        if not await _AP_MANAGER.start():
             print("AP mode setup failed. Exiting.")
             sys.exit() # Critical failure
 
     print("--- Bootup Sequence Complete. Starting Services ---")
 
     # Start the async tasks
-    asyncio.create_task(schedule_checker()) # Schedule checker runs independently
+    if _ENGINE is not None:
+        # the engine polls the schedules, the interlock and the queue itself
+        _ENGINE.start(_RECONCILER, _RELAYS.relays, interlock=_INTERLOCK, queue=_ZONE_QUEUE)
+        asyncio.create_task(_ENGINE.dispatch()) # Runs the relay listeners of this core
+        _WATCHDOG.health_check = _ENGINE.alive # a hung engine resets the board too
+    else:
+        asyncio.create_task(_PROFILER.task('schedule_checker', schedule_checker())) # Schedule checker runs independently
+        asyncio.create_task(_INTERLOCK.run()) # Turns off zones that exceed their maximum runtime
+        asyncio.create_task(_PROFILER.task('zone_queue', _ZONE_QUEUE.run())) # Runs scheduled zones
+    asyncio.create_task(_PROFILER.monitor()) # Measures event loop stalls
+    asyncio.create_task(_WATCHDOG.run()) # Arms and feeds the hardware watchdog
+    asyncio.create_task(_USAGE.run()) # Writes zone runtimes to flash periodically
+    asyncio.create_task(_EVENTS.run()) # Writes staged events to flash periodically
+
+    # An update booted on trial is kept once the server has been up a while and served a request
+    asyncio.create_task(confirm_firmware())
 
     # Run the Microdot web server (this will run concurrently)
     app.run(port=5000, debug=True) # 'app' is globally defined
 
-if __name__ == '__main__':
+async def confirm_firmware():
+    """Confirms a trial OTA slot once it works, then deletes the settings files of the
+    previous firmware, which a rollback to it would have needed."""
+    await _OTA.confirm_when_up()
+    _CONFIG.remove_legacy_files()
+
+def shutdown_services():
+    """Stops the engine, turns every zone off and writes what is buffered in RAM;
+    on exit and before the board resets to boot an update."""
+    _AP_MANAGER.disconnect() # Ensure AP mode is gracefully shut down if active
+    if _ENGINE is not None:
+        _ENGINE.stop() # the relays belong to this core again
+    turn_off_all_relays()
+    _USAGE.flush() # keep the runtime of the zones that were just turned off
+    _EVENTS.flush()
+_OTA.on_reboot = shutdown_services
+
+def run():
+    """Runs the application until it is stopped; main.py calls it after selecting the code slot."""
     try:
         asyncio.run(main_loop())
     except KeyboardInterrupt:
         print("Server and tasks stopped by user (KeyboardInterrupt).")
     finally:
         # Clean up or deactivate things if necessary on exit
-        _AP_MANAGER.disconnect() # Ensure AP mode is gracefully shut down if active
-        turn_off_all_relays()
+        shutdown_services()
         print("PicoSprinkler application terminated.")
+
+if __name__ == '__main__':
+    run()